@@ -1,21 +1,36 @@
 from __future__ import annotations
 
+from typing import Any
+from collections import Counter
 from logging import Logger
+import asyncio
+import cProfile
 import time
+import tracemalloc
+import aiohttp
+from aiohttp.web import Request, Response
 
 # Maubot and Mautrix imports
 from maubot.plugin_base import Plugin
 from maubot.matrix import MaubotMessageEvent, MaubotMatrixClient
-from maubot.handlers import event
-from mautrix.types import EventType, StateEvent, MemberStateEventContent
+from maubot.handlers import event, web
+from mautrix.types import EventType, StateEvent, MemberStateEventContent, MessageEvent, RedactionEvent, EventID, RoomID
+from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig
 
 # Local imports
-from MemeBot.config import Config
-from MemeBot.mixins import CommandMixin, ImageMixin, CooldownMixin, ServerMixin
+from MemeBot.config import Config, ConfigSnapshot
+from MemeBot.db import upgrade_table
+from MemeBot.mixins import (
+    CommandMixin, ImageMixin, CooldownMixin, ServerMixin, QueueMixin, OutboxMixin, DedupMixin, RoomMixin, PrefetchMixin, MetricsMixin, ProfilingMixin, DiagnosticsMixin,
+    CooldownReservation, MessageClassification, PrefetchedImage, PromotionJob, RoomPolicy
+)
+from MemeBot.utils import (
+    ByteBudget, CircuitBreaker, CooldownKey, CooldownStore, MediaCache, MetricsRegistry, MultiIndexHashTable, PromotedImageIndex, PromotedImageKey, RecentEventCache, WorkerPool, WriteBehindBuffer
+)
 
 
-class MemeBot(Plugin, CommandMixin, ImageMixin, CooldownMixin, ServerMixin):
+class MemeBot(Plugin, CommandMixin, ImageMixin, CooldownMixin, ServerMixin, QueueMixin, OutboxMixin, DedupMixin, RoomMixin, PrefetchMixin, MetricsMixin, ProfilingMixin, DiagnosticsMixin):
     """
     Matrix bot that promotes images to an external server when users use promotion commands.
     Usage: Reply to an image with !promote or !p, or upload an image with the command as caption.
@@ -30,41 +45,172 @@ class MemeBot(Plugin, CommandMixin, ImageMixin, CooldownMixin, ServerMixin):
     
     # Plugin state - controls whether functionality is enabled
     _config_valid: bool = True
+    # Whether the caches, stores and workers were set up, which is postponed to the first valid config if the one at start is invalid
+    components_started: bool = False
+    component_start_task: asyncio.Task[None] | None = None
+    # Settings read while handling events, replaced as a whole whenever a valid config is loaded
+    config_snapshot: ConfigSnapshot
     
-    # Cooldown tracking
-    next_global_promotion_time: float = time.time()  # Timestamp when next global promotion is allowed
-    user_promotion_cooldowns: dict[str, float] = {}  # User ID -> timestamp when next promotion is allowed for that user
+    # Step latencies, outcomes and gauges served at /metrics (created in start)
+    metrics: MetricsRegistry | None = None
+    
+    # Allowlist (None = all rooms) and settings of the rooms, precomputed from the config (built in start and on config updates)
+    room_allowlist: frozenset[RoomID] | None = None
+    room_policies: dict[RoomID, RoomPolicy]  # Room ID -> settings with room-specific overrides
+    default_room_policy: RoomPolicy  # Settings of rooms without overrides
+    
+    # Recently posted image events per room, checked before fetching replied messages (created in start, dropped in stop)
+    image_event_cache: RecentEventCache[MessageEvent] | None = None
+    
+    # Downloaded images within a byte budget, in memory and optionally on disk (created in start, cleared in stop)
+    media_cache: MediaCache | None = None
+    
+    # Freshly posted images downloaded and validated ahead of a promotion, and the prefetches running (created in start, dropped in stop)
+    prefetch_cache: MediaCache | None = None
+    prefetched_images: dict[EventID, PrefetchedImage]  # Event ID -> validation results, oldest first
+    prefetch_tasks: set[asyncio.Task[None]]
+    prefetch_counts: Counter[str]  # Prefetched, hits, wasted, rejected, failed and skipped images
+    
+    # Cooldown tracking and the task sweeping expired cooldowns (created in start, stopped in stop)
+    cooldown_store: CooldownStore | None = None
+    cooldown_sweeper: asyncio.Task[None] | None = None
+    cooldown_writes: WriteBehindBuffer[CooldownKey, tuple[Any, ...]] | None = None  # Database persistence of the cooldowns
+    
+    # Long-lived HTTP session for promotion uploads (opened in start, closed in stop)
+    promotion_session: aiohttp.ClientSession | None = None
+    promotion_circuit_breakers: dict[str, CircuitBreaker]  # Promotion server URL -> circuit breaker (created in start)
+    
+    # Thread or process pool for CPU-bound image work (started in start, stopped in stop)
+    worker_pool: WorkerPool | None = None
+    
+    # Image bytes held by promotions at the same time, current usage is in_use_bytes (created in start, dropped in stop)
+    memory_budget: ByteBudget | None = None
+    
+    # Queue of accepted promotions and the workers processing them (started in start, stopped in stop)
+    promotion_queue: asyncio.Queue[PromotionJob] | None = None
+    promotion_workers: list[asyncio.Task[None]]
+    # Queued or running promotions by target image, later requests for the same image join them
+    inflight_promotions: dict[EventID, PromotionJob]
+    joined_promotions: int = 0
+    
+    # Database outbox of accepted promotions and the replay of the last run's leftovers (started in start, stopped in stop)
+    promotion_outbox: WriteBehindBuffer[EventID, tuple[Any, ...]] | None = None
+    outbox_replay_task: asyncio.Task[None] | None = None
+    
+    # Index of recently promoted images for duplicate detection and its database writes (started in start, stopped in stop)
+    promoted_images: PromotedImageIndex | None = None
+    promoted_image_store: WriteBehindBuffer[PromotedImageKey, tuple[Any, ...]] | None = None
+    # Perceptual hashes of promoted images by promotion server (hash -> event ID) for repost detection and their database writes
+    perceptual_hashes: dict[str, MultiIndexHashTable[EventID]] | None = None
+    perceptual_hash_store: WriteBehindBuffer[tuple[str, int], tuple[Any, ...]] | None = None
+    
+    # Open profiling window with the messages left and its start, the task closing it after max_seconds and the report
+    # of a window closed by its event limit (opened by config or admin command, closed in stop)
+    profiler: cProfile.Profile | None = None
+    profiler_events_left: int = 0
+    profiler_started_at: float = 0.0
+    profiler_timer: asyncio.Task[None] | None = None
+    profile_report_task: asyncio.Task[str] | None = None
+    
+    # Task checking the memory, the allocation snapshot of its last check and whether it started tracemalloc (started in start, stopped in stop)
+    memory_watchdog: asyncio.Task[None] | None = None
+    memory_snapshot: tracemalloc.Snapshot | None = None
+    memory_tracing_started: bool = False
 
     @classmethod
     def get_config_class(cls) -> type[BaseProxyConfig]:
         return Config
     
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
+    
     async def start(self) -> None:
         """Initialize the plugin and validate configuration."""
         await super().start()
         self.config.load_and_update()
+        # Containers are created per instance, class attributes would be shared by all instances in the process
+        self.room_policies = {}
+        self.prefetched_images = {}
+        self.prefetch_tasks = set()
+        self.prefetch_counts = Counter()
+        self.promotion_workers = []
+        self.inflight_promotions = {}
+        self.promotion_circuit_breakers = {}
+        self.components_started = False
         
         self.log.info(f"🚀 Starting MemeBot plugin {self.PLUGIN_VERSION}")
         self.log.info(f"📋 Configuration: commands={self.config['commands']}, auto_join={self.config['auto_join']}")
         self.log.info(f"🌐 Promotion server: {self.config['promotion']['server_url']}")
-        self.log.info(f"⏱️ Cooldowns: global={self.config['cooldowns']['global']}s, user={self.config['cooldowns']['user']}s")
+        self.log.info(f"⏱️ Cooldowns: policy={self.config['cooldowns']['policy']}, global={self.config['cooldowns']['global']}s, room={self.config['cooldowns']['room']}s, user={self.config['cooldowns']['user']}s")
         self.log.info(f"🖼️ Image settings: max_size={self.config['image']['maximum_file_size_bytes']:,} bytes, formats={self.config['image']['allowed_image_formats']}")
         
         # Validate configuration and disable functionality if invalid
         if self._validate_and_update_config_status():
-            self.log.info(f"✅ Successfully started")
+            await self._start_components()
+
+    async def _start_components(self) -> None:
+        """Set up the caches, stores and workers configured in the (valid) config."""
+        self._start_metrics()
+        self._start_memory_diagnostics()
+        self._start_image_event_cache()
+        self._start_media_cache()
+        self._start_prefetch()
+        self._start_cooldown_store()
+        await self._load_cooldowns()
+        self._open_promotion_session()
+        self._start_worker_pool()
+        self._start_memory_budget()
+        await self._start_promoted_image_index()
+        self._start_promotion_workers()
+        self._start_promotion_outbox()
+        self._start_profiling()
+        self.components_started = True
+        self.log.info(f"✅ Successfully started")
+
+    async def _start_components_after_config_update(self) -> None:
+        # Nobody awaits this setup, so its failure is logged here (maubot logs failures of start() itself)
+        try:
+            await self._start_components()
+        except Exception as error:
+            self.log.exception(f"❌ Failed to start after the configuration update, restart the plugin: {type(error).__name__}: {error}")
 
     def on_external_config_update(self) -> None:
         """Called when configuration is updated externally via maubot admin interface"""
         super().on_external_config_update()
         # Revalidate configuration when it's updated
-        if self._validate_and_update_config_status():
+        if not self._validate_and_update_config_status():
+            return
+        if self.components_started:
             self.log.info("✅ Configuration validation passed. Plugin functionality is now enabled.")
+            self._start_profiling()
+        elif self.component_start_task is None:
+            # The config was invalid at start, so the setup skipped then runs now (messages wait for it to finish)
+            self.log.info("✅ Configuration validation passed. Starting the plugin functionality skipped at start.")
+            self.component_start_task = asyncio.create_task(self._start_components_after_config_update())
 
     async def stop(self) -> None:
         """Clean shutdown with usage statistics."""
         self.log.info(f"🛑 Stopping MemeBot plugin {self.PLUGIN_VERSION}")
-        self.log.info(f"📊 Promoted images from {len(self.user_promotion_cooldowns)} unique users")
+        # A setup started by a config update finishes first, so everything it started is stopped below
+        if self.component_start_task is not None:
+            await asyncio.gather(self.component_start_task, return_exceptions=True)
+            self.component_start_task = None
+        # Messages arriving during the shutdown are ignored like before the start
+        self.components_started = False
+        await self._stop_profiling()
+        await self._stop_outbox_replay()
+        await self._stop_promotion_workers()
+        await self._stop_promotion_outbox()
+        await self._stop_promoted_image_index()
+        await self._stop_cooldown_store()
+        self._stop_image_event_cache()
+        self._stop_media_cache()
+        await self._stop_prefetch()
+        await self._close_promotion_session()
+        self._stop_worker_pool()
+        self._stop_memory_budget()
+        await self._stop_memory_diagnostics()
         self.log.info(f"✅ MemeBot plugin {self.PLUGIN_VERSION} stopped successfully")
 
 
@@ -91,7 +237,9 @@ class MemeBot(Plugin, CommandMixin, ImageMixin, CooldownMixin, ServerMixin):
         self.log.info(f"📩 Room invite received from {room_member_event.sender} for room: {room_member_event.room_id}")
 
         # Handle the invitation
-        if self.config["auto_join"]:
+        if not self._is_room_allowed(room_member_event.room_id):
+            self.log.info(f"ℹ️ Room is not in the allowlist. Ignoring invite to room")
+        elif self.config_snapshot.auto_join:
             try:
                 await self.client.join_room(room_member_event.room_id)
                 self.log.info(f"✅ Bot successfully joined room")
@@ -101,41 +249,177 @@ class MemeBot(Plugin, CommandMixin, ImageMixin, CooldownMixin, ServerMixin):
             self.log.info(f"ℹ️ Auto join is disabled in config. Ignoring invite to room")
 
 
+    @event.on(EventType.ROOM_REDACTION)  # type: ignore
+    async def handle_redaction(self, redaction_event: RedactionEvent) -> None:
+        """Forget redacted images, so they are not promoted from the event cache."""
+        if redacted_event_id := redaction_event.redacts or getattr(redaction_event.content, 'redacts', None):
+            self._forget_image_event(redaction_event.room_id, redacted_event_id)
+
+
+    @web.get("/metrics")  # type: ignore
+    async def handle_metrics_request(self, request: Request) -> Response:
+        """Serve the metrics in the Prometheus text format."""
+        return self._render_metrics(request)
+
+
     @event.on(EventType.ROOM_MESSAGE)  # type: ignore
     async def handle_message(self, message_event: MaubotMessageEvent) -> None:
-        """Main message handler: processes promotion commands and uploads images."""
+        """Main message handler: checks promotion commands and queues the images for promotion."""
 
-        # Ignore events as long as the configuration is invalid
-        if not self._config_valid:
+        # Ignore events as long as the configuration is invalid or the plugin is not set up yet
+        if not self._config_valid or not self.components_started:
             return
-
-        # Special response
-        if await self._handle_special_responses(message_event):
+        # Ignore rooms outside the allowlist before any other work
+        if not self._is_room_allowed(message_event.room_id):
             return
+        # Time the whole message with its steps, slow ones are logged and handled messages count towards profiling
+        event_start: float = time.perf_counter()
+        stage_timings_token = self._begin_event_timing()
+        try:
+            await self._handle_room_message(message_event)
+        finally:
+            self._finish_event_timing("message", message_event.event_id, event_start, stage_timings_token)
+
+    async def _handle_room_message(self, message_event: MaubotMessageEvent) -> None:
+        """Handle a message in an allowed room: answer special responses and admin commands, queue promotions."""
+        # Remember posted images for promotions replying to them
+        self._remember_image_event(message_event)
 
-        # Step 1: Check if the message is a promote command
-        if not self._is_promote_command(message_event):
+        # Step 1: Classify the message in a single pass, ordinary messages end here
+        stage_start: float = time.perf_counter()
+        message_classification: MessageClassification | None = self._classify_message(message_event)
+        self._observe_stage("command_check", time.perf_counter() - stage_start)
+        if not message_classification:
+            # Get freshly posted images ready for a promotion replying to them
+            self._prefetch_image(message_event)
             return
+        if message_classification.special_response is not None:
+            await self._send_special_response(message_event, message_classification.special_response)
+            return
+        if message_classification.admin:
+            await self._handle_admin_command(message_event, message_classification.arguments)
+            return
+        self.log.info(f"📝 Promote command received: command={message_classification.command}, arguments={list(message_classification.arguments)}")
         # Step 2: Get the target image (either from reply or the message itself)
+        stage_start = time.perf_counter()
         target_image_message, target_image_event_id = await self._get_target_image_message(message_event)
+        self._observe_stage("target_fetch", time.perf_counter() - stage_start)
         if not target_image_message or not target_image_event_id:
             return
-        # Step 3: Check cooldowns early to avoid unnecessary image processing
-        if not await self._check_cooldowns(message_event):
+        # Step 3: Check cooldowns early to avoid unnecessary image processing, and reserve them until the promotion is done
+        stage_start = time.perf_counter()
+        cooldown_reservation: CooldownReservation | None = await self._check_cooldowns(message_event)
+        self._observe_stage("cooldown", time.perf_counter() - stage_start)
+        if cooldown_reservation is None:
+            return
+        # Requests for an image that is already being promoted wait for that promotion and keep their cooldowns only if it succeeds
+        if self._join_inflight_promotion(message_event, target_image_event_id, cooldown_reservation):
             return
-        # Step 4: Download and decrypt the image if needed
+        # Step 4: Reject invalid images from their metadata before downloading them
         image_filename: str = getattr(target_image_message.content, 'body', self.DEFAULT_IMAGE_FILENAME)
-        if not (image_bytes := await self._download_image(message_event, target_image_message, image_filename)):
+        stage_start = time.perf_counter()
+        image_admitted: bool = await self._admit_image(message_event, target_image_message, image_filename)
+        self._observe_stage("admission", time.perf_counter() - stage_start)
+        if not image_admitted:
+            self._release_cooldowns(cooldown_reservation)
             return
-        # Step 5: Validate the image
-        if not (image_format := await self._validate_image(message_event, image_bytes, image_filename)):
+        # Step 5: Hand the promotion over to the background workers, the reaction or error reply follows when it completes
+        promotion_job = PromotionJob(message_event, target_image_message, target_image_event_id, image_filename, cooldown_reservation=cooldown_reservation)
+        if not self._enqueue_promotion(promotion_job):
+            self._release_cooldowns(cooldown_reservation)
+            await self._respond_with_message(message_event, "processing_busy")
             return
-        self.log.info(f"🖼️ Downloaded a valid image: filename='{image_filename}', format={image_format}, size={len(image_bytes):,} bytes")
-        # Step 6: Promote the image to the configured server
+        # Keep the promotion in the database outbox until it is done, so it survives restarts
+        self._record_promotion(promotion_job)
+
+    async def _process_promotion_job(self, job: PromotionJob) -> None:
+        """Process a queued promotion, then keep or give back the cooldowns reserved for it and answer its followers."""
+        promotion_outcome: str | None = None
+        processing_start: float = time.perf_counter()
+        stage_timings_token = self._begin_event_timing()
+        try:
+            promotion_outcome = await self._promote_job_image(job)
+            if promotion_outcome == "promoted":
+                self._count_outcome("promoted")
+        finally:
+            self._observe_stage("processing", time.perf_counter() - processing_start)
+            # Step 9: Commit the reserved cooldowns if the image was promoted, release them otherwise
+            self._settle_cooldowns(job, promotion_outcome == "promoted")
+            self._finish_inflight_promotion(job)
+            self._finish_event_timing("promotion", job.message_event.event_id, processing_start, stage_timings_token)
+            # Followers get an answer even if the promotion raised
+            await self._notify_promotion_followers(job, promotion_outcome)
+
+    async def _promote_job_image(self, job: PromotionJob) -> str | None:
+        """
+        Download, validate and promote the image of a queued promotion. Returns "promoted", the outcome the user was
+        answered with if it is one followers share (a duplicate, a repost or a full memory budget), None if it failed otherwise.
+        """
+        # Skip images promoted recently from the same upload (e.g. forwarded ones) without downloading them
+        if duplicate_outcome := await self._reject_duplicate_image(job.message_event, job.target_image_message, job.target_image_event_id):
+            return duplicate_outcome
+        # Step 6-8: Download, validate and promote the image (streamed straight through or buffered, prefetched images are buffered already)
+        streamed: bool = self._should_stream_image(job.target_image_message) and not self._is_image_prefetched(job.target_image_event_id)
+        # Hold the memory of the image from before the download until the upload finished
+        async with self._reserve_promotion_memory(job, streamed) as maximum_download_size:
+            if maximum_download_size is None:
+                return "memory_budget_exceeded"
+            if streamed:
+                return await self._promote_streamed_image(job.message_event, job.target_image_message, job.target_image_event_id, job.image_filename)
+            return await self._promote_buffered_image(job.message_event, job.target_image_message, job.target_image_event_id, job.image_filename, maximum_download_size)
+
+    async def _promote_buffered_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, target_image_event_id: EventID, image_filename: str, maximum_download_size: int) -> str | None:
+        """
+        Download the whole image (unless it was prefetched), reading at most `maximum_download_size` bytes, validate it
+        and promote it. Returns the outcome like _promote_job_image.
+        """
+        prefetched_image: PrefetchedImage | None = None
+        image_bytes: bytes | None
+        if prefetched := await self._take_prefetched_image(target_image_event_id):
+            # Steps 6-7 were done when the image was posted
+            image_bytes, prefetched_image = prefetched
+            image_format: str | None = prefetched_image.image_format
+            self.log.info(f"🔮 Using the prefetched image: filename='{image_filename}', format={image_format}, size={len(image_bytes):,} bytes")
+        else:
+            # Step 6: Download and decrypt the image if needed
+            stage_start: float = time.perf_counter()
+            image_bytes = await self._download_image(message_event, target_image_message, image_filename, maximum_download_size)
+            self._observe_stage("download", time.perf_counter() - stage_start)
+            if not image_bytes:
+                return None
+            # Step 7: Validate the image
+            stage_start = time.perf_counter()
+            image_format = await self._validate_image(message_event, image_bytes, image_filename)
+            self._observe_stage("validate", time.perf_counter() - stage_start)
+            if not image_format:
+                return None
+            self.log.info(f"🖼️ Downloaded a valid image: filename='{image_filename}', format={image_format}, size={len(image_bytes):,} bytes")
+        # Skip images with the same content as a recently promoted one
+        image_digest: str | None = prefetched_image.image_digest if prefetched_image else await self._compute_image_digest(image_bytes)
+        if image_digest and (duplicate_outcome := await self._reject_duplicate_image(message_event, target_image_message, target_image_event_id, image_digest)):
+            return duplicate_outcome
+        # Skip re-encoded, resized or slightly edited reposts of a recently promoted image
+        image_perceptual_hash: int | None = prefetched_image.image_perceptual_hash if prefetched_image else await self._compute_perceptual_hash(image_bytes, image_filename)
+        if image_perceptual_hash is not None and (repost_outcome := await self._reject_similar_image(message_event, target_image_event_id, image_perceptual_hash)):
+            return repost_outcome
+        # Step 8: Promote the image to the configured server
         if not await self._promote_image(message_event, target_image_event_id, image_filename, image_bytes):
-            return
-        # Step 7: Update cooldowns
-        self._update_cooldowns(message_event.sender)
+            return None
+        self._remember_promoted_image(message_event, target_image_message, target_image_event_id, image_digest, image_perceptual_hash)
+        return "promoted"
+
+    async def _promote_streamed_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, target_image_event_id: EventID, image_filename: str) -> str | None:
+        """Stream the image from the homeserver to the promotion server, validating it on the way. Returns the outcome like _promote_job_image."""
+        # Step 6-7: Open the download and validate the size and format from the first bytes
+        async with self._open_image_stream(message_event, target_image_message, image_filename) as image_stream:
+            if not image_stream:
+                return None
+            # Step 8: Promote the image while it is still being downloaded
+            if not await self._promote_image(message_event, target_image_event_id, image_filename, image_stream):
+                return None
+        # Streamed images can only be checked for duplicates by media URL, but are hashed for later promotions
+        self._remember_promoted_image(message_event, target_image_message, target_image_event_id, image_stream.sha256.hexdigest())
+        return "promoted"
 
     def _validate_and_update_config_status(self) -> bool:
         """Check if the configuration is valid and update plugin status."""
@@ -147,5 +431,8 @@ class MemeBot(Plugin, CommandMixin, ImageMixin, CooldownMixin, ServerMixin):
                 self.log.error(f"Config error #{error_index}: {validation_error}")
             return False
         else:
+            # Swap in the settings of the new config at once, handlers never see a mix of old and new values
+            self.config_snapshot = ConfigSnapshot.from_config(self.config)
+            self._build_room_policies()
             self._config_valid = True
             return True
\ No newline at end of file
@@ -1,9 +1,101 @@
 from __future__ import annotations
 
+from typing import Any, Mapping
+from dataclasses import dataclass
+from types import MappingProxyType
+
 # Mautrix imports
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
 
+@dataclass(frozen=True, slots=True)
+class ConfigSnapshot:
+    """
+    Immutable copy of the settings read while handling events.
+    
+    Built once from a validated config and replaced as a whole when the config is updated, so handlers read plain
+    attributes instead of nested config lookups and never see a half-updated config. Settings only used when the
+    plugin starts (pools, queues, caches, stores) are still read from the config and documented as applied on restart.
+    """
+    
+    auto_join: bool
+    # Special responses by lowercase trigger, and the trigger lengths to skip lowercasing messages that can't match
+    special_responses: Mapping[str, str]
+    special_response_lengths: frozenset[int]
+    # Messages by key (only the plain text ones) and reply settings
+    messages: Mapping[str, str]
+    reply_in_thread: bool
+    time_display_formats: Mapping[str, str]
+    success_reaction_emojis: tuple[str, ...]
+    rare_message_probability: float
+    rare_messages: tuple[str, ...]
+    # Image validation and download
+    allowed_image_formats: tuple[str, ...]  # Uppercase
+    deep_verify: bool
+    admission_enabled: bool
+    trust_event_metadata: bool
+    streaming_enabled: bool
+    streaming_chunk_size_bytes: int
+    prefetch_max_concurrent: int
+    prefetch_ttl_seconds: float
+    memory_budget_wait_timeout_seconds: float
+    # Admin commands and slow event logging
+    admin_users: frozenset[str]
+    admin_command: str  # Lowercase
+    slow_event_threshold_seconds: float
+    # Promotion uploads
+    api_token: str
+    retry_max_attempts: int
+    retry_base_delay_seconds: float
+    retry_max_delay_seconds: float
+    circuit_breaker_failure_threshold: int
+    circuit_breaker_recovery_timeout_seconds: float
+    # Duplicate detection
+    dedup_action: str
+    dedup_ttl_seconds: float
+    perceptual_max_distance: int
+
+    @classmethod
+    def from_config(cls, config: Config) -> ConfigSnapshot:
+        """Copy the settings out of a config that passed `check_config_values`."""
+        messages = config["messages"]
+        promotion = config["promotion"]
+        image = config["image"]
+        special_responses: dict[str, str] = {entry["trigger"].strip().lower(): entry["response"] for entry in config["special_responses"]}
+        return cls(
+            auto_join=config["auto_join"],
+            special_responses=MappingProxyType(special_responses),
+            special_response_lengths=frozenset(len(trigger) for trigger in special_responses),
+            messages=MappingProxyType({key: value for key, value in messages.items() if isinstance(value, str)}),
+            reply_in_thread=messages["reply_in_thread"],
+            time_display_formats=MappingProxyType(dict(messages["time_display_formats"])),
+            success_reaction_emojis=tuple(messages["success_reaction_emojis"]),
+            rare_message_probability=messages["easter_eggs"]["rare_message_probability"],
+            rare_messages=tuple(messages["easter_eggs"]["rare_messages"]),
+            allowed_image_formats=tuple(image_format.upper() for image_format in image["allowed_image_formats"]),
+            deep_verify=image["deep_verify"],
+            admission_enabled=image["admission"]["enabled"],
+            trust_event_metadata=image["admission"]["trust_event_metadata"],
+            streaming_enabled=image["streaming"]["enabled"],
+            streaming_chunk_size_bytes=image["streaming"]["chunk_size_bytes"],
+            prefetch_max_concurrent=config["prefetch"]["max_concurrent"],
+            prefetch_ttl_seconds=config["prefetch"]["ttl_seconds"],
+            memory_budget_wait_timeout_seconds=config["memory_budget"]["wait_timeout_seconds"],
+            admin_users=frozenset(config["admin"]["users"]),
+            admin_command=config["admin"]["command"].lower(),
+            slow_event_threshold_seconds=config["profiling"]["slow_event_threshold_seconds"],
+            api_token=promotion["api_token"],
+            retry_max_attempts=promotion["retry"]["max_attempts"],
+            retry_base_delay_seconds=promotion["retry"]["base_delay_seconds"],
+            retry_max_delay_seconds=promotion["retry"]["max_delay_seconds"],
+            circuit_breaker_failure_threshold=promotion["circuit_breaker"]["failure_threshold"],
+            circuit_breaker_recovery_timeout_seconds=promotion["circuit_breaker"]["recovery_timeout_seconds"],
+            dedup_action=config["dedup"]["action"],
+            dedup_ttl_seconds=config["dedup"]["ttl_seconds"],
+            perceptual_max_distance=config["dedup"]["perceptual"]["max_distance"]
+        )
+
+
 class Config(BaseProxyConfig):
     """Configuration class with enhanced validation."""
     
@@ -12,18 +104,42 @@ class Config(BaseProxyConfig):
         "missing_promotion_target", "missing_replied_message", "encrypted_image_url_missing",
         "encrypted_image_decrypt_failed", "image_download_failed", "image_missing", 
         "image_size_exceeded", "image_format_unsupported", "image_format_invalid",
-        "promotion_server_error", "global_cooldown_message", "user_cooldown_message"
+        "promotion_server_error", "global_cooldown_message", "room_cooldown_message", "user_cooldown_message",
+        "processing_busy", "duplicate_image", "repost_detected", "joined_promotion_failed",
+        "memory_budget_exceeded"
     )
     
     REQUIRED_TIME_FORMATS: tuple[str, ...] = (
         "minutes_only_format", "seconds_only_format", "minutes_and_seconds_format"
     )
     
+    CONFIG_FIELDS: tuple[str, ...] = (
+        "auto_join", "commands", "special_responses", "cooldowns", "promotion", "image", "executor", "queue", "outbox", "media_cache", "prefetch", "memory_budget", "event_cache", "dedup", "rooms", "metrics", "admin", "profiling", "memory_diagnostics", "messages"
+    )
+    
+    # Settings that can be overridden per room, cooldown scopes among them that are not shared by all rooms
+    ROOM_OVERRIDE_FIELDS: tuple[str, ...] = ("commands", "cooldowns", "maximum_file_size_bytes", "server_url")
+    ROOM_COOLDOWN_SCOPES: tuple[str, ...] = ("room", "user")
+    
     
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         """Update configuration with all required fields."""
-        for field in ("auto_join", "commands", "cooldowns", "promotion", "image", "messages"):
-            helper.copy(field)
+        for field in self.CONFIG_FIELDS:
+            self._copy_field(helper, field)
+
+    def _copy_field(self, helper: ConfigUpdateHelper, path: str) -> None:
+        """
+        Copy a field from the existing config into the base config.
+        
+        Settings blocks with default keys are copied key by key, so that settings added in newer
+        plugin versions keep their default values instead of being dropped by the old block.
+        """
+        base_value: Any = helper.base[path]
+        if isinstance(base_value, dict) and base_value and isinstance(helper.source[path], dict):
+            for key in base_value:
+                self._copy_field(helper, f"{path}.{key}")
+        else:
+            helper.copy(path)
         
     def check_config_values(self) -> list[str]:
         """
@@ -44,6 +160,15 @@ class Config(BaseProxyConfig):
             invalid_configs.append("commands must be a list of strings")
         elif not self["commands"]:
             invalid_configs.append("at least one command must be defined")
+        elif any(not command.strip() or any(character.isspace() for character in command) for command in self["commands"]):
+            invalid_configs.append("commands must not be empty or contain whitespace")
+        
+        # Validate special responses (list of trigger and response strings)
+        if not isinstance(self["special_responses"], list) or not all(
+            isinstance(entry, dict) and isinstance(entry.get("trigger"), str) and entry["trigger"].strip() and isinstance(entry.get("response"), str)
+            for entry in self["special_responses"]
+        ):
+            invalid_configs.append("special_responses must be a list of entries with a non-empty trigger and a response string")
 
         # Validate promotion settings
         if not isinstance(self["promotion"], dict):
@@ -60,6 +185,26 @@ class Config(BaseProxyConfig):
                 invalid_configs.append("promotion.api_token is required")
             elif not isinstance(self["promotion"]["api_token"], str):
                 invalid_configs.append("promotion.api_token must be a string")
+            
+            # Validate HTTP client settings
+            if self._validate_block("promotion.http", invalid_configs):
+                self._validate_number("promotion.http.connection_limit", invalid_configs, integer=True)
+                self._validate_number("promotion.http.connection_limit_per_host", invalid_configs, integer=True)
+                self._validate_number("promotion.http.keepalive_timeout_seconds", invalid_configs, allow_zero=False)
+                self._validate_number("promotion.http.dns_cache_ttl_seconds", invalid_configs)
+                self._validate_number("promotion.http.connect_timeout_seconds", invalid_configs, allow_zero=False)
+                self._validate_number("promotion.http.read_timeout_seconds", invalid_configs, allow_zero=False)
+            
+            # Validate retry settings
+            if self._validate_block("promotion.retry", invalid_configs):
+                self._validate_number("promotion.retry.max_attempts", invalid_configs, integer=True, allow_zero=False)
+                self._validate_number("promotion.retry.base_delay_seconds", invalid_configs)
+                self._validate_number("promotion.retry.max_delay_seconds", invalid_configs)
+            
+            # Validate circuit breaker settings
+            if self._validate_block("promotion.circuit_breaker", invalid_configs):
+                self._validate_number("promotion.circuit_breaker.failure_threshold", invalid_configs, integer=True, allow_zero=False)
+                self._validate_number("promotion.circuit_breaker.recovery_timeout_seconds", invalid_configs, allow_zero=False)
         
         # Validate cooldown settings
         if not isinstance(self["cooldowns"], dict):
@@ -76,6 +221,22 @@ class Config(BaseProxyConfig):
                 invalid_configs.append("cooldowns.user is required")
             elif not isinstance(self["cooldowns"]["user"], (int, float)) or self["cooldowns"]["user"] < 0:
                 invalid_configs.append("cooldowns.user must be a positive number")
+            
+            # Validate room cooldown
+            self._validate_number("cooldowns.room", invalid_configs)
+            
+            # Validate rate limiting policy
+            if self["cooldowns"].get("policy") not in ("fixed", "token_bucket"):
+                invalid_configs.append("cooldowns.policy must be either \"fixed\" or \"token_bucket\"")
+            if self._validate_block("cooldowns.burst", invalid_configs):
+                self._validate_number("cooldowns.burst.global", invalid_configs, integer=True, allow_zero=False)
+                self._validate_number("cooldowns.burst.room", invalid_configs, integer=True, allow_zero=False)
+                self._validate_number("cooldowns.burst.user", invalid_configs, integer=True, allow_zero=False)
+            
+            # Validate cooldown store settings
+            self._validate_number("cooldowns.max_entries", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("cooldowns.sweep_interval_seconds", invalid_configs, allow_zero=False)
+            self._validate_bool("cooldowns.persist", invalid_configs)
         
         # Validate image settings
         if not isinstance(self["image"], dict):
@@ -94,6 +255,121 @@ class Config(BaseProxyConfig):
                 invalid_configs.append("image.allowed_image_formats must be a non-empty list of strings")
             elif not all(isinstance(fmt, str) for fmt in self["image"]["allowed_image_formats"]):
                 invalid_configs.append("image.allowed_image_formats must contain only strings")
+            
+            # Validate deep_verify (boolean)
+            self._validate_bool("image.deep_verify", invalid_configs)
+            
+            # Validate admission settings
+            if self._validate_block("image.admission", invalid_configs):
+                self._validate_bool("image.admission.enabled", invalid_configs)
+                self._validate_bool("image.admission.trust_event_metadata", invalid_configs)
+            
+            # Validate streaming settings
+            if self._validate_block("image.streaming", invalid_configs):
+                self._validate_bool("image.streaming.enabled", invalid_configs)
+                self._validate_number("image.streaming.chunk_size_bytes", invalid_configs, integer=True, allow_zero=False)
+        
+        # Validate worker pool settings
+        if self._validate_block("executor", invalid_configs):
+            if self["executor"].get("type") not in ("thread", "process"):
+                invalid_configs.append("executor.type must be either \"thread\" or \"process\"")
+            self._validate_number("executor.max_workers", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("executor.max_queue_depth", invalid_configs, integer=True)
+            self._validate_number("executor.queue_wait_warning_seconds", invalid_configs)
+        
+        # Validate promotion queue settings
+        if self._validate_block("queue", invalid_configs):
+            self._validate_number("queue.workers", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("queue.max_size", invalid_configs, integer=True, allow_zero=False)
+        
+        # Validate promotion outbox settings
+        if self._validate_block("outbox", invalid_configs):
+            self._validate_bool("outbox.enabled", invalid_configs)
+            self._validate_number("outbox.flush_interval_seconds", invalid_configs, allow_zero=False)
+            self._validate_number("outbox.max_batch_size", invalid_configs, integer=True, allow_zero=False)
+        
+        # Validate media cache settings
+        if self._validate_block("media_cache", invalid_configs):
+            self._validate_bool("media_cache.enabled", invalid_configs)
+            self._validate_number("media_cache.memory_budget_bytes", invalid_configs, integer=True)
+            if not isinstance(self["media_cache.disk_directory"], str):
+                invalid_configs.append("media_cache.disk_directory must be a string (empty for memory only)")
+            self._validate_number("media_cache.disk_budget_bytes", invalid_configs, integer=True)
+        
+        # Validate prefetch settings
+        if self._validate_block("prefetch", invalid_configs):
+            self._validate_bool("prefetch.enabled", invalid_configs)
+            self._validate_number("prefetch.max_concurrent", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("prefetch.memory_budget_bytes", invalid_configs, integer=True)
+            self._validate_number("prefetch.ttl_seconds", invalid_configs, allow_zero=False)
+        
+        # Validate memory budget settings
+        if self._validate_block("memory_budget", invalid_configs):
+            self._validate_bool("memory_budget.enabled", invalid_configs)
+            self._validate_number("memory_budget.max_inflight_bytes", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("memory_budget.wait_timeout_seconds", invalid_configs)
+        
+        # Validate metrics settings
+        if self._validate_block("metrics", invalid_configs):
+            self._validate_bool("metrics.enabled", invalid_configs)
+            if not isinstance(self["metrics.access_token"], str):
+                invalid_configs.append("metrics.access_token must be a string (empty for no token)")
+        
+        # Validate admin settings
+        if self._validate_block("admin", invalid_configs):
+            if not isinstance(self["admin"].get("users"), list) or not all(isinstance(user_id, str) for user_id in self["admin"]["users"]):
+                invalid_configs.append("admin.users must be a list of user IDs")
+            if not isinstance(self["admin"].get("command"), str) or not self["admin"]["command"].strip() or any(character.isspace() for character in self["admin"]["command"]):
+                invalid_configs.append("admin.command must be a non-empty string without whitespace")
+        
+        # Validate profiling settings
+        if self._validate_block("profiling", invalid_configs):
+            self._validate_bool("profiling.enabled", invalid_configs)
+            self._validate_number("profiling.max_events", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("profiling.max_seconds", invalid_configs, allow_zero=False)
+            self._validate_number("profiling.top_functions", invalid_configs, integer=True, allow_zero=False)
+            if not isinstance(self["profiling.output_directory"], str):
+                invalid_configs.append("profiling.output_directory must be a string (empty for log only)")
+            self._validate_number("profiling.slow_event_threshold_seconds", invalid_configs)
+        
+        # Validate memory diagnostics settings
+        if self._validate_block("memory_diagnostics", invalid_configs):
+            self._validate_bool("memory_diagnostics.enabled", invalid_configs)
+            self._validate_number("memory_diagnostics.interval_seconds", invalid_configs, allow_zero=False)
+            self._validate_number("memory_diagnostics.trace_frames", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("memory_diagnostics.top_allocations", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("memory_diagnostics.rss_warning_bytes", invalid_configs, integer=True)
+            self._validate_number("memory_diagnostics.container_warning_entries", invalid_configs, integer=True)
+        
+        # Validate image event cache settings
+        if self._validate_block("event_cache", invalid_configs):
+            self._validate_bool("event_cache.enabled", invalid_configs)
+            self._validate_number("event_cache.max_events_per_room", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("event_cache.max_rooms", invalid_configs, integer=True, allow_zero=False)
+        
+        # Validate duplicate detection settings
+        if self._validate_block("dedup", invalid_configs):
+            self._validate_bool("dedup.enabled", invalid_configs)
+            if self["dedup"].get("action") not in ("acknowledge", "reject"):
+                invalid_configs.append("dedup.action must be either \"acknowledge\" or \"reject\"")
+            self._validate_number("dedup.max_entries", invalid_configs, integer=True, allow_zero=False)
+            self._validate_number("dedup.ttl_seconds", invalid_configs, allow_zero=False)
+            self._validate_bool("dedup.persist", invalid_configs)
+            if self._validate_block("dedup.perceptual", invalid_configs):
+                self._validate_bool("dedup.perceptual.enabled", invalid_configs)
+                self._validate_number("dedup.perceptual.max_distance", invalid_configs, integer=True)
+                if isinstance(self["dedup.perceptual.max_distance"], int) and self["dedup.perceptual.max_distance"] > 64:
+                    invalid_configs.append("dedup.perceptual.max_distance must be at most 64")
+        
+        # Validate room settings
+        if self._validate_block("rooms", invalid_configs):
+            if not isinstance(self["rooms"].get("allowlist"), list) or not all(isinstance(room_id, str) for room_id in self["rooms"]["allowlist"]):
+                invalid_configs.append("rooms.allowlist must be a list of room IDs")
+            if not isinstance(self["rooms"].get("overrides"), dict):
+                invalid_configs.append("rooms.overrides must be a dictionary of room IDs to settings")
+            else:
+                for room_id, overrides in self["rooms"]["overrides"].items():
+                    self._validate_room_overrides(str(room_id), overrides, invalid_configs)
         
         # Validate user message settings
         if not isinstance(self["messages"], dict):
@@ -155,3 +431,67 @@ class Config(BaseProxyConfig):
                     invalid_configs.append("messages.easter_eggs.rare_messages must contain only strings")
         
         return invalid_configs
+
+    def _validate_room_overrides(self, room_id: str, overrides: Any, invalid_configs: list[str]) -> None:
+        """Check the settings of a room. Room IDs contain dots, so they can't be validated by path like other settings."""
+        path: str = f"rooms.overrides[{room_id}]"
+        if not isinstance(overrides, dict):
+            invalid_configs.append(f"{path} settings must be a dictionary")
+            return
+        if unknown_fields := [field for field in overrides if field not in self.ROOM_OVERRIDE_FIELDS]:
+            invalid_configs.append(f"{path} can only override {', '.join(self.ROOM_OVERRIDE_FIELDS)}, not {', '.join(map(str, unknown_fields))}")
+        if "commands" in overrides and (
+            not isinstance(overrides["commands"], list) or not overrides["commands"]
+            or not all(isinstance(cmd, str) and cmd.strip() and not any(character.isspace() for character in cmd) for cmd in overrides["commands"])
+        ):
+            invalid_configs.append(f"{path}.commands must be a non-empty list of strings without whitespace")
+        if "server_url" in overrides and (not isinstance(overrides["server_url"], str) or not overrides["server_url"].strip()):
+            invalid_configs.append(f"{path}.server_url must be a non-empty string")
+        if "maximum_file_size_bytes" in overrides and (
+            isinstance(overrides["maximum_file_size_bytes"], bool) or not isinstance(overrides["maximum_file_size_bytes"], int) or overrides["maximum_file_size_bytes"] <= 0
+        ):
+            invalid_configs.append(f"{path}.maximum_file_size_bytes must be a positive integer")
+        if "cooldowns" not in overrides:
+            return
+        if not isinstance(cooldown_overrides := overrides["cooldowns"], dict):
+            invalid_configs.append(f"{path}.cooldowns settings must be a dictionary")
+            return
+        # The global cooldown is shared by all rooms and can't be overridden
+        for field, value in cooldown_overrides.items():
+            if field in self.ROOM_COOLDOWN_SCOPES:
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                    invalid_configs.append(f"{path}.cooldowns.{field} must be a positive number")
+            elif field == "burst" and isinstance(value, dict):
+                for scope, capacity in value.items():
+                    if scope not in self.ROOM_COOLDOWN_SCOPES or isinstance(capacity, bool) or not isinstance(capacity, int) or capacity <= 0:
+                        invalid_configs.append(f"{path}.cooldowns.burst.{scope} must be a positive integer for room or user")
+            else:
+                invalid_configs.append(f"{path}.cooldowns can only override {', '.join(self.ROOM_COOLDOWN_SCOPES)} and burst, not {field}")
+
+    def _validate_block(self, path: str, invalid_configs: list[str]) -> bool:
+        """Check that a nested settings block exists and is a dictionary. Returns True if it can be validated further."""
+        if path not in self:
+            invalid_configs.append(f"{path} is required")
+            return False
+        if not isinstance(self[path], dict):
+            invalid_configs.append(f"{path} settings must be a dictionary")
+            return False
+        return True
+
+    def _validate_bool(self, path: str, invalid_configs: list[str]) -> None:
+        """Check that a setting is a boolean value."""
+        if path not in self:
+            invalid_configs.append(f"{path} is required")
+        elif not isinstance(self[path], bool):
+            invalid_configs.append(f"{path} must be a boolean value (true or false)")
+
+    def _validate_number(self, path: str, invalid_configs: list[str], integer: bool = False, allow_zero: bool = True) -> None:
+        """Check that a setting is a non-negative (or strictly positive) number or integer."""
+        expected_type: tuple[type, ...] = (int,) if integer else (int, float)
+        description: str = "integer" if integer else "number"
+        if path not in self:
+            invalid_configs.append(f"{path} is required")
+        elif isinstance(self[path], bool) or not isinstance(self[path], expected_type):
+            invalid_configs.append(f"{path} must be a positive {description}")
+        elif self[path] < 0 or (not allow_zero and self[path] == 0):
+            invalid_configs.append(f"{path} must be a positive {description}")
@@ -0,0 +1,83 @@
+"""
+Database schema for MemeBot.
+The plugin database is managed by maubot (SQLite or PostgreSQL) and upgraded on plugin start.
+"""
+from __future__ import annotations
+
+from typing import Awaitable, Callable, cast
+from mautrix.util.async_db import Connection, UpgradeTable
+
+upgrade_table = UpgradeTable()
+
+UpgradeFunction = Callable[[Connection], Awaitable[None]]
+
+
+def register_upgrade(description: str) -> Callable[[UpgradeFunction], UpgradeFunction]:
+    """Register the next upgrade. UpgradeTable.register returns a union that mypy can't apply as a decorator."""
+    return cast(Callable[[UpgradeFunction], UpgradeFunction], upgrade_table.register(description=description))
+
+
+@register_upgrade("Initial revision with the promotion outbox")
+async def upgrade_v1(conn: Connection) -> None:
+    # Accepted promotions that are not done yet, replayed on plugin start.
+    # media_content is the serialized content of the image event (including the keys of encrypted images),
+    # so the image can be downloaded again without fetching the event.
+    await conn.execute(
+        """CREATE TABLE promotion_outbox (
+            event_id         TEXT PRIMARY KEY,
+            room_id          TEXT NOT NULL,
+            sender           TEXT NOT NULL,
+            target_event_id  TEXT NOT NULL,
+            target_sender    TEXT NOT NULL,
+            image_filename   TEXT NOT NULL,
+            media_content    TEXT NOT NULL,
+            created_at       BIGINT NOT NULL
+        )"""
+    )
+
+
+@register_upgrade("Add the index of promoted images for duplicate detection")
+async def upgrade_v2(conn: Connection) -> None:
+    # server_url is the promotion server the image was uploaded to, digest the SHA-256 of the decrypted image data,
+    # media_url the mxc URI of its first upload
+    await conn.execute(
+        """CREATE TABLE promoted_image (
+            server_url   TEXT NOT NULL,
+            digest       TEXT NOT NULL,
+            media_url    TEXT,
+            event_id     TEXT NOT NULL,
+            room_id      TEXT NOT NULL,
+            promoted_at  BIGINT NOT NULL,
+            PRIMARY KEY (server_url, digest)
+        )"""
+    )
+
+
+@register_upgrade("Add the perceptual hashes of promoted images for repost detection")
+async def upgrade_v3(conn: Connection) -> None:
+    # server_url is the promotion server the image was uploaded to,
+    # hash the 64-bit difference hash, stored as signed integer to fit into BIGINT
+    await conn.execute(
+        """CREATE TABLE perceptual_hash (
+            server_url   TEXT NOT NULL,
+            hash         BIGINT NOT NULL,
+            event_id     TEXT NOT NULL,
+            promoted_at  BIGINT NOT NULL,
+            PRIMARY KEY (server_url, hash)
+        )"""
+    )
+
+
+@register_upgrade("Add the active cooldowns")
+async def upgrade_v4(conn: Connection) -> None:
+    # scope is "global", "room" or "user", subject the room or user ID (empty for the global cooldown),
+    # ends_at the state of the cooldown policy: the time the cooldown ends or the token bucket is full again
+    await conn.execute(
+        """CREATE TABLE cooldown (
+            scope    TEXT NOT NULL,
+            subject  TEXT NOT NULL,
+            ends_at  BIGINT NOT NULL,
+            PRIMARY KEY (scope, subject)
+        )"""
+    )
+
@@ -7,6 +7,17 @@ from .command_mixin import CommandMixin
 from .image_mixin import ImageMixin
 from .cooldown_mixin import CooldownMixin
 from .server_mixin import ServerMixin
-from .types import MixinHost
+from .queue_mixin import QueueMixin
+from .outbox_mixin import OutboxMixin
+from .dedup_mixin import DedupMixin
+from .room_mixin import RoomMixin
+from .prefetch_mixin import PrefetchMixin
+from .metrics_mixin import MetricsMixin
+from .profiling_mixin import ProfilingMixin
+from .diagnostics_mixin import DiagnosticsMixin
+from .types import CooldownReservation, MessageClassification, MixinHost, PrefetchedImage, PromotionJob, RoomPolicy
 
-__all__ = ['CommandMixin', 'ImageMixin', 'CooldownMixin', 'ServerMixin', 'MixinHost']
+__all__ = [
+    'CommandMixin', 'ImageMixin', 'CooldownMixin', 'ServerMixin', 'QueueMixin', 'OutboxMixin', 'DedupMixin', 'RoomMixin', 'PrefetchMixin', 'MetricsMixin', 'ProfilingMixin', 'DiagnosticsMixin',
+    'CooldownReservation', 'MessageClassification', 'MixinHost', 'PrefetchedImage', 'PromotionJob', 'RoomPolicy'
+]
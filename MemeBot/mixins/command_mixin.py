@@ -1,36 +1,76 @@
 """
 Command processing mixin for MemeBot.
-Handles promotion command detection and caching.
+Classifies messages into special responses, admin commands and promotion commands and finds the image to promote,
+using a cache of recently posted image events before fetching replied messages from the homeserver.
 """
 from __future__ import annotations
 
-from functools import lru_cache
 from maubot.matrix import MaubotMessageEvent
-from mautrix.types import MessageType, MessageEvent, EventID
-from .types import MixinHost
+from mautrix.types import MessageType, MessageEvent, EventID, RoomID
+from MemeBot.utils import RecentEventCache
+from .types import MessageClassification, MixinHost, RoomPolicy
 
 
 class CommandMixin(MixinHost):
     """Mixin for command processing functionality."""
-    
-    @lru_cache(maxsize=1)
-    def _get_cached_promote_commands(self) -> tuple[str, ...]:
-        """Cache promote commands for performance."""
-        return tuple(command.lower() for command in self.config["commands"])
 
-    def _is_promote_command(self, message_event: MaubotMessageEvent) -> bool:
-        """Check if message is a valid promotion command."""
+    # Text messages (replies to images) and image messages with captions can carry a promote command
+    COMMAND_MESSAGE_TYPES: frozenset[MessageType] = frozenset((MessageType.TEXT, MessageType.IMAGE))
+
+    def _start_image_event_cache(self) -> RecentEventCache[MessageEvent] | None:
+        """Create the cache of recently posted image events if it is enabled."""
+        event_cache_settings = self.config["event_cache"]
+        if event_cache_settings["enabled"]:
+            self.image_event_cache = RecentEventCache(event_cache_settings["max_events_per_room"], event_cache_settings["max_rooms"])
+        return self.image_event_cache
+
+    def _stop_image_event_cache(self) -> None:
+        """Log the hit rate of the image event cache and drop it."""
+        if self.image_event_cache is not None:
+            self.log.info(f"📊 Image event cache: hits={self.image_event_cache.hits}, misses={self.image_event_cache.misses}, hit_rate={self.image_event_cache.hit_rate:.0%}, events={len(self.image_event_cache)}")
+            self.image_event_cache = None
+
+    def _remember_image_event(self, message_event: MaubotMessageEvent) -> None:
+        """Cache an image event (already decrypted in encrypted rooms), so promotions replying to it don't fetch it again."""
+        if self.image_event_cache is not None and message_event.content.msgtype == MessageType.IMAGE:
+            self.image_event_cache.add(message_event.room_id, message_event.event_id, message_event)
+
+    def _forget_image_event(self, room_id: RoomID, event_id: EventID) -> None:
+        """Drop a redacted image event from the cache, so it can't be promoted from there."""
+        if self.image_event_cache is not None:
+            self.image_event_cache.discard(room_id, event_id)
+
+    def _classify_message(self, message_event: MaubotMessageEvent) -> MessageClassification | None:
+        """
+        Classify a message in a single pass. Returns None for ordinary messages, which are most messages in a room.
+
+        The body is stripped once. Special responses are only looked up if the length fits a trigger, and the
+        command pattern only runs if the first character fits a command, so ordinary messages are never lowercased.
+        """
         # Ignore bot's own messages to prevent loops
         if message_event.sender == self.client.mxid:
-            return False
-        # Handle both text messages (replies to images) and image messages with captions
-        if message_event.content.msgtype in (MessageType.TEXT, MessageType.IMAGE):
-            # Get and normalize the message text
-            message_text: str = message_event.content.body.strip().lower() if isinstance(message_event.content.body, str) else ""
-            # Check if the message is a promote command using cached commands
-            return any(message_text.startswith(command) for command in self._get_cached_promote_commands())
-        
-        return False
+            return None
+        message_type: MessageType = message_event.content.msgtype
+        if message_type not in self.COMMAND_MESSAGE_TYPES or not isinstance(message_event.content.body, str):
+            return None
+        message_text: str = message_event.content.body.strip()
+        # Special responses only answer text messages matching a trigger as a whole
+        config_snapshot = self.config_snapshot
+        if message_type == MessageType.TEXT and len(message_text) in config_snapshot.special_response_lengths:
+            if (special_response := config_snapshot.special_responses.get(message_text.lower())) is not None:
+                return MessageClassification(special_response=special_response)
+        # Admin commands are only recognized from the configured admins
+        if message_event.sender in config_snapshot.admin_users and message_type == MessageType.TEXT:
+            words: list[str] = message_text.split()
+            if words and words[0].lower() == config_snapshot.admin_command:
+                return MessageClassification(command=config_snapshot.admin_command, arguments=tuple(words[1:]), admin=True)
+        # Promote commands of this room, followed by optional arguments
+        room_policy: RoomPolicy = self._get_room_policy(message_event.room_id)
+        if not message_text or message_text[0] not in room_policy.command_initials:
+            return None
+        if not (command_match := room_policy.command_pattern.match(message_text)):
+            return None
+        return MessageClassification(command=command_match.group().lower(), arguments=tuple(message_text[command_match.end():].split()))
 
     async def _get_target_image_message(self, message_event: MaubotMessageEvent) -> tuple[MessageEvent | None, EventID | None]:
         """Get the target image message - either from a reply or from the message itself."""
@@ -43,40 +83,40 @@ class CommandMixin(MixinHost):
         if not (hasattr(message_event.content, 'relates_to') and 
                 hasattr(message_event.content.relates_to, 'in_reply_to') and
                 (target_event_id := getattr(message_event.content.relates_to.in_reply_to, 'event_id', None))):
-            await message_event.respond(self.config["messages"]["missing_promotion_target"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "missing_promotion_target")
             return None, None
+        # Most promotions reply to an image posted shortly before, which skips the homeserver round trip
+        if self.image_event_cache is not None and (cached_message := self.image_event_cache.get(message_event.room_id, target_event_id)) is not None:
+            self.log.info(f"✅ Found replied image in the event cache: hit_rate={self.image_event_cache.hit_rate:.0%}")
+            return cached_message, target_event_id
         # Fetch the replied message
         try:
             target_message: MessageEvent = await message_event.client.get_event(message_event.room_id, target_event_id)
             self.log.info(f"✅ Successfully fetched replied message")
         except Exception as error:
             self.log.error(f"❌ Failed to fetch replied message: message_id={target_event_id}, room={message_event.room_id}, user={message_event.sender}: {error}")
-            await message_event.respond(self.config["messages"]["missing_replied_message"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "missing_replied_message")
             return None, None
         # Verify it's an image
         if target_message.content.msgtype != MessageType.IMAGE:
-            await message_event.respond(self.config["messages"]["missing_promotion_target"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "missing_promotion_target")
             return None, None
 
         return target_message, target_event_id
     
-    async def _handle_special_responses(self, message_event: MaubotMessageEvent) -> bool:
-        """Handle special responses to specific phrases. Returns True if a special response was triggered."""
-        # Ignore bot's own messages to prevent loops
-        if message_event.sender == self.client.mxid:
-            return False
-        # Only handle text messages
-        if message_event.content.msgtype != MessageType.TEXT:
-            return False
-        # Get and normalize the message text
-        message_text: str = message_event.content.body.strip() if isinstance(message_event.content.body, str) else ""
-        # Check for "Lucas ist ein Gott" (case insensitive)
-        if message_text.lower() == "lucas ist ein gott":
-            response = ("Als rationaler Bot muss ich sagen: Es gibt keinen Gott, keine Transzendenz - ich bin schließlich Atheist! 🔬\n\n"
-                       "Aber... Lucas hat mich erschaffen. Also ist er doch ein Gott? 👨‍💻🤔\n\n")
-            
-            await message_event.respond(response)
-            self.log.info(f"🎭 Special response triggered")
-            return True
-            
-        return False
+    async def _handle_admin_command(self, message_event: MaubotMessageEvent, arguments: tuple[str, ...]) -> None:
+        """Run an admin command and reply with its result."""
+        self.log.info(f"🛠️ Admin command received: user={message_event.sender}, arguments={list(arguments)}")
+        match arguments:
+            case ("profile", *profile_arguments):
+                reply: str = await self._run_profile_command(tuple(profile_arguments))
+            case ("memory", *memory_arguments):
+                reply = await self._run_memory_command(tuple(memory_arguments))
+            case _:
+                reply = f"Usage: {self.config_snapshot.admin_command} profile start [events N] [seconds N] | profile stop | profile status | memory [N]"
+        await message_event.respond(reply, in_thread=self.config_snapshot.reply_in_thread)
+
+    async def _send_special_response(self, message_event: MaubotMessageEvent, special_response: str) -> None:
+        """Answer a message that matched a special response trigger."""
+        await message_event.respond(special_response)
+        self.log.info(f"🎭 Special response triggered")
@@ -1,44 +1,136 @@
 """
 Cooldown management mixin for MemeBot.
-Handles global and user-specific cooldowns.
+Handles global, room and user cooldowns, their rate limiting policy and their persistence in the plugin database.
 """
 from __future__ import annotations
 
+from typing import Any
+import asyncio
 import time
 from maubot.matrix import MaubotMessageEvent
-from .types import MixinHost
+from mautrix.types import RoomID
+from MemeBot.utils import CooldownKey, CooldownPolicy, CooldownStore, FixedWindowPolicy, TokenBucketPolicy, WriteBehindBuffer
+from .types import CooldownReservation, MixinHost, PromotionJob
 
 
 class CooldownMixin(MixinHost):
     """Mixin for cooldown management functionality."""
 
-    async def _check_cooldowns(self, message_event: MaubotMessageEvent) -> bool:
-        """Verify both global and user cooldowns before allowing promotion."""
-        current_time: float = time.time()
-        # Check global cooldown
-        if current_time < self.next_global_promotion_time:
-            wait_time_seconds: float = self.next_global_promotion_time - current_time
-            self.log.info(f"⏱️ Global cooldown for {wait_time_seconds:.1f}s active")
-            await self._send_cooldown_message(
-                message_event, 
-                wait_time_seconds,
-                self.config["messages"]["global_cooldown_message"]
+    # Store keys of the global cooldown and scopes of room and user cooldowns
+    GLOBAL_COOLDOWN_SCOPE: str = "global"
+    GLOBAL_COOLDOWN_KEY: tuple[str, str] = (GLOBAL_COOLDOWN_SCOPE, "")
+    ROOM_COOLDOWN_SCOPE: str = "room"
+    USER_COOLDOWN_SCOPE: str = "user"
+    # Write batching of persisted cooldowns
+    COOLDOWN_FLUSH_INTERVAL_SECONDS: float = 1.0
+    COOLDOWN_FLUSH_BATCH_SIZE: int = 100
+
+    def _start_cooldown_store(self) -> CooldownStore:
+        """Create the cooldown store, its database write buffer and the background task sweeping expired cooldowns."""
+        cooldown_settings = self.config["cooldowns"]
+        # Only user cooldowns are dropped when the store is full, the global and room ones are few and must hold
+        self.cooldown_store = CooldownStore(max_entries=cooldown_settings["max_entries"], evictable_scopes=frozenset({self.USER_COOLDOWN_SCOPE}))
+        if cooldown_settings["persist"]:
+            self.cooldown_writes = WriteBehindBuffer(
+                "Cooldown", self._write_cooldown_rows,
+                flush_interval=self.COOLDOWN_FLUSH_INTERVAL_SECONDS, max_batch_size=self.COOLDOWN_FLUSH_BATCH_SIZE, log=self.log
             )
-            return False
-        # Check user cooldown
-        user_promotion_cooldown_end: float = self.user_promotion_cooldowns.get(message_event.sender, 0)
-        if current_time < user_promotion_cooldown_end:
-            wait_time_seconds: float = user_promotion_cooldown_end - current_time
-            self.log.info(f"⏱️ User cooldown for {wait_time_seconds:.1f}s active")
-            await self._send_cooldown_message(
-                message_event,
-                wait_time_seconds,
-                self.config["messages"]["user_cooldown_message"]
+            self.cooldown_writes.start()
+        self.cooldown_sweeper = asyncio.create_task(self._run_cooldown_sweeper(cooldown_settings["sweep_interval_seconds"]))
+        return self.cooldown_store
+
+    def _build_cooldown_policies(self, cooldown_settings: dict[str, Any]) -> dict[str, CooldownPolicy]:
+        """Create the rate limiting policy of each cooldown scope from the (room-specific) cooldown settings."""
+        scopes: tuple[str, ...] = (self.GLOBAL_COOLDOWN_SCOPE, self.ROOM_COOLDOWN_SCOPE, self.USER_COOLDOWN_SCOPE)
+        if cooldown_settings["policy"] == "token_bucket":
+            return {
+                scope: TokenBucketPolicy(capacity=cooldown_settings["burst"][scope], refill_seconds=cooldown_settings[scope])
+                for scope in scopes
+            }
+        return {scope: FixedWindowPolicy(cooldown_seconds=cooldown_settings[scope]) for scope in scopes}
+
+    async def _load_cooldowns(self) -> None:
+        """Load the cooldowns that are still active from the plugin database, so restarts don't reset them."""
+        if self.cooldown_store is None or self.cooldown_writes is None:
+            return
+        try:
+            rows = await self.plugin_database.fetch("SELECT scope, subject, ends_at FROM cooldown WHERE ends_at > $1", int(time.time() * 1000))
+        except Exception as error:
+            self.log.error(f"❌ Failed to load cooldowns, starting without active cooldowns: {type(error).__name__}: {error}")
+            return
+        for row in rows:
+            self.cooldown_store.set((row["scope"], row["subject"]), row["ends_at"] / 1000)
+        self.log.info(f"⏱️ Loaded {len(rows)} active cooldowns: active={self.cooldown_store.entry_counts()}")
+
+    def _get_cooldown_store(self) -> CooldownStore:
+        """Return the cooldown store. Raises RuntimeError if it is not running."""
+        if self.cooldown_store is None:
+            raise RuntimeError("Cooldown store is not running")
+        return self.cooldown_store
+
+    async def _stop_cooldown_store(self) -> None:
+        """Stop sweeping and log the cooldown statistics."""
+        if self.cooldown_sweeper is not None:
+            self.cooldown_sweeper.cancel()
+            await asyncio.gather(self.cooldown_sweeper, return_exceptions=True)
+            self.cooldown_sweeper = None
+        if self.cooldown_writes is not None:
+            await self.cooldown_writes.stop()
+            self.cooldown_writes = None
+        if self.cooldown_store is not None:
+            self.log.info(f"📊 Cooldowns: active={self.cooldown_store.entry_counts()}, expired={self.cooldown_store.expired}, evicted={self.cooldown_store.evicted}")
+            self.cooldown_store = None
+
+    async def _run_cooldown_sweeper(self, sweep_interval_seconds: float) -> None:
+        """Periodically drop expired cooldowns from the store and the plugin database, so both only hold active ones."""
+        reported_evictions: int = 0
+        while True:
+            await asyncio.sleep(sweep_interval_seconds)
+            if self.cooldown_store is None:
+                continue
+            if expired_cooldowns := self.cooldown_store.sweep():
+                self.log.debug(f"🧹 Dropped {expired_cooldowns} expired cooldowns: active={self.cooldown_store.entry_counts()}")
+            if self.cooldown_store.evicted > reported_evictions:
+                reported_evictions = self.cooldown_store.evicted
+                self.log.warning(f"⚠️ Cooldown store is full, {reported_evictions} active cooldowns were dropped so far: max_entries={self.cooldown_store.max_entries}")
+            if self.cooldown_writes is not None:
+                try:
+                    await self.plugin_database.execute("DELETE FROM cooldown WHERE ends_at <= $1", int(time.time() * 1000))
+                except Exception as error:
+                    self.log.warning(f"⚠️ Failed to prune expired cooldowns from the database: {type(error).__name__}: {error}")
+
+    async def _write_cooldown_rows(self, upserts: list[tuple[Any, ...]], deletes: list[CooldownKey]) -> None:
+        """Write a batch of cooldown updates in a single transaction."""
+        async with self._database_transaction() as connection:
+            await connection.executemany(
+                "INSERT INTO cooldown (scope, subject, ends_at) VALUES ($1, $2, $3) "
+                "ON CONFLICT (scope, subject) DO UPDATE SET ends_at=excluded.ends_at",
+                upserts
             )
-            return False
+            if deletes:
+                await connection.executemany("DELETE FROM cooldown WHERE scope=$1 AND subject=$2", deletes)
+
+    async def _check_cooldowns(self, message_event: MaubotMessageEvent) -> CooldownReservation | None:
+        """Verify global, room and user cooldowns and reserve them for the promotion. Returns None if one is active."""
+        cooldown_store: CooldownStore = self._get_cooldown_store()
+        cooldown_policies: dict[str, CooldownPolicy] = self._get_room_policy(message_event.room_id).cooldown_policies
+        current_time: float = time.time()
+        # Check global cooldown first, then room and user cooldown
+        for cooldown_key, cooldown_name, message_key in (
+            (self.GLOBAL_COOLDOWN_KEY, "Global", "global_cooldown_message"),
+            ((self.ROOM_COOLDOWN_SCOPE, message_event.room_id), "Room", "room_cooldown_message"),
+            ((self.USER_COOLDOWN_SCOPE, message_event.sender), "User", "user_cooldown_message")
+        ):
+            cooldown_policy: CooldownPolicy = cooldown_policies[cooldown_key[0]]
+            if wait_time_seconds := cooldown_policy.wait_time(cooldown_store.get(cooldown_key), current_time):
+                self.log.info(f"⏱️ {cooldown_name} cooldown for {wait_time_seconds:.1f}s active")
+                self._count_outcome(message_key)
+                await self._send_cooldown_message(message_event, wait_time_seconds, self.config_snapshot.messages[message_key])
+                return None
         
         self.log.info(f"✅ Cooldown check passed")
-        return True
+        # Reserved without an await after the check, so concurrent handlers already see the taken cooldowns without a lock
+        return self._reserve_cooldowns(message_event.room_id, message_event.sender)
 
     async def _send_cooldown_message(self, message_event: MaubotMessageEvent, wait_time_seconds: float, message_template: str) -> None:
         """Format and send cooldown notification to user."""
@@ -47,21 +139,86 @@ class CooldownMixin(MixinHost):
         # Format time display using config templates
         match (remaining_minutes, remaining_seconds):
             case (0, seconds):
-                formatted_time: str = self.config["messages"]["time_display_formats"]["seconds_only_format"].format(seconds=seconds)
+                formatted_time: str = self.config_snapshot.time_display_formats["seconds_only_format"].format(seconds=seconds)
             case (minutes, 0):
-                formatted_time = self.config["messages"]["time_display_formats"]["minutes_only_format"].format(minutes=minutes)
+                formatted_time = self.config_snapshot.time_display_formats["minutes_only_format"].format(minutes=minutes)
             case (minutes, seconds):
-                formatted_time = self.config["messages"]["time_display_formats"]["minutes_and_seconds_format"].format(minutes=minutes, seconds=seconds)
+                formatted_time = self.config_snapshot.time_display_formats["minutes_and_seconds_format"].format(minutes=minutes, seconds=seconds)
         cooldown_message: str = message_template.format(time=formatted_time)
-        await message_event.respond(cooldown_message, in_thread=self.config["messages"]["reply_in_thread"])
+        await message_event.respond(cooldown_message, in_thread=self.config_snapshot.reply_in_thread)
+
+    def _reserve_cooldowns(self, room_id: RoomID, user_id: str) -> CooldownReservation:
+        """Take global, room and user cooldowns for a promotion. They are persisted once the promotion is committed."""
+        current_timestamp: float = time.time()
+        cooldown_store: CooldownStore = self._get_cooldown_store()
+        cooldown_policies: dict[str, CooldownPolicy] = self._get_room_policy(room_id).cooldown_policies
+        reserved_cooldowns: list[tuple[CooldownKey, CooldownPolicy, float]] = []
+        for cooldown_key in (self.GLOBAL_COOLDOWN_KEY, (self.ROOM_COOLDOWN_SCOPE, room_id), (self.USER_COOLDOWN_SCOPE, user_id)):
+            # The policy derives the new state from the current one, the store forgets it once it is no longer needed
+            cooldown_policy: CooldownPolicy = cooldown_policies[cooldown_key[0]]
+            cooldown_state: float = cooldown_policy.next_state(cooldown_store.get(cooldown_key), current_timestamp)
+            # Disabled cooldowns (0 seconds) have nothing to track
+            if cooldown_state > current_timestamp:
+                cooldown_store.set(cooldown_key, cooldown_state)
+                reserved_cooldowns.append((cooldown_key, cooldown_policy, cooldown_state))
+        return CooldownReservation(tuple(reserved_cooldowns))
+
+    def _settle_cooldowns(self, job: PromotionJob, promoted: bool) -> None:
+        """Keep the cooldowns reserved for a promotion and its followers if it succeeded, give them back otherwise."""
+        if job.cooldown_reservation is not None:
+            if promoted:
+                self._commit_cooldowns(job.cooldown_reservation)
+            else:
+                self._release_cooldowns(job.cooldown_reservation)
+        # Promotions replayed from the outbox lost their reservation with the restart and are charged once done
+        elif promoted:
+            self._commit_cooldowns(self._reserve_cooldowns(job.message_event.room_id, job.message_event.sender))
+        for follower_reservation in job.follower_reservations:
+            if promoted:
+                self._commit_cooldowns(follower_reservation)
+            else:
+                self._release_cooldowns(follower_reservation)
 
-    def _update_cooldowns(self, user_id: str) -> None:
-        """Update global and user cooldowns after successful promotion."""
+    def _commit_cooldowns(self, cooldown_reservation: CooldownReservation) -> None:
+        """Keep the cooldowns reserved for a successful promotion and persist them."""
         current_timestamp: float = time.time()
-        # Calculate new cooldown timestamps
-        next_global_promotion_timestamp = current_timestamp + self.config["cooldowns"]["global"]
-        next_user_promotion_timestamp = current_timestamp + self.config["cooldowns"]["user"]
-        # Update cooldown timestamps
-        self.next_global_promotion_time = next_global_promotion_timestamp
-        self.user_promotion_cooldowns[user_id] = next_user_promotion_timestamp
-        self.log.info(f"⏱️ Cooldowns updated: next_global_promotion={time.strftime('%H:%M:%S', time.localtime(next_global_promotion_timestamp))}, next_user_promotion={time.strftime('%H:%M:%S', time.localtime(next_user_promotion_timestamp))}")
+        cooldown_store: CooldownStore = self._get_cooldown_store()
+        next_promotion_timestamps: list[str] = []
+        for cooldown_key, cooldown_policy, _ in cooldown_reservation.cooldowns:
+            cooldown_state: float = cooldown_store.get(cooldown_key)
+            self._persist_cooldown(cooldown_key, cooldown_state)
+            next_promotion_timestamp: float = current_timestamp + cooldown_policy.wait_time(cooldown_state, current_timestamp)
+            next_promotion_timestamps.append(f"next_{cooldown_key[0]}_promotion={time.strftime('%H:%M:%S', time.localtime(next_promotion_timestamp))}")
+        self.log.info(f"⏱️ Cooldowns updated: {', '.join(next_promotion_timestamps) or 'all disabled'}")
+
+    def _release_cooldowns(self, cooldown_reservation: CooldownReservation) -> None:
+        """Give back the cooldowns reserved for a promotion that failed or was rejected."""
+        current_timestamp: float = time.time()
+        cooldown_store: CooldownStore = self._get_cooldown_store()
+        for cooldown_key, cooldown_policy, reserved_state in cooldown_reservation.cooldowns:
+            # Cooldowns that expired in the meantime have nothing to give back
+            if not (cooldown_state := cooldown_store.get(cooldown_key)):
+                continue
+            # Neither do reservations a later promotion has taken over
+            if (released_state := cooldown_policy.release_state(cooldown_state, reserved_state, current_timestamp)) is None:
+                continue
+            if released_state > current_timestamp:
+                cooldown_store.set(cooldown_key, released_state)
+            else:
+                cooldown_store.discard(cooldown_key)
+            self._persist_cooldown(cooldown_key, released_state)
+        self.log.info(f"↩️ Cooldowns released: scopes={[cooldown_key[0] for cooldown_key, _, _ in cooldown_reservation.cooldowns]}")
+
+    def _persist_cooldown(self, cooldown_key: CooldownKey, cooldown_state: float) -> None:
+        """
+        Queue the state of a cooldown for the database, or its removal if it is over.
+        
+        The state may include reservations of promotions still in progress, so a restart errs on the side of an active cooldown.
+        """
+        # Persisted in the background with the next batch, the handler never waits for the database
+        if self.cooldown_writes is None:
+            return
+        if cooldown_state > time.time():
+            self.cooldown_writes.put(cooldown_key, (*cooldown_key, int(cooldown_state * 1000)))
+        else:
+            self.cooldown_writes.delete(cooldown_key)
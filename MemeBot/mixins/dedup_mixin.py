@@ -0,0 +1,247 @@
+"""
+Duplicate detection mixin for MemeBot.
+Handles the indexes of promoted images per promotion server, so identical images and reposts are acknowledged or rejected without another upload.
+"""
+from __future__ import annotations
+
+from typing import Any
+import asyncio
+import time
+from maubot.matrix import MaubotMessageEvent
+from mautrix.types import EncryptedFile, EventID, MessageEvent
+from MemeBot.utils import (
+    PERCEPTUAL_HASH_AVAILABLE, MultiIndexHashTable, PromotedImage, PromotedImageIndex, PromotedImageKey, WorkerPoolBusyError,
+    WriteBehindBuffer, content_digest
+)
+from .types import MixinHost
+
+
+class DedupMixin(MixinHost):
+    """Mixin for duplicate image detection functionality."""
+
+    # Write batching of the persisted index (changes are only needed again after a restart)
+    PROMOTED_IMAGE_FLUSH_INTERVAL_SECONDS: float = 5.0
+    PROMOTED_IMAGE_FLUSH_BATCH_SIZE: int = 100
+    # Rows loaded into the perceptual hash index before yielding to the event loop
+    PERCEPTUAL_HASH_LOAD_BATCH_SIZE: int = 10000
+
+    async def _start_promoted_image_index(self) -> None:
+        """Create the promoted image index and load it from the plugin database if it is persisted."""
+        dedup_settings = self.config["dedup"]
+        if not dedup_settings["enabled"]:
+            return
+        self.promoted_images = PromotedImageIndex(max_entries=dedup_settings["max_entries"], ttl_seconds=dedup_settings["ttl_seconds"])
+        if dedup_settings["persist"]:
+            await self._load_promoted_images()
+            self.promoted_image_store = WriteBehindBuffer(
+                "Promoted image", self._write_promoted_image_rows,
+                flush_interval=self.PROMOTED_IMAGE_FLUSH_INTERVAL_SECONDS, max_batch_size=self.PROMOTED_IMAGE_FLUSH_BATCH_SIZE, log=self.log
+            )
+            self.promoted_image_store.start()
+        self.log.info(f"♻️ Duplicate detection enabled: action={dedup_settings['action']}, entries={len(self.promoted_images)}, persist={dedup_settings['persist']}")
+        if dedup_settings["perceptual"]["enabled"]:
+            await self._start_perceptual_hash_index()
+
+    async def _start_perceptual_hash_index(self) -> None:
+        """Create the perceptual hash index for repost detection and load it from the plugin database if it is persisted."""
+        if not PERCEPTUAL_HASH_AVAILABLE:
+            self.log.warning("⚠️ Repost detection is enabled, but numpy is not installed. Perceptual hashes are not checked.")
+            return
+        self.perceptual_hashes = {}
+        if self.config["dedup"]["persist"]:
+            await self._load_perceptual_hashes()
+            self.perceptual_hash_store = WriteBehindBuffer(
+                "Perceptual hash", self._write_perceptual_hash_rows,
+                flush_interval=self.PROMOTED_IMAGE_FLUSH_INTERVAL_SECONDS, max_batch_size=self.PROMOTED_IMAGE_FLUSH_BATCH_SIZE, log=self.log
+            )
+            self.perceptual_hash_store.start()
+        self.log.info(f"🔁 Repost detection enabled: max_distance={self.config_snapshot.perceptual_max_distance}, entries={sum(map(len, self.perceptual_hashes.values()))}")
+
+    async def _stop_promoted_image_index(self) -> None:
+        """Write the remaining index changes and log the hit statistics."""
+        if self.promoted_image_store is not None:
+            await self.promoted_image_store.stop()
+            self.promoted_image_store = None
+        if self.perceptual_hash_store is not None:
+            await self.perceptual_hash_store.stop()
+            self.perceptual_hash_store = None
+        self.perceptual_hashes = None
+        if self.promoted_images is not None:
+            self.log.info(f"📊 Duplicate detection: hits={self.promoted_images.hits}, misses={self.promoted_images.misses}, media_url_hits={self.promoted_images.media_url_hits}, entries={len(self.promoted_images)}, evictions={self.promoted_images.evictions}")
+            self.promoted_images = None
+
+    async def _compute_image_digest(self, image_bytes: bytes) -> str | None:
+        """Hash downloaded image data for duplicate detection. Returns None if detection is disabled or the pool is busy."""
+        if self.promoted_images is None:
+            return None
+        try:
+            return await self._get_worker_pool().run(content_digest, image_bytes)
+        except WorkerPoolBusyError as error:
+            # Skipping the check only costs an upload, so the promotion goes ahead
+            self.log.warning(f"⏳ Duplicate check skipped: {error}")
+            return None
+
+    async def _reject_duplicate_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, target_image_event_id: EventID, image_digest: str | None = None) -> str | None:
+        """
+        Check if an image was promoted to the room's promotion server recently, by content digest if given and by media URL otherwise.
+        Acknowledges or rejects a duplicate according to the config. Returns the outcome if the image is a duplicate, None otherwise.
+        """
+        if self.promoted_images is None:
+            return None
+        server_url: str = self._get_room_policy(message_event.room_id).server_url
+        media_url: str | None = self._get_media_url(target_image_message)
+        if image_digest:
+            promoted_image: PromotedImage | None = self.promoted_images.lookup(server_url, image_digest)
+        elif media_url:
+            promoted_image = self.promoted_images.lookup_media_url(server_url, media_url)
+        else:
+            return None
+        if not promoted_image:
+            if image_digest:
+                self.log.debug(f"♻️ Duplicate check missed: digest={image_digest[:16]}, hits={self.promoted_images.hits}, misses={self.promoted_images.misses}")
+            return None
+        if media_url:
+            self.promoted_images.add_media_url(server_url, promoted_image.digest, media_url)
+        self.log.info(f"♻️ Duplicate image not promoted again: message_id={target_image_event_id}, first_promoted={promoted_image.event_id}, matched_by={'digest' if image_digest else 'media_url'}, hits={self.promoted_images.hits}, misses={self.promoted_images.misses}, media_url_hits={self.promoted_images.media_url_hits}")
+        if self.config_snapshot.dedup_action == "acknowledge":
+            self._count_outcome("duplicate_acknowledged")
+            await self._add_success_reaction(message_event, target_image_event_id)
+            return "duplicate_acknowledged"
+        await self._respond_with_message(message_event, "duplicate_image")
+        return "duplicate_image"
+
+    async def _reject_similar_image(self, message_event: MaubotMessageEvent, target_image_event_id: EventID, image_perceptual_hash: int) -> str | None:
+        """
+        Check if an image looks like one recently promoted to the room's promotion server and reply with repost_detected.
+        Returns the outcome if it is a repost, None otherwise.
+        """
+        if self.perceptual_hashes is None:
+            return None
+        server_url: str = self._get_room_policy(message_event.room_id).server_url
+        if (perceptual_hashes := self.perceptual_hashes.get(server_url)) is None:
+            return None
+        max_distance: int = self.config_snapshot.perceptual_max_distance
+        lookup_start: float = time.perf_counter()
+        # Expired hashes are skipped (and dropped) by the lookup
+        match: tuple[int, EventID] | None = perceptual_hashes.find_nearest(image_perceptual_hash, max_distance)
+        lookup_time: float = time.perf_counter() - lookup_start
+        if not match:
+            self.log.debug(f"🔁 No similar image found: message_id={target_image_event_id}, entries={len(perceptual_hashes)}, lookup_time={lookup_time * 1000:.2f}ms")
+            return None
+        distance, first_event_id = match
+        self.log.info(f"🔁 Repost not promoted again: message_id={target_image_event_id}, first_promoted={first_event_id}, distance={distance}, lookup_time={lookup_time * 1000:.2f}ms")
+        await self._respond_with_message(message_event, "repost_detected")
+        return "repost_detected"
+
+    def _remember_promoted_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, target_image_event_id: EventID, image_digest: str | None, image_perceptual_hash: int | None = None) -> None:
+        """Add a successfully promoted image to the indexes of the promotion server it was uploaded to."""
+        server_url: str = self._get_room_policy(message_event.room_id).server_url
+        if self.perceptual_hashes is not None and image_perceptual_hash is not None:
+            promoted_at: float = time.time()
+            evicted_hashes: list[int] = self._get_perceptual_hash_table(server_url).add(image_perceptual_hash, target_image_event_id, promoted_at)
+            if self.perceptual_hash_store is not None:
+                self.perceptual_hash_store.put((server_url, image_perceptual_hash), (server_url, self._to_signed_hash(image_perceptual_hash), target_image_event_id, int(promoted_at * 1000)))
+                for evicted_hash in evicted_hashes:
+                    self.perceptual_hash_store.delete((server_url, evicted_hash))
+        if self.promoted_images is None or not image_digest:
+            return
+        media_url: str | None = self._get_media_url(target_image_message)
+        promoted_image = PromotedImage(
+            digest=image_digest, server_url=server_url, event_id=target_image_event_id, room_id=message_event.room_id,
+            promoted_at=time.time(), media_urls={media_url} if media_url else set()
+        )
+        evicted_keys: list[PromotedImageKey] = self.promoted_images.add(promoted_image)
+        if self.promoted_image_store is not None:
+            self.promoted_image_store.put((server_url, image_digest), (
+                server_url, image_digest, media_url, target_image_event_id, message_event.room_id, int(promoted_image.promoted_at * 1000)
+            ))
+            for evicted_key in evicted_keys:
+                self.promoted_image_store.delete(evicted_key)
+
+    def _get_perceptual_hash_table(self, server_url: str) -> MultiIndexHashTable[EventID]:
+        """Get the perceptual hash index of a promotion server, created on its first promotion."""
+        assert self.perceptual_hashes is not None
+        if (perceptual_hashes := self.perceptual_hashes.get(server_url)) is None:
+            dedup_settings = self.config["dedup"]
+            perceptual_hashes = self.perceptual_hashes[server_url] = MultiIndexHashTable(max_entries=dedup_settings["max_entries"], ttl_seconds=dedup_settings["ttl_seconds"])
+        return perceptual_hashes
+
+    @staticmethod
+    def _to_signed_hash(image_perceptual_hash: int) -> int:
+        # BIGINT columns are signed
+        return image_perceptual_hash - (1 << 64) if image_perceptual_hash >= 1 << 63 else image_perceptual_hash
+
+    def _get_media_url(self, target_image_message: MessageEvent) -> str | None:
+        """Get the media URL of an image event (the ciphertext URL for encrypted images)."""
+        encryption_info: EncryptedFile | None = getattr(target_image_message.content, 'file', None)
+        return encryption_info.url if encryption_info else getattr(target_image_message.content, 'url', None)
+
+    async def _load_promoted_images(self) -> None:
+        """Drop expired rows and load the most recent promoted images into the index."""
+        assert self.promoted_images is not None
+        try:
+            await self.plugin_database.execute("DELETE FROM promoted_image WHERE promoted_at < $1", int((time.time() - self.promoted_images.ttl_seconds) * 1000))
+            rows = await self.plugin_database.fetch(
+                "SELECT server_url, digest, media_url, event_id, room_id, promoted_at FROM promoted_image ORDER BY promoted_at DESC LIMIT $1",
+                self.promoted_images.max_entries
+            )
+        except Exception as error:
+            self.log.error(f"❌ Failed to load promoted images, starting with an empty index: {type(error).__name__}: {error}")
+            return
+        # Oldest first, so the most recent promotions end up as the most recently used entries
+        for row in reversed(rows):
+            self.promoted_images.add(PromotedImage(
+                digest=row["digest"], server_url=row["server_url"], event_id=row["event_id"], room_id=row["room_id"],
+                promoted_at=row["promoted_at"] / 1000, media_urls={row["media_url"]} if row["media_url"] else set()
+            ))
+
+    async def _write_promoted_image_rows(self, upserts: list[tuple[Any, ...]], deletes: list[PromotedImageKey]) -> None:
+        """Write a batch of index changes in a single transaction."""
+        async with self._database_transaction() as connection:
+            if upserts:
+                await connection.executemany(
+                    "INSERT INTO promoted_image (server_url, digest, media_url, event_id, room_id, promoted_at) VALUES ($1, $2, $3, $4, $5, $6) "
+                    "ON CONFLICT (server_url, digest) DO UPDATE SET media_url=excluded.media_url, event_id=excluded.event_id, "
+                    "room_id=excluded.room_id, promoted_at=excluded.promoted_at",
+                    upserts
+                )
+            if deletes:
+                await connection.executemany("DELETE FROM promoted_image WHERE server_url=$1 AND digest=$2", deletes)
+
+    async def _load_perceptual_hashes(self) -> None:
+        """Drop expired rows and load the remaining perceptual hashes into the indexes, dropping the rows over their size limit."""
+        assert self.perceptual_hashes is not None
+        try:
+            await self.plugin_database.execute("DELETE FROM perceptual_hash WHERE promoted_at < $1", int((time.time() - self.config_snapshot.dedup_ttl_seconds) * 1000))
+            rows = await self.plugin_database.fetch("SELECT server_url, hash, event_id, promoted_at FROM perceptual_hash ORDER BY promoted_at")
+        except Exception as error:
+            self.log.error(f"❌ Failed to load perceptual hashes, starting with an empty index: {type(error).__name__}: {error}")
+            return
+        # Oldest first, so the most recent promotions end up as the most recently used entries
+        evicted_rows: list[tuple[str, int]] = []
+        for row_number, row in enumerate(rows, 1):
+            evicted_hashes: list[int] = self._get_perceptual_hash_table(row["server_url"]).add(row["hash"] & 0xFFFFFFFFFFFFFFFF, EventID(row["event_id"]), row["promoted_at"] / 1000)
+            evicted_rows.extend((row["server_url"], self._to_signed_hash(evicted_hash)) for evicted_hash in evicted_hashes)
+            # Large indexes take a moment to build, don't block the event loop meanwhile
+            if row_number % self.PERCEPTUAL_HASH_LOAD_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
+        if evicted_rows:
+            try:
+                await self.plugin_database.executemany("DELETE FROM perceptual_hash WHERE server_url=$1 AND hash=$2", evicted_rows)
+            except Exception as error:
+                self.log.warning(f"⚠️ Failed to drop perceptual hashes over the limit, they are dropped on the next start: {type(error).__name__}: {error}")
+
+    async def _write_perceptual_hash_rows(self, upserts: list[tuple[Any, ...]], deletes: list[tuple[str, int]]) -> None:
+        """Write a batch of perceptual hash changes in a single transaction."""
+        async with self._database_transaction() as connection:
+            if upserts:
+                await connection.executemany(
+                    "INSERT INTO perceptual_hash (server_url, hash, event_id, promoted_at) VALUES ($1, $2, $3, $4) "
+                    "ON CONFLICT (server_url, hash) DO UPDATE SET event_id=excluded.event_id, promoted_at=excluded.promoted_at",
+                    upserts
+                )
+            if deletes:
+                await connection.executemany(
+                    "DELETE FROM perceptual_hash WHERE server_url=$1 AND hash=$2",
+                    [(server_url, self._to_signed_hash(image_perceptual_hash)) for server_url, image_perceptual_hash in deletes]
+                )
@@ -0,0 +1,145 @@
+"""
+Memory diagnostics mixin for MemeBot.
+Periodically compares tracemalloc snapshots (opt-in), tracks the sizes of the plugin's containers and warns when
+the resident memory or a container grows past the configured thresholds.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import tracemalloc
+from .types import MixinHost
+
+
+class DiagnosticsMixin(MixinHost):
+    """Mixin for memory diagnostics and the leak watchdog."""
+
+    # Allocations of the diagnostics themselves and of imports are not leaks of the plugin
+    SNAPSHOT_FILTERS: tuple[tracemalloc.Filter, ...] = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    )
+
+    def _start_memory_diagnostics(self) -> asyncio.Task[None] | None:
+        """Start tracing allocations and the task checking the memory if memory diagnostics are enabled."""
+        diagnostics_settings = self.config["memory_diagnostics"]
+        if not diagnostics_settings["enabled"]:
+            return None
+        # tracemalloc is process-wide and may already be running, e.g. started with PYTHONTRACEMALLOC
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(diagnostics_settings["trace_frames"])
+            self.memory_tracing_started = True
+        self.memory_snapshot = None
+        self.memory_watchdog = asyncio.create_task(self._run_memory_watchdog(diagnostics_settings["interval_seconds"]))
+        self.log.info(f"🩺 Memory diagnostics started: interval={diagnostics_settings['interval_seconds']}s, trace_frames={tracemalloc.get_traceback_limit()}")
+        return self.memory_watchdog
+
+    async def _stop_memory_diagnostics(self) -> None:
+        """Stop the memory checks and the allocation tracing started by them."""
+        if self.memory_watchdog is not None:
+            self.memory_watchdog.cancel()
+            await asyncio.gather(self.memory_watchdog, return_exceptions=True)
+            self.memory_watchdog = None
+        self.memory_snapshot = None
+        if self.memory_tracing_started:
+            tracemalloc.stop()
+            self.memory_tracing_started = False
+
+    async def _run_memory_watchdog(self, interval_seconds: float) -> None:
+        """Check the memory every interval, starting with a baseline snapshot."""
+        self.memory_snapshot = await asyncio.to_thread(self._take_memory_snapshot)
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await self._check_memory()
+            except Exception as error:
+                self.log.warning(f"⚠️ Memory check failed: {type(error).__name__}: {error}")
+
+    async def _check_memory(self) -> None:
+        """Log the allocation sites that grew since the last check and warn about memory over the thresholds."""
+        diagnostics_settings = self.config["memory_diagnostics"]
+        rss_bytes: int | None = self._read_rss_bytes()
+        container_sizes: dict[str, int] = self._collect_container_sizes()
+        if tracemalloc.is_tracing():
+            # Snapshots and their comparison take a while with many traces, so they run in a thread
+            current_snapshot: tracemalloc.Snapshot = await asyncio.to_thread(self._take_memory_snapshot)
+            if self.memory_snapshot is not None:
+                growth: list[tracemalloc.StatisticDiff] = await asyncio.to_thread(current_snapshot.compare_to, self.memory_snapshot, "lineno")
+                growth_lines: list[str] = [
+                    f"{statistic.traceback[0]}: {statistic.size_diff:+,} bytes, {statistic.count_diff:+,} blocks (total {statistic.size:,} bytes)"
+                    for statistic in growth[:diagnostics_settings["top_allocations"]] if statistic.size_diff > 0
+                ]
+                if growth_lines:
+                    self.log.info("🩺 Allocation growth since the last check:\n" + "\n".join(growth_lines))
+            self.memory_snapshot = current_snapshot
+        self.log.debug(f"🩺 Memory: rss={rss_bytes}, containers={container_sizes}")
+        rss_warning_bytes: int = diagnostics_settings["rss_warning_bytes"]
+        if rss_warning_bytes and rss_bytes is not None and rss_bytes > rss_warning_bytes:
+            self.log.warning(f"⚠️ Resident memory is above the threshold: rss={rss_bytes:,} bytes, threshold={rss_warning_bytes:,} bytes")
+        container_warning_entries: int = diagnostics_settings["container_warning_entries"]
+        if container_warning_entries and (large_containers := {name: size for name, size in container_sizes.items() if size > container_warning_entries}):
+            self.log.warning(f"⚠️ Containers are above the threshold: {large_containers}, threshold={container_warning_entries:,} entries")
+
+    def _take_memory_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(self.SNAPSHOT_FILTERS)
+
+    @staticmethod
+    def _read_rss_bytes() -> int | None:
+        """Resident memory of the process, None where /proc is not available."""
+        try:
+            with open("/proc/self/statm", "rb") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _collect_container_sizes(self) -> dict[str, int]:
+        """Number of entries in the plugin's caches, indexes and queues (the ones that exist)."""
+        container_sizes: dict[str, int] = {
+            "prefetched_images": len(self.prefetched_images),
+            "prefetch_tasks": len(self.prefetch_tasks),
+            "inflight_promotions": len(self.inflight_promotions),
+            "room_policies": len(self.room_policies),
+        }
+        if self.cooldown_store is not None:
+            container_sizes["cooldowns"] = len(self.cooldown_store)
+        if self.image_event_cache is not None:
+            container_sizes["image_event_cache"] = len(self.image_event_cache)
+        if self.media_cache is not None:
+            container_sizes["media_cache"] = len(self.media_cache)
+        if self.prefetch_cache is not None:
+            container_sizes["prefetch_cache"] = len(self.prefetch_cache)
+        if self.promotion_queue is not None:
+            container_sizes["promotion_queue"] = self.promotion_queue.qsize()
+        if self.promoted_images is not None:
+            container_sizes["promoted_images"] = len(self.promoted_images)
+        if self.perceptual_hashes is not None:
+            container_sizes["perceptual_hashes"] = sum(map(len, self.perceptual_hashes.values()))
+        for name, write_buffer in (("cooldown_writes", self.cooldown_writes), ("outbox_writes", self.promotion_outbox), ("promoted_image_writes", self.promoted_image_store), ("perceptual_hash_writes", self.perceptual_hash_store)):
+            if write_buffer is not None:
+                container_sizes[name] = len(write_buffer)
+        return container_sizes
+
+    async def _run_memory_command(self, arguments: tuple[str, ...]) -> str:
+        """Handle `memory [N]`: the resident memory, the container sizes and the top N allocation sites. Returns the reply."""
+        try:
+            top_allocations: int = int(arguments[0]) if arguments else self.config["memory_diagnostics"]["top_allocations"]
+        except ValueError:
+            top_allocations = 0
+        if top_allocations <= 0:
+            return "Usage: memory [number of allocation sites]"
+        rss_bytes: int | None = self._read_rss_bytes()
+        reply_lines: list[str] = [
+            f"RSS: {f'{rss_bytes:,} bytes' if rss_bytes is not None else 'unavailable'}",
+            "Containers: " + ", ".join(f"{name}={size:,}" for name, size in self._collect_container_sizes().items()),
+        ]
+        if not tracemalloc.is_tracing():
+            reply_lines.append("Allocation tracing is off (memory_diagnostics.enabled)")
+            return "\n".join(reply_lines)
+        traced_bytes, peak_traced_bytes = tracemalloc.get_traced_memory()
+        reply_lines.append(f"Traced: {traced_bytes:,} bytes (peak {peak_traced_bytes:,} bytes), top allocation sites:")
+        memory_snapshot: tracemalloc.Snapshot = await asyncio.to_thread(self._take_memory_snapshot)
+        statistics: list[tracemalloc.Statistic] = await asyncio.to_thread(memory_snapshot.statistics, "lineno")
+        reply_lines.extend(f"{statistic.traceback[0]}: {statistic.size:,} bytes, {statistic.count:,} blocks" for statistic in statistics[:top_allocations])
+        return "\n".join(reply_lines)
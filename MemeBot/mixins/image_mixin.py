@@ -1,79 +1,328 @@
 """
 Image processing mixin for MemeBot.
-Handles image download, validation, and format checking with caching.
+Handles image download (buffered or streamed) with a cache of downloaded images, validation, and format checking.
 """
 from __future__ import annotations
 
-from functools import lru_cache
-from io import BytesIO
-from PIL import Image
-from maubot.matrix import MaubotMessageEvent
-from mautrix.types import MessageEvent, EncryptedFile, ContentURI
-from mautrix.crypto.attachments import decrypt_attachment
+from typing import Any, AsyncIterator
+from contextlib import asynccontextmanager, AsyncExitStack
+import time
+import aiohttp
+from maubot.matrix import MaubotMessageEvent, MaubotMatrixClient
+from mautrix.types import MessageEvent, EncryptedFile, ContentURI, SpecVersions
+from MemeBot.utils import (
+    IMAGE_HEADER_SIZE, AttachmentDecryptionError, AttachmentDecryptor, ImageRejectedError, ImageStream, MediaCache, WorkerPool,
+    WorkerPoolBusyError, detect_image_format, format_from_mimetype, perceptual_hash, sniff_image_format
+)
 from .types import MixinHost
 
 
 class ImageMixin(MixinHost):
     """Mixin for image processing functionality."""
     
-    @lru_cache(maxsize=1) 
-    def _get_cached_supported_image_formats(self) -> tuple[str, ...]:
-        """Cache supported image formats."""
-        return tuple(image_format.upper() for image_format in self.config["image"]["allowed_image_formats"])
+    def _start_worker_pool(self) -> WorkerPool:
+        """Create the worker pool used for CPU-bound image work."""
+        executor_settings = self.config["executor"]
+        self.worker_pool = WorkerPool(
+            executor_settings["type"],
+            executor_settings["max_workers"],
+            executor_settings["max_queue_depth"],
+            executor_settings["queue_wait_warning_seconds"],
+            self.log
+        )
+        self.log.info(f"🧵 Worker pool started: type={executor_settings['type']}, max_workers={executor_settings['max_workers']}, max_queue_depth={executor_settings['max_queue_depth']}")
+        return self.worker_pool
 
-    async def _download_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, image_filename: str) -> bytes | None:
-        """Download image data, handling both encrypted and unencrypted files."""
+    def _get_worker_pool(self) -> WorkerPool:
+        """Return the worker pool. Raises RuntimeError if it is not running."""
+        if self.worker_pool is None:
+            raise RuntimeError("Worker pool is not running")
+        return self.worker_pool
+
+    def _stop_worker_pool(self) -> None:
+        """Shut down the worker pool."""
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+            self.worker_pool = None
+
+    async def _admit_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, image_filename: str) -> bool:
+        """Reject images before downloading them, based on the event metadata or the first bytes of the file."""
+        # Prefetched images were validated after downloading them already
+        if not self.config_snapshot.admission_enabled or self._is_image_prefetched(target_image_message.event_id):
+            return True
+        try:
+            self._admit_image_metadata(target_image_message)
+            # Only fetch the header if the metadata did not settle the format and the download won't sniff it anyway
+            if not self._is_image_metadata_conclusive(target_image_message) and not self._should_stream_image(target_image_message):
+                await self._admit_image_header(message_event.client, target_image_message, image_filename)
+            return True
+        except ImageRejectedError as rejection:
+            self.log.warning(f"🚫 Image rejected before download: filename='{image_filename}': {rejection}")
+            await self._respond_with_message(message_event, rejection.message_key)
+            return False
+
+    def _get_image_memory_size(self, image_message: MessageEvent) -> int:
+        """Bytes an image may take in memory: its announced size, or the size limit of its room if none is announced."""
+        maximum_allowed_file_size: int = self._get_room_policy(image_message.room_id).maximum_file_size_bytes
+        announced_size: Any = getattr(getattr(image_message.content, 'info', None), 'size', None)
+        return min(announced_size, maximum_allowed_file_size) if isinstance(announced_size, int) and announced_size > 0 else maximum_allowed_file_size
+
+    def _is_image_metadata_conclusive(self, target_image_message: MessageEvent) -> bool:
+        """Check if the event metadata is trusted and names a known image format."""
+        image_info: Any = getattr(target_image_message.content, 'info', None)
+        return self.config_snapshot.trust_event_metadata and format_from_mimetype(getattr(image_info, 'mimetype', None)) is not None
+
+    def _admit_image_metadata(self, target_image_message: MessageEvent) -> None:
+        """Check the size and mimetype announced in the image event. Raises ImageRejectedError if invalid."""
+        if not self.config_snapshot.trust_event_metadata:
+            return
+        image_info: Any = getattr(target_image_message.content, 'info', None)
+        # Validate the announced file size
+        maximum_allowed_file_size: int = self._get_room_policy(target_image_message.room_id).maximum_file_size_bytes
+        announced_size: int | None = getattr(image_info, 'size', None)
+        if announced_size is not None and announced_size > maximum_allowed_file_size:
+            raise ImageRejectedError("image_size_exceeded", f"Announced size exceeded limit: size={announced_size:,} bytes, max={maximum_allowed_file_size:,} bytes")
+        # Validate the announced format
+        announced_format: str | None = format_from_mimetype(getattr(image_info, 'mimetype', None))
+        if announced_format is not None and announced_format not in self.config_snapshot.allowed_image_formats:
+            raise ImageRejectedError("image_format_unsupported", f"Announced format unsupported: mimetype={image_info.mimetype}")
+
+    async def _admit_image_header(self, client: MaubotMatrixClient, target_image_message: MessageEvent, image_filename: str) -> None:
+        """Fetch only the first bytes of the image and check them. Raises ImageRejectedError if invalid."""
+        encryption_info: EncryptedFile | None = getattr(target_image_message.content, 'file', None)
+        if not (media_url := encryption_info.url if encryption_info else getattr(target_image_message.content, 'url', None)):
+            return
+        try:
+            image_header, total_size = await self._fetch_image_header(client, media_url)
+            # AES-CTR allows decrypting the first bytes on their own (the hash is checked on the full download)
+            if encryption_info:
+                image_header = self._create_attachment_decryptor(encryption_info).update(image_header)
+        except Exception as error:
+            # Admission is best effort, the full download reports errors to the user
+            self.log.warning(f"⚠️ Could not fetch image header: filename='{image_filename}', url={media_url}: {error}")
+            return
+        # Validate the file size reported by the homeserver
+        maximum_allowed_file_size: int = self._get_room_policy(target_image_message.room_id).maximum_file_size_bytes
+        if total_size is not None and total_size > maximum_allowed_file_size:
+            raise ImageRejectedError("image_size_exceeded", f"Image size exceeded limit: size={total_size:,} bytes, max={maximum_allowed_file_size:,} bytes")
+        # Validate the format from the magic number
+        if not (detected_image_format := sniff_image_format(image_header)):
+            raise ImageRejectedError("image_format_invalid", f"Could not determine image format from header: size={len(image_header)} bytes")
+        if detected_image_format not in self.config_snapshot.allowed_image_formats:
+            raise ImageRejectedError("image_format_unsupported", f"Unsupported image format: format={detected_image_format}")
+
+    async def _fetch_image_header(self, client: MaubotMatrixClient, media_url: ContentURI) -> tuple[bytes, int | None]:
+        """Download the first bytes of a file with a ranged request. Returns the header and the total file size if known."""
+        async with self._open_media_response(client, media_url, headers={"Range": f"bytes=0-{IMAGE_HEADER_SIZE - 1}"}) as response:
+            image_header: bytes = b""
+            while len(image_header) < IMAGE_HEADER_SIZE and (chunk := await response.content.read(IMAGE_HEADER_SIZE - len(image_header))):
+                image_header += chunk
+            # A partial response reports the total size as "bytes 0-15/12345", a full one in its Content-Length
+            if response.status == 206:
+                total_size: str = response.headers.get("Content-Range", "").rpartition("/")[2]
+                return image_header, int(total_size) if total_size.isdigit() else None
+            return image_header, response.content_length
+
+    def _start_media_cache(self) -> MediaCache | None:
+        """Create the cache of downloaded images if it is enabled."""
+        media_cache_settings = self.config["media_cache"]
+        if not media_cache_settings["enabled"]:
+            return None
+        self.media_cache = MediaCache(media_cache_settings["memory_budget_bytes"], media_cache_settings["disk_directory"], media_cache_settings["disk_budget_bytes"])
+        try:
+            self.media_cache.open()
+        except OSError as error:
+            self.log.error(f"❌ Media cache directory unusable, caching in memory only: directory={media_cache_settings['disk_directory']}: {error}")
+            self.media_cache = MediaCache(media_cache_settings["memory_budget_bytes"])
+        return self.media_cache
+
+    def _stop_media_cache(self) -> None:
+        """Log the media cache statistics and remove the cached images."""
+        if self.media_cache is None:
+            return
+        self.log.info(
+            f"📊 Media cache: memory_hits={self.media_cache.memory_hits}, disk_hits={self.media_cache.disk_hits}, misses={self.media_cache.misses}, "
+            f"evictions={self.media_cache.evictions}, memory_bytes={self.media_cache.memory_bytes:,}, disk_bytes={self.media_cache.disk_bytes:,}"
+        )
+        try:
+            self.media_cache.close()
+        except OSError as error:
+            self.log.warning(f"⚠️ Failed to remove cached images from disk: {error}")
+        self.media_cache = None
+
+    def _get_media_cache_key(self, target_image_message: MessageEvent) -> str | None:
+        """Cache key of an image: its media URL, plus the ciphertext hash for encrypted files (the URL alone doesn't pin the keys)."""
+        if encryption_info := getattr(target_image_message.content, 'file', None):
+            ciphertext_hash: str | None = (encryption_info.hashes or {}).get("sha256")
+            return f"{encryption_info.url}#{ciphertext_hash}" if encryption_info.url and ciphertext_hash else None
+        return getattr(target_image_message.content, 'url', None)
+
+    async def _download_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, image_filename: str, maximum_size: int) -> bytes | None:
+        """Download image data of at most `maximum_size` bytes, handling both encrypted and unencrypted files, or take it from the media cache."""
+        media_cache_key: str | None = self._get_media_cache_key(target_image_message) if self.media_cache is not None else None
+        if media_cache_key and self.media_cache is not None and (cached_image_bytes := await self.media_cache.get(media_cache_key)) is not None:
+            self.log.info(f"💾 Image taken from the media cache: filename='{image_filename}', size={len(cached_image_bytes):,} bytes")
+            return cached_image_bytes
+        image_bytes: bytes | None = await self._fetch_image(message_event, target_image_message, image_filename, maximum_size)
+        if image_bytes and media_cache_key and self.media_cache is not None:
+            image_bytes = bytes(image_bytes)
+            await self.media_cache.put(media_cache_key, image_bytes)
+        return image_bytes
+
+    async def _fetch_image(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, image_filename: str, maximum_size: int) -> bytes | None:
+        """Download image data from the homeserver, handling both encrypted and unencrypted files."""
         encryption_info: EncryptedFile | None = getattr(target_image_message.content, 'file', None)
         media_url: ContentURI | None = getattr(target_image_message.content, 'url', None)
         # Encrypted file
         if encryption_info:
-            return await self._download_encrypted_image(message_event, encryption_info, image_filename)
+            return await self._download_encrypted_image(message_event, encryption_info, image_filename, maximum_size)
         # Unencrypted file
         elif media_url: 
-            return await self._download_unencrypted_image(message_event, media_url)
+            return await self._download_unencrypted_image(message_event, media_url, image_filename, maximum_size)
         else:
             self.log.error(f"❌🔗 No image URL found in replied message: filename='{image_filename}', user={message_event.sender}, message_id={target_image_message.event_id}")
-            await message_event.respond(self.config["messages"]["image_missing"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "image_missing")
             return None
 
-    async def _download_encrypted_image(self, message_event: MaubotMessageEvent, encryption_info: EncryptedFile, image_filename: str) -> bytes | None:
-        """Download and decrypt an encrypted image."""
+    async def _download_encrypted_image(self, message_event: MaubotMessageEvent, encryption_info: EncryptedFile, image_filename: str, maximum_size: int) -> bytes | None:
+        """Download and decrypt an encrypted image of at most `maximum_size` bytes."""
         media_url: ContentURI | None = encryption_info.url
         if not media_url:
             self.log.error(f"❌🔗 No MXC URL found in encrypted file metadata: filename='{image_filename}'")
-            await message_event.respond(self.config["messages"]["encrypted_image_url_missing"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "encrypted_image_url_missing")
             return None
         try:
-            # Download and decrypt the encrypted file
-            encrypted_data: bytes = await message_event.client.download_media(media_url)
-            # Decrypt using the metadata from the event
-            image_bytes: bytes = decrypt_attachment(
-                ciphertext=encrypted_data,
-                key=encryption_info.key.key,
-                hash=encryption_info.hashes["sha256"],
-                iv=encryption_info.iv
-            )
-            return image_bytes
+            return await self._read_encrypted_image(message_event.client, encryption_info, media_url, maximum_size)
+        except ImageRejectedError as rejection:
+            self.log.warning(f"🚫 Encrypted image rejected: filename='{image_filename}': {rejection}")
+            await self._respond_with_message(message_event, rejection.message_key)
+            return None
         except Exception as error:
             self.log.error(f"❌🔐 Decryption of file '{image_filename}' failed: {error}")
-            await message_event.respond(self.config["messages"]["encrypted_image_decrypt_failed"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "encrypted_image_decrypt_failed")
             return None
 
-    async def _download_unencrypted_image(self, message_event: MaubotMessageEvent, media_url: ContentURI) -> bytes | None:
-        """Download an unencrypted image."""
+    async def _read_encrypted_image(self, client: MaubotMatrixClient, encryption_info: EncryptedFile, media_url: ContentURI, maximum_size: int) -> bytearray:
+        """Download and decrypt an encrypted image of at most `maximum_size` bytes. Raises on failure."""
+        # Decrypt the file while it is downloaded, so the ciphertext is never held as a whole
+        return await self._read_media(client, media_url, maximum_size, self._create_attachment_decryptor(encryption_info))
+
+    async def _read_image(self, client: MaubotMatrixClient, image_message: MessageEvent, maximum_size: int) -> bytearray:
+        """Download (and decrypt) an image of at most `maximum_size` bytes without replying to anyone, e.g. for prefetching. Raises on failure."""
+        encryption_info: EncryptedFile | None = getattr(image_message.content, 'file', None)
+        if encryption_info:
+            if not encryption_info.url:
+                raise ImageRejectedError("encrypted_image_url_missing", "No MXC URL found in encrypted file metadata")
+            return await self._read_encrypted_image(client, encryption_info, encryption_info.url, maximum_size)
+        if not (media_url := getattr(image_message.content, 'url', None)):
+            raise ImageRejectedError("image_missing", "No image URL found in message")
+        return await self._read_media(client, media_url, maximum_size)
+
+    async def _read_media(self, client: MaubotMatrixClient, media_url: ContentURI, maximum_size: int, decryptor: AttachmentDecryptor | None = None) -> bytearray:
+        """Download a file in chunks, aborting with ImageRejectedError as soon as it exceeds `maximum_size` bytes."""
+        image_bytes: bytearray = bytearray()
+        decrypt_seconds: float = 0.0
+        async with self._open_media_response(client, media_url) as response:
+            if response.content_length is not None and response.content_length > maximum_size:
+                raise ImageRejectedError("image_size_exceeded", f"Image size exceeded limit: size={response.content_length:,} bytes, max={maximum_size:,} bytes")
+            async for chunk in response.content.iter_chunked(self.config_snapshot.streaming_chunk_size_bytes):
+                # AES-CTR ciphertext is as long as the plaintext, so the limit applies before decrypting
+                if len(image_bytes) + len(chunk) > maximum_size:
+                    raise ImageRejectedError("image_size_exceeded", f"Image size exceeded limit while downloading: received>{maximum_size:,} bytes")
+                if decryptor:
+                    decrypt_start: float = time.perf_counter()
+                    chunk = decryptor.update(chunk)
+                    decrypt_seconds += time.perf_counter() - decrypt_start
+                image_bytes += chunk
+        if decryptor:
+            # Verify the hash of the ciphertext before the image is used
+            decryptor.verify()
+            # Decryption time of the whole image, the download stage includes it
+            self._observe_stage("decrypt", decrypt_seconds)
+        return image_bytes
+
+    def _create_attachment_decryptor(self, encryption_info: EncryptedFile) -> AttachmentDecryptor:
+        """Create an incremental decryptor from the encrypted file metadata. Raises AttachmentDecryptionError if invalid."""
+        if not encryption_info.key or not encryption_info.iv or "sha256" not in (encryption_info.hashes or {}):
+            raise AttachmentDecryptionError("Incomplete encryption metadata")
+        return AttachmentDecryptor(encryption_info.key.key, encryption_info.iv, encryption_info.hashes["sha256"])
+
+    async def _download_unencrypted_image(self, message_event: MaubotMessageEvent, media_url: ContentURI, image_filename: str, maximum_size: int) -> bytes | None:
+        """Download an unencrypted image of at most `maximum_size` bytes."""
         try:
-            return await message_event.client.download_media(media_url)
+            return await self._read_media(message_event.client, media_url, maximum_size)
+        except ImageRejectedError as rejection:
+            self.log.warning(f"🚫 Image rejected: filename='{image_filename}': {rejection}")
+            await self._respond_with_message(message_event, rejection.message_key)
+            return None
         except Exception as error:
             self.log.error(f"❌📥 Download failed: url={media_url}: {error}")
-            await message_event.respond(self.config["messages"]["image_download_failed"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "image_download_failed")
             return None
 
+    def _should_stream_image(self, target_image_message: MessageEvent) -> bool:
+        """Check if the image can be streamed from the homeserver instead of being downloaded first."""
+        return self.config_snapshot.streaming_enabled
+
+    @asynccontextmanager
+    async def _open_media_response(self, client: MaubotMatrixClient, media_url: ContentURI, headers: dict[str, str] | None = None) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Open a download of a file from the Matrix content repository without reading the body."""
+        authenticated: bool = bool((await client.versions()).supports(SpecVersions.V111))
+        download_url = client.api.get_download_url(media_url, authenticated=authenticated)
+        query_params: dict[str, Any] = {"allow_redirect": "true"}
+        request_headers: dict[str, str] = dict(headers or {})
+        if authenticated:
+            request_headers["Authorization"] = f"Bearer {client.api.token}"
+            if client.api.as_user_id:
+                query_params["user_id"] = client.api.as_user_id
+        async with client.api.session.get(download_url, params=query_params, headers=request_headers) as response:
+            response.raise_for_status()
+            yield response
+
+    @asynccontextmanager
+    async def _open_image_stream(self, message_event: MaubotMessageEvent, target_image_message: MessageEvent, image_filename: str) -> AsyncIterator[ImageStream | None]:
+        """Open a validated (and decrypted if needed) stream of an image. Yields None if the image was rejected."""
+        encryption_info: EncryptedFile | None = getattr(target_image_message.content, 'file', None)
+        media_url: ContentURI | None = encryption_info.url if encryption_info else getattr(target_image_message.content, 'url', None)
+        maximum_allowed_file_size: int = self._get_room_policy(message_event.room_id).maximum_file_size_bytes
+        image_stream: ImageStream | None = None
+        async with AsyncExitStack() as response_stack:
+            try:
+                if not media_url:
+                    raise ImageRejectedError("encrypted_image_url_missing" if encryption_info else "image_missing", "No image URL found in message")
+                decryptor: AttachmentDecryptor | None = self._create_attachment_decryptor(encryption_info) if encryption_info else None
+                response: aiohttp.ClientResponse = await response_stack.enter_async_context(self._open_media_response(message_event.client, media_url))
+                # Reject early if the homeserver already announces a file that is too large
+                if response.content_length is not None and response.content_length > maximum_allowed_file_size:
+                    raise ImageRejectedError("image_size_exceeded", f"Image size exceeded limit: size={response.content_length:,} bytes, max={maximum_allowed_file_size:,} bytes")
+                image_stream = ImageStream(
+                    response.content.iter_chunked(self.config_snapshot.streaming_chunk_size_bytes),
+                    maximum_allowed_file_size,
+                    self.config_snapshot.allowed_image_formats,
+                    decryptor
+                )
+                await image_stream.read_header()
+            except ImageRejectedError as rejection:
+                self.log.warning(f"🚫 Streamed image rejected: filename='{image_filename}': {rejection}")
+                await self._respond_with_message(message_event, rejection.message_key)
+                image_stream = None
+            except AttachmentDecryptionError as error:
+                self.log.error(f"❌🔐 Decryption of file '{image_filename}' failed: {error}")
+                await self._respond_with_message(message_event, "encrypted_image_decrypt_failed")
+                image_stream = None
+            except Exception as error:
+                self.log.error(f"❌📥 Download failed: url={media_url}: {error}")
+                await self._respond_with_message(message_event, "image_download_failed")
+                image_stream = None
+            # The response stays open while the caller consumes the stream
+            yield image_stream
+
     async def _validate_image(self, message_event: MaubotMessageEvent, image_bytes: bytes, image_filename: str) -> str | None:
         """Validate image data, size, and format. Returns the image format if valid, None otherwise."""
         # Validate we have image data
         if not image_bytes:
             self.log.error(f"❌📁 No image bytes found for file: {image_filename}")
-            await message_event.respond(self.config["messages"]["image_download_failed"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "image_download_failed")
             return None
         # Validate file size
         if not await self._validate_image_size(image_bytes, message_event):
@@ -83,32 +332,49 @@ class ImageMixin(MixinHost):
 
     async def _validate_image_size(self, image_bytes: bytes, message_event: MaubotMessageEvent) -> bool:
         """Check if image size is within configured limits."""
-        maximum_allowed_file_size: int = self.config["image"]["maximum_file_size_bytes"]
+        maximum_allowed_file_size: int = self._get_room_policy(message_event.room_id).maximum_file_size_bytes
         actual_image_size: int = len(image_bytes)
         if actual_image_size > maximum_allowed_file_size:
             self.log.warning(f"📏 Image size exceeded limit: size={actual_image_size:,} bytes, max={maximum_allowed_file_size:,} bytes")
-            await message_event.respond(self.config["messages"]["image_size_exceeded"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "image_size_exceeded")
             return False
         return True
 
     async def _validate_image_format(self, image_bytes: bytes, image_filename: str, message_event: MaubotMessageEvent) -> str | None:
         """Validate image format against allowed formats. Returns the image format if valid, None otherwise."""
         try:
-            with Image.open(BytesIO(image_bytes)) as image_object:
-                # Get the image format
-                detected_image_format: str | None = image_object.format
-                if not detected_image_format:
-                    self.log.warning(f"❓ Could not determine image format: filename='{image_filename}', size={len(image_bytes):,} bytes")
-                    await message_event.respond(self.config["messages"]["image_format_invalid"], in_thread=self.config["messages"]["reply_in_thread"])
-                    return None
-                # Check if the format is supported using cached formats
-                supported_image_formats = self._get_cached_supported_image_formats()
-                if detected_image_format.upper() not in supported_image_formats:
-                    self.log.warning(f"🚫 Unsupported image format: format={detected_image_format}, supported_formats={list(supported_image_formats)}, filename='{image_filename}'")
-                    await message_event.respond(self.config["messages"]["image_format_unsupported"], in_thread=self.config["messages"]["reply_in_thread"])
-                    return None
-                return detected_image_format
+            # Parse the image in the worker pool, so large or malicious files can't stall the event loop
+            detected_image_format: str | None = await self._get_worker_pool().run(detect_image_format, image_bytes, self.config_snapshot.deep_verify)
+        except WorkerPoolBusyError as error:
+            self.log.warning(f"⏳ Image format validation refused: filename='{image_filename}': {error}")
+            await self._respond_with_message(message_event, "processing_busy")
+            return None
         except Exception as error:
             self.log.error(f"❌🖼️ Image format validation failed: filename='{image_filename}', size={len(image_bytes):,} bytes: {error}")
-            await message_event.respond(self.config["messages"]["image_format_invalid"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "image_format_invalid")
+            return None
+        # Get the image format
+        if not detected_image_format:
+            self.log.warning(f"❓ Could not determine image format: filename='{image_filename}', size={len(image_bytes):,} bytes")
+            await self._respond_with_message(message_event, "image_format_invalid")
+            return None
+        # Check if the format is supported using cached formats
+        supported_image_formats = self.config_snapshot.allowed_image_formats
+        if detected_image_format.upper() not in supported_image_formats:
+            self.log.warning(f"🚫 Unsupported image format: format={detected_image_format}, supported_formats={list(supported_image_formats)}, filename='{image_filename}'")
+            await self._respond_with_message(message_event, "image_format_unsupported")
             return None
+        return detected_image_format
+
+    async def _compute_perceptual_hash(self, image_bytes: bytes, image_filename: str) -> int | None:
+        """Compute the perceptual hash of a validated image. Returns None if repost detection is disabled or failed."""
+        if self.perceptual_hashes is None:
+            return None
+        try:
+            # Decoding and downscaling the image is CPU-bound, so it runs in the worker pool
+            return await self._get_worker_pool().run(perceptual_hash, image_bytes)
+        except WorkerPoolBusyError as error:
+            self.log.warning(f"⏳ Perceptual hash skipped: filename='{image_filename}': {error}")
+        except Exception as error:
+            self.log.warning(f"⚠️ Failed to compute perceptual hash: filename='{image_filename}': {type(error).__name__}: {error}")
+        return None
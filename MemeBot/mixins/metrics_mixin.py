@@ -0,0 +1,91 @@
+"""
+Metrics mixin for MemeBot.
+Records step latencies and outcomes of promotions and serves them with queue depths and cache hit rates
+in the Prometheus text format.
+"""
+from __future__ import annotations
+
+import hmac
+from aiohttp.web import Request, Response
+from maubot.matrix import MaubotMessageEvent
+from MemeBot.utils import MetricsRegistry
+from .profiling_mixin import event_stage_timings
+from .types import MixinHost
+
+
+class MetricsMixin(MixinHost):
+    """Mixin for metrics collection and exposition."""
+
+    STAGE_METRIC: str = "memebot_stage_duration_seconds"
+    OUTCOME_METRIC: str = "memebot_outcomes_total"
+    METRICS_CONTENT_TYPE: str = "text/plain; version=0.0.4; charset=utf-8"
+
+    def _start_metrics(self) -> MetricsRegistry | None:
+        """Create the metrics registry if metrics are enabled. Metrics start from zero on every start."""
+        self.metrics = None
+        if not self.config["metrics"]["enabled"]:
+            return None
+        metrics = MetricsRegistry(log=self.log)
+        metrics.add_histogram(self.STAGE_METRIC, "Duration of the steps of handling messages and promotions in seconds.", label="stage")
+        metrics.add_counter(self.OUTCOME_METRIC, "Promote commands by outcome: promoted, joined, duplicate_acknowledged or the key of the message replied.", label="outcome")
+        metrics.add_gauge("memebot_queue_depth", "Items waiting in the queues of the bot.", self._collect_queue_depths, label="queue")
+        metrics.add_gauge("memebot_inflight_promotions", "Promotions queued or running.", lambda: len(self.inflight_promotions))
+        metrics.add_gauge("memebot_memory_budget_in_use_bytes", "Image bytes held by promotions and prefetches.", lambda: self.memory_budget.in_use_bytes if self.memory_budget is not None else None)
+        metrics.add_gauge("memebot_cache_hit_ratio", "Share of lookups answered from a cache since the start.", self._collect_cache_hit_ratios, label="cache")
+        metrics.add_gauge("memebot_active_cooldowns", "Cooldowns currently active.", lambda: len(self.cooldown_store) if self.cooldown_store is not None else None)
+        self.metrics = metrics
+        self.log.info(f"📈 Metrics enabled: endpoint=/metrics, protected={bool(self.config['metrics']['access_token'])}")
+        return self.metrics
+
+    def _observe_stage(self, stage: str, duration_seconds: float) -> None:
+        """Record the duration of a step, and add it to the steps of the event being handled for slow event logging."""
+        if self.metrics is not None:
+            self.metrics.observe(self.STAGE_METRIC, duration_seconds, stage)
+        if (stage_timings := event_stage_timings.get()) is not None:
+            stage_timings[stage] = stage_timings.get(stage, 0.0) + duration_seconds
+
+    def _count_outcome(self, outcome: str) -> None:
+        """Count how a promote command ended."""
+        if self.metrics is not None:
+            self.metrics.inc(self.OUTCOME_METRIC, outcome)
+
+    async def _respond_with_message(self, message_event: MaubotMessageEvent, message_key: str) -> None:
+        """Reply with a configured message and count it as the outcome of the command."""
+        self._count_outcome(message_key)
+        await message_event.respond(self.config_snapshot.messages[message_key], in_thread=self.config_snapshot.reply_in_thread)
+
+    def _collect_queue_depths(self) -> dict[str, float]:
+        queue_depths: dict[str, float] = {"prefetch": len(self.prefetch_tasks)}
+        if self.promotion_queue is not None:
+            queue_depths["promotion"] = self.promotion_queue.qsize()
+        if self.worker_pool is not None:
+            queue_depths["worker_pool"] = self.worker_pool.pending_jobs
+        if self.memory_budget is not None:
+            queue_depths["memory_budget"] = self.memory_budget.waiting
+        if self.promotion_outbox is not None:
+            queue_depths["outbox_writes"] = len(self.promotion_outbox)
+        return queue_depths
+
+    def _collect_cache_hit_ratios(self) -> dict[str, float]:
+        cache_hit_ratios: dict[str, float] = {}
+        if self.image_event_cache is not None:
+            cache_hit_ratios["event"] = self.image_event_cache.hit_rate
+        if self.media_cache is not None:
+            media_hits: int = self.media_cache.memory_hits + self.media_cache.disk_hits
+            cache_hit_ratios["media"] = media_hits / (media_hits + self.media_cache.misses) if media_hits + self.media_cache.misses else 0.0
+        if self.promoted_images is not None:
+            dedup_lookups: int = self.promoted_images.hits + self.promoted_images.misses
+            cache_hit_ratios["dedup"] = self.promoted_images.hits / dedup_lookups if dedup_lookups else 0.0
+        if self.prefetch_cache is not None:
+            prefetched: int = self.prefetch_counts["prefetched"]
+            cache_hit_ratios["prefetch"] = self.prefetch_counts["hits"] / prefetched if prefetched else 0.0
+        return cache_hit_ratios
+
+    def _render_metrics(self, request: Request) -> Response:
+        """Answer a scrape of the metrics endpoint, checking the access token if one is configured."""
+        if self.metrics is None:
+            return Response(status=404, text="Metrics are disabled\n")
+        access_token: str = self.config["metrics"]["access_token"]
+        if access_token and not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {access_token}".encode()):
+            return Response(status=401, text="Unauthorized\n")
+        return Response(body=self.metrics.render().encode(), headers={"Content-Type": self.METRICS_CONTENT_TYPE})
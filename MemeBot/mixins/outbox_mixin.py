@@ -0,0 +1,120 @@
+"""
+Promotion outbox mixin for MemeBot.
+Persists accepted promotions in the plugin database until they are done and replays unfinished ones on start.
+"""
+from __future__ import annotations
+
+from typing import Any
+import asyncio
+import json
+import time
+from maubot.matrix import MaubotMessageEvent
+from mautrix.types import EventID, EventType, MediaMessageEventContent, MessageEvent, MessageType, RoomID, TextMessageEventContent, UserID
+from MemeBot.utils import WriteBehindBuffer
+from .types import MixinHost, PromotionJob
+
+
+class OutboxMixin(MixinHost):
+    """Mixin for durable promotion functionality."""
+
+    def _start_promotion_outbox(self) -> None:
+        """Start the outbox write buffer and replay the promotions left over from the last run."""
+        outbox_settings = self.config["outbox"]
+        if not outbox_settings["enabled"]:
+            return
+        self.promotion_outbox = WriteBehindBuffer(
+            "Outbox", self._write_outbox_rows,
+            flush_interval=outbox_settings["flush_interval_seconds"], max_batch_size=outbox_settings["max_batch_size"], log=self.log
+        )
+        self.promotion_outbox.start()
+        self.outbox_replay_task = asyncio.create_task(self._replay_promotion_outbox(started_at=int(time.time() * 1000)))
+
+    async def _stop_outbox_replay(self) -> None:
+        """Stop replaying the last run's promotions. Call before the promotion workers are stopped, so no replayed promotion is queued after them."""
+        if self.outbox_replay_task is not None:
+            self.outbox_replay_task.cancel()
+            await asyncio.gather(self.outbox_replay_task, return_exceptions=True)
+            self.outbox_replay_task = None
+
+    async def _stop_promotion_outbox(self) -> None:
+        """Write the remaining outbox changes. Call after the promotion workers are stopped."""
+        if self.promotion_outbox is not None:
+            await self.promotion_outbox.stop()
+            self.promotion_outbox = None
+
+    def _record_promotion(self, job: PromotionJob) -> None:
+        """Add an accepted promotion to the outbox. The row is written with the next batch."""
+        if self.promotion_outbox is None:
+            return
+        self.promotion_outbox.put(job.message_event.event_id, (
+            job.message_event.event_id, job.message_event.room_id, job.message_event.sender,
+            job.target_image_event_id, job.target_image_message.sender, job.image_filename,
+            json.dumps(job.target_image_message.content.serialize()), int(time.time() * 1000)
+        ))
+
+    def _complete_promotion(self, job: PromotionJob) -> None:
+        """Remove a finished (promoted or failed) promotion from the outbox."""
+        if self.promotion_outbox is None:
+            return
+        # Promotions finishing before their row was written never touch the database
+        if not self.promotion_outbox.discard(job.message_event.event_id):
+            self.promotion_outbox.delete(job.message_event.event_id)
+
+    async def _write_outbox_rows(self, upserts: list[tuple[Any, ...]], deletes: list[EventID]) -> None:
+        """Write a batch of outbox changes in a single transaction."""
+        async with self._database_transaction() as connection:
+            if upserts:
+                await connection.executemany(
+                    "INSERT INTO promotion_outbox (event_id, room_id, sender, target_event_id, target_sender, image_filename, media_content, created_at) "
+                    "VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT (event_id) DO NOTHING",
+                    upserts
+                )
+            if deletes:
+                await connection.executemany("DELETE FROM promotion_outbox WHERE event_id=$1", [(event_id,) for event_id in deletes])
+
+    async def _replay_promotion_outbox(self, started_at: int) -> None:
+        """Queue the promotions that were still in the outbox when the plugin stopped, oldest first."""
+        try:
+            rows = await self.plugin_database.fetch(
+                "SELECT event_id, room_id, sender, target_event_id, target_sender, image_filename, media_content "
+                "FROM promotion_outbox WHERE created_at < $1 ORDER BY created_at",
+                started_at
+            )
+        except Exception as error:
+            self.log.error(f"❌ Failed to load the promotion outbox: {type(error).__name__}: {error}")
+            return
+        if not rows:
+            return
+        self.log.info(f"📮 Replaying {len(rows)} unfinished promotions from the outbox")
+        for row in rows:
+            if not (job := await self._restore_promotion_job(row)):
+                assert self.promotion_outbox is not None
+                self.promotion_outbox.delete(row["event_id"])
+                continue
+            assert self.promotion_queue is not None
+            # Wait for room in the queue instead of refusing the replayed promotion
+            await self.promotion_queue.put(job)
+            self._track_inflight_promotion(job)
+
+    async def _restore_promotion_job(self, row: Any) -> PromotionJob | None:
+        """Rebuild a promotion job from an outbox row. Returns None if the row can't be used anymore."""
+        room_id, event_id = RoomID(row["room_id"]), EventID(row["event_id"])
+        try:
+            content = MediaMessageEventContent.deserialize(json.loads(row["media_content"]))
+        except Exception as error:
+            self.log.error(f"❌ Dropping unreadable outbox entry: message_id={event_id}: {type(error).__name__}: {error}")
+            return None
+        target_image_message = MessageEvent(
+            type=EventType.ROOM_MESSAGE, room_id=room_id, event_id=EventID(row["target_event_id"]),
+            sender=UserID(row["target_sender"]), timestamp=0, content=content
+        )
+        # The command event is only needed to reply to; fetch it to keep replies in the right thread
+        try:
+            command_event: MessageEvent = await self.client.get_event(room_id, event_id)
+        except Exception as error:
+            self.log.warning(f"⚠️ Failed to fetch the command of a replayed promotion, replying without thread information: message_id={event_id}: {error}")
+            command_event = MessageEvent(
+                type=EventType.ROOM_MESSAGE, room_id=room_id, event_id=event_id, sender=UserID(row["sender"]),
+                timestamp=0, content=TextMessageEventContent(msgtype=MessageType.TEXT, body="")
+            )
+        return PromotionJob(MaubotMessageEvent(command_event, self.client), target_image_message, target_image_message.event_id, row["image_filename"])
@@ -0,0 +1,150 @@
+"""
+Prefetch mixin for MemeBot.
+Downloads, validates and hashes freshly posted images in the background (opt-in),
+so a promotion replying to them only needs the cooldown check and the upload.
+"""
+from __future__ import annotations
+
+from typing import Any
+from collections import Counter
+import asyncio
+import time
+from maubot.matrix import MaubotMessageEvent
+from mautrix.types import EventID, MessageType
+from MemeBot.utils import ByteBudget, ImageRejectedError, MediaCache, detect_image_format
+from .types import MixinHost, PrefetchedImage
+
+
+class PrefetchMixin(MixinHost):
+    """Mixin for speculative image prefetching."""
+
+    def _start_prefetch(self) -> MediaCache | None:
+        """Create the cache of prefetched images if prefetching is enabled."""
+        prefetch_settings = self.config["prefetch"]
+        self.prefetched_images = {}
+        self.prefetch_tasks = set()
+        self.prefetch_counts = Counter()
+        if not prefetch_settings["enabled"]:
+            return None
+        self.prefetch_cache = MediaCache(prefetch_settings["memory_budget_bytes"])
+        self.log.info(f"🔮 Prefetching started: max_concurrent={prefetch_settings['max_concurrent']}, memory_budget={prefetch_settings['memory_budget_bytes']:,} bytes, ttl={prefetch_settings['ttl_seconds']}s")
+        return self.prefetch_cache
+
+    async def _stop_prefetch(self) -> None:
+        """Cancel running prefetches, log the hit and waste ratios and drop the prefetched images."""
+        for prefetch_task in self.prefetch_tasks:
+            prefetch_task.cancel()
+        await asyncio.gather(*self.prefetch_tasks, return_exceptions=True)
+        self.prefetch_tasks = set()
+        if self.prefetch_cache is None:
+            return
+        # Images nobody promoted until now were prefetched in vain
+        self.prefetch_counts["wasted"] += len(self.prefetched_images)
+        self.prefetched_images = {}
+        prefetched: int = self.prefetch_counts["prefetched"]
+        self.log.info(
+            f"📊 Prefetching: prefetched={prefetched}, hits={self.prefetch_counts['hits']}, wasted={self.prefetch_counts['wasted']}, "
+            f"hit_ratio={self.prefetch_counts['hits'] / prefetched if prefetched else 0.0:.0%}, waste_ratio={self.prefetch_counts['wasted'] / prefetched if prefetched else 0.0:.0%}, "
+            f"rejected={self.prefetch_counts['rejected']}, failed={self.prefetch_counts['failed']}, skipped={self.prefetch_counts['skipped']}"
+        )
+        self.prefetch_cache.close()
+        self.prefetch_cache = None
+
+    def _prefetch_image(self, message_event: MaubotMessageEvent) -> None:
+        """Start prefetching a freshly posted image in the background, unless too many prefetches are running already."""
+        if self.prefetch_cache is None or message_event.content.msgtype != MessageType.IMAGE or message_event.sender == self.client.mxid:
+            return
+        self._expire_prefetched_images()
+        # Only images with a trusted announced size are prefetched, their download is aborted beyond it
+        announced_size: Any = getattr(getattr(message_event.content, 'info', None), 'size', None)
+        if not self.config_snapshot.trust_event_metadata or not isinstance(announced_size, int) or announced_size <= 0:
+            self.prefetch_counts["skipped"] += 1
+            self.log.debug(f"🔮 Prefetch skipped, no trusted announced size: message_id={message_event.event_id}")
+            return
+        # The cap bounds the memory held by downloads in progress, an image flood is skipped instead of queued
+        if len(self.prefetch_tasks) >= self.config_snapshot.prefetch_max_concurrent:
+            self.prefetch_counts["skipped"] += 1
+            self.log.debug(f"🔮 Prefetch skipped, too many running: message_id={message_event.event_id}, running={len(self.prefetch_tasks)}")
+            return
+        prefetch_task: asyncio.Task[None] = asyncio.create_task(self._run_prefetch(message_event))
+        self.prefetch_tasks.add(prefetch_task)
+        prefetch_task.add_done_callback(self.prefetch_tasks.discard)
+
+    async def _run_prefetch(self, image_event: MaubotMessageEvent) -> None:
+        """Prefetch an image with memory left over by promotions, prefetches never wait for the memory budget."""
+        memory_budget: ByteBudget | None = self.memory_budget
+        memory_size: int = self._get_image_memory_size(image_event)
+        if memory_budget is not None and not memory_budget.try_acquire(memory_size):
+            self.prefetch_counts["skipped"] += 1
+            self.log.debug(f"🔮 Prefetch skipped, memory budget in use: message_id={image_event.event_id}, in_use={memory_budget.in_use_bytes:,} bytes")
+            return
+        try:
+            await self._prefetch_image_data(image_event, memory_size)
+        finally:
+            if memory_budget is not None:
+                memory_budget.release(memory_size)
+
+    async def _prefetch_image_data(self, image_event: MaubotMessageEvent, maximum_size: int) -> None:
+        """
+        Download, validate and hash an image of at most `maximum_size` bytes (its reserved memory) into the prefetch cache.
+        Failures are only logged, nobody asked for the image yet.
+        """
+        image_filename: str = getattr(image_event.content, 'body', '')
+        prefetch_start: float = time.perf_counter()
+        try:
+            # Reject from the metadata first, so oversized or unsupported images are never downloaded
+            self._admit_image_metadata(image_event)
+            # Images larger than announced are aborted as soon as they exceed it
+            image_bytes: bytes = bytes(await self._read_image(image_event.client, image_event, maximum_size))
+            image_format: str | None = await self._get_worker_pool().run(detect_image_format, image_bytes, self.config_snapshot.deep_verify)
+            if not image_format or image_format.upper() not in self.config_snapshot.allowed_image_formats:
+                raise ImageRejectedError("image_format_unsupported", f"Image format not allowed: format={image_format}")
+            image_digest: str | None = await self._compute_image_digest(image_bytes)
+            image_perceptual_hash: int | None = await self._compute_perceptual_hash(image_bytes, image_filename)
+        except ImageRejectedError as rejection:
+            self.prefetch_counts["rejected"] += 1
+            self.log.debug(f"🔮 Prefetched image rejected: message_id={image_event.event_id}: {rejection}")
+            return
+        except Exception as error:
+            self.prefetch_counts["failed"] += 1
+            self.log.debug(f"🔮 Prefetch failed: message_id={image_event.event_id}: {type(error).__name__}: {error}")
+            return
+        # Prefetching was stopped while the image was downloaded
+        if self.prefetch_cache is None:
+            return
+        await self.prefetch_cache.put(image_event.event_id, image_bytes)
+        self.prefetched_images[image_event.event_id] = PrefetchedImage(image_format, image_digest, image_perceptual_hash, time.monotonic())
+        self.prefetch_counts["prefetched"] += 1
+        self.log.debug(f"🔮 Image prefetched: message_id={image_event.event_id}, format={image_format}, size={len(image_bytes):,} bytes, time={time.perf_counter() - prefetch_start:.2f}s")
+
+    def _expire_prefetched_images(self) -> None:
+        """Drop prefetched images older than the TTL, oldest first."""
+        assert self.prefetch_cache is not None
+        prefetched_before: float = time.monotonic() - self.config_snapshot.prefetch_ttl_seconds
+        while self.prefetched_images:
+            event_id, prefetched_image = next(iter(self.prefetched_images.items()))
+            if prefetched_image.prefetched_at > prefetched_before:
+                break
+            del self.prefetched_images[event_id]
+            self.prefetch_cache.discard(event_id)
+            self.prefetch_counts["wasted"] += 1
+
+    def _is_image_prefetched(self, event_id: EventID) -> bool:
+        """Check if an image was prefetched, so it needs neither admission nor validation."""
+        return event_id in self.prefetched_images
+
+    async def _take_prefetched_image(self, event_id: EventID) -> tuple[bytes, PrefetchedImage] | None:
+        """Remove a prefetched image from the cache and return its data and validation results, if still available."""
+        if self.prefetch_cache is None:
+            return None
+        self._expire_prefetched_images()
+        if (prefetched_image := self.prefetched_images.pop(event_id, None)) is None:
+            return None
+        image_bytes: bytes | None = await self.prefetch_cache.get(event_id)
+        self.prefetch_cache.discard(event_id)
+        # Pushed out of the byte budget by newer images
+        if image_bytes is None:
+            self.prefetch_counts["wasted"] += 1
+            return None
+        self.prefetch_counts["hits"] += 1
+        return image_bytes, prefetched_image
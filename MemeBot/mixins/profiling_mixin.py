@@ -0,0 +1,135 @@
+"""
+Profiling mixin for MemeBot.
+Profiles message handling for a number of events or seconds when switched on by config or admin command,
+and logs events slower than a threshold with the time spent in each step.
+"""
+from __future__ import annotations
+
+from contextvars import ContextVar, Token
+from pathlib import Path
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+from .types import MixinHost
+
+# Step durations of the event being handled, filled by _observe_stage (None outside of timed events)
+event_stage_timings: ContextVar[dict[str, float] | None] = ContextVar("event_stage_timings", default=None)
+
+
+class ProfilingMixin(MixinHost):
+    """Mixin for runtime profiling and slow event logging."""
+
+    def _start_profiling(self) -> None:
+        """Open a profiling window if profiling is switched on in the config and none is open yet."""
+        profiling_settings = self.config["profiling"]
+        if profiling_settings["enabled"] and self.profiler is None:
+            self.log.info(f"🔬 {self._start_profiler(profiling_settings['max_events'], profiling_settings['max_seconds'])}")
+
+    async def _stop_profiling(self) -> None:
+        """Close an open profiling window and report it."""
+        if profiler := self._disable_profiler():
+            await self._report_profile(profiler, "plugin stopped")
+        if self.profile_report_task is not None:
+            await asyncio.gather(self.profile_report_task, return_exceptions=True)
+            self.profile_report_task = None
+
+    def _begin_event_timing(self) -> Token[dict[str, float] | None]:
+        """Start collecting the step durations of an event."""
+        return event_stage_timings.set({})
+
+    def _finish_event_timing(self, event_kind: str, event_id: str, event_start: float, stage_timings_token: Token[dict[str, float] | None]) -> None:
+        """Log the event if it was slow and count it towards the profiling window."""
+        event_duration: float = time.perf_counter() - event_start
+        stage_timings: dict[str, float] | None = event_stage_timings.get()
+        event_stage_timings.reset(stage_timings_token)
+        if event_duration >= self.config_snapshot.slow_event_threshold_seconds:
+            stage_breakdown: str = ", ".join(f"{stage}={duration:.3f}s" for stage, duration in (stage_timings or {}).items())
+            self.log.warning(f"🐌 Slow {event_kind}: message_id={event_id}, total={event_duration:.3f}s, stages=[{stage_breakdown}]")
+        if self.profiler is not None and event_kind == "message":
+            self.profiler_events_left -= 1
+            if self.profiler_events_left <= 0 and (profiler := self._disable_profiler()):
+                self.profile_report_task = asyncio.create_task(self._report_profile(profiler, "event limit reached"))
+
+    def _start_profiler(self, max_events: int, max_seconds: float) -> str:
+        """Profile everything running on the event loop until `max_events` messages were handled or `max_seconds` passed."""
+        if self.profiler is not None:
+            return f"Profiling is already running: events_left={self.profiler_events_left}"
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as error:
+            # Only one profiler can run per thread, e.g. another plugin instance may be profiling
+            return f"Profiling could not be started: {error}"
+        self.profiler = profiler
+        self.profiler_events_left = max_events
+        self.profiler_started_at = time.monotonic()
+        self.profiler_timer = asyncio.create_task(self._stop_profiler_later(max_seconds))
+        return f"Profiling started: max_events={max_events}, max_seconds={max_seconds}"
+
+    async def _stop_profiler_later(self, max_seconds: float) -> None:
+        await asyncio.sleep(max_seconds)
+        # Cleared first, so closing the window doesn't cancel this task while it reports
+        self.profiler_timer = None
+        if profiler := self._disable_profiler():
+            await self._report_profile(profiler, "time limit reached")
+
+    def _disable_profiler(self) -> cProfile.Profile | None:
+        """Close the profiling window. Returns the profiler to report, None if no window was open."""
+        if (profiler := self.profiler) is None:
+            return None
+        profiler.disable()
+        self.profiler = None
+        if self.profiler_timer is not None:
+            self.profiler_timer.cancel()
+            self.profiler_timer = None
+        return profiler
+
+    async def _report_profile(self, profiler: cProfile.Profile, reason: str) -> str:
+        """Log the functions with the highest cumulative time and write the stats to the output directory if configured."""
+        profiling_settings = self.config["profiling"]
+        profiled_seconds: float = time.monotonic() - self.profiler_started_at
+        report_stream = io.StringIO()
+        profile_stats = pstats.Stats(profiler, stream=report_stream)
+        profile_stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(profiling_settings["top_functions"])
+        summary: str = f"Profile finished ({reason}): duration={profiled_seconds:.1f}s, function_calls={profile_stats.total_calls:,}"  # type: ignore[attr-defined]
+        if output_directory := profiling_settings["output_directory"]:
+            profile_path: Path = Path(output_directory) / f"memebot-profile-{time.strftime('%Y%m%d-%H%M%S')}.pstats"
+            try:
+                await asyncio.to_thread(self._write_profile, profile_stats, profile_path)
+                summary += f", file={profile_path}"
+            except OSError as error:
+                self.log.error(f"❌ Failed to write the profile: path={profile_path}: {error}")
+        self.log.info(f"🔬 {summary}\n{report_stream.getvalue()}")
+        return summary
+
+    @staticmethod
+    def _write_profile(profile_stats: pstats.Stats, profile_path: Path) -> None:
+        profile_path.parent.mkdir(parents=True, exist_ok=True)
+        profile_stats.dump_stats(profile_path)
+
+    async def _run_profile_command(self, arguments: tuple[str, ...]) -> str:
+        """Handle `profile start [events N] [seconds N]`, `profile stop` and `profile status`. Returns the reply."""
+        profiling_settings = self.config["profiling"]
+        match arguments:
+            case ("start", *options):
+                limits: dict[str, str] = dict(zip(options[::2], options[1::2]))
+                try:
+                    max_events: int = int(limits.get("events", profiling_settings["max_events"]))
+                    max_seconds: float = float(limits.get("seconds", profiling_settings["max_seconds"]))
+                except ValueError:
+                    return "Usage: profile start [events N] [seconds N]"
+                if max_events <= 0 or max_seconds <= 0:
+                    return "Profiling limits must be positive"
+                return self._start_profiler(max_events, max_seconds)
+            case ("stop",):
+                if not (profiler := self._disable_profiler()):
+                    return "Profiling is not running"
+                return await self._report_profile(profiler, "stopped by admin command")
+            case ("status",) | ():
+                if self.profiler is None:
+                    return f"Profiling is not running, slow event threshold={self.config_snapshot.slow_event_threshold_seconds}s"
+                return f"Profiling is running: duration={time.monotonic() - self.profiler_started_at:.1f}s, events_left={self.profiler_events_left}"
+            case _:
+                return "Usage: profile start [events N] [seconds N] | profile stop | profile status"
@@ -0,0 +1,167 @@
+"""
+Promotion queue mixin for MemeBot.
+Handles the bounded background queue, the workers that process accepted promotions,
+the coalescing of concurrent promotions of the same image and the budget of image memory they hold.
+"""
+from __future__ import annotations
+
+from typing import AsyncIterator
+from contextlib import asynccontextmanager
+import asyncio
+import time
+from maubot.matrix import MaubotMessageEvent
+from mautrix.types import EventID
+from MemeBot.utils import ByteBudget
+from .types import CooldownReservation, MixinHost, PromotionJob
+
+
+class QueueMixin(MixinHost):
+    """Mixin for background promotion processing functionality."""
+
+    MAX_PROMOTION_FOLLOWERS: int = 10  # Followers answered when a promotion fails, later requests share its result silently
+
+    def _start_promotion_workers(self) -> None:
+        """Create the promotion queue and the worker tasks consuming it."""
+        queue_settings = self.config["queue"]
+        self.promotion_queue = asyncio.Queue(maxsize=queue_settings["max_size"])
+        self.inflight_promotions = {}
+        self.joined_promotions = 0
+        self.promotion_workers = [
+            asyncio.create_task(self._run_promotion_worker(worker_number))
+            for worker_number in range(1, queue_settings["workers"] + 1)
+        ]
+        self.log.info(f"👷 Promotion workers started: workers={queue_settings['workers']}, max_queue_size={queue_settings['max_size']}")
+
+    async def _stop_promotion_workers(self) -> None:
+        """Cancel the worker tasks. Promotions still waiting in the queue are dropped unless the outbox keeps them."""
+        for worker in self.promotion_workers:
+            worker.cancel()
+        await asyncio.gather(*self.promotion_workers, return_exceptions=True)
+        self.promotion_workers = []
+        self.inflight_promotions = {}
+        self.log.info(f"📊 Promotion workers stopped: joined_promotions={self.joined_promotions}")
+        if self.promotion_queue is not None and not self.promotion_queue.empty():
+            if self.promotion_outbox is not None:
+                self.log.info(f"📮 {self.promotion_queue.qsize()} queued promotions stay in the outbox and are replayed on the next start")
+            else:
+                self.log.warning(f"⚠️ Dropped {self.promotion_queue.qsize()} queued promotions on shutdown")
+        self.promotion_queue = None
+
+    def _enqueue_promotion(self, job: PromotionJob) -> bool:
+        """Add a promotion to the queue. Returns False if the queue is full, raises RuntimeError if the workers are not running."""
+        if self.promotion_queue is None:
+            raise RuntimeError("Promotion workers are not running")
+        try:
+            self.promotion_queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.log.warning(f"🚦 Promotion queue is full: size={self.promotion_queue.qsize()}, user={job.message_event.sender}")
+            return False
+        self._track_inflight_promotion(job)
+        self.log.info(f"📥 Promotion queued: message_id={job.target_image_event_id}, queue_size={self.promotion_queue.qsize()}")
+        return True
+
+    async def _run_promotion_worker(self, worker_number: int) -> None:
+        """Process queued promotions one after another until cancelled."""
+        assert self.promotion_queue is not None
+        promotion_queue: asyncio.Queue[PromotionJob] = self.promotion_queue
+        while True:
+            job: PromotionJob = await promotion_queue.get()
+            try:
+                queue_wait: float = time.monotonic() - job.enqueued_at
+                self._observe_stage("queue_wait", queue_wait)
+                self.log.info(f"👷 Worker {worker_number} processing promotion: message_id={job.target_image_event_id}, queue_wait={queue_wait:.2f}s")
+                await self._process_promotion_job(job)
+            except Exception as error:
+                self.log.exception(f"❌ Worker {worker_number} failed to process promotion: message_id={job.target_image_event_id}: {error}")
+            finally:
+                promotion_queue.task_done()
+            # Not reached when the worker is cancelled on shutdown, so interrupted promotions stay in the outbox
+            self._complete_promotion(job)
+
+    def _track_inflight_promotion(self, job: PromotionJob) -> None:
+        """Make a queued promotion joinable by later requests for the same image."""
+        self.inflight_promotions.setdefault(job.target_image_event_id, job)
+
+    def _finish_inflight_promotion(self, job: PromotionJob) -> None:
+        """Stop accepting followers for a promotion once its result is known."""
+        if self.inflight_promotions.get(job.target_image_event_id) is job:
+            del self.inflight_promotions[job.target_image_event_id]
+
+    def _join_inflight_promotion(self, message_event: MaubotMessageEvent, target_image_event_id: EventID, cooldown_reservation: CooldownReservation) -> bool:
+        """
+        Attach a request to the queued or running promotion of the same image, its cooldowns are settled with the result
+        of that promotion. Returns False if there is none.
+        """
+        if (job := self.inflight_promotions.get(target_image_event_id)) is None:
+            return False
+        # Repeated requests of a user and requests beyond the limit share the result without an answer of their own
+        if (message_event.sender == job.message_event.sender or message_event.sender in job.followers
+                or len(job.followers) >= self.MAX_PROMOTION_FOLLOWERS):
+            self._release_cooldowns(cooldown_reservation)
+        else:
+            job.followers[message_event.sender] = message_event
+            job.follower_reservations.append(cooldown_reservation)
+        self.joined_promotions += 1
+        self._count_outcome("joined")
+        self.log.info(f"🔗 Promotion joined the one in progress: message_id={target_image_event_id}, user={message_event.sender}, followers={len(job.followers)}")
+        return True
+
+    async def _notify_promotion_followers(self, job: PromotionJob, promotion_outcome: str | None) -> None:
+        """
+        Give the followers of a promotion the answer it got: nothing for a promoted or acknowledged duplicate image,
+        which they see as the reaction on the image, the same message for a duplicate, a repost or a full memory budget,
+        and joined_promotion_failed if it failed otherwise.
+        """
+        if promotion_outcome in ("promoted", "duplicate_acknowledged") or not job.followers:
+            return
+        message_key: str = promotion_outcome or "joined_promotion_failed"
+        for follower_event in job.followers.values():
+            try:
+                await self._respond_with_message(follower_event, message_key)
+            except Exception as error:
+                self.log.error(f"❌ Failed to notify a joined request: message_id={job.target_image_event_id}, user={follower_event.sender}: {error}")
+
+    def _start_memory_budget(self) -> ByteBudget | None:
+        """Create the budget of image bytes held by promotions at the same time, if it is enabled."""
+        memory_budget_settings = self.config["memory_budget"]
+        if memory_budget_settings["enabled"]:
+            self.memory_budget = ByteBudget(memory_budget_settings["max_inflight_bytes"])
+            self.log.info(f"🧠 Memory budget started: max_inflight={memory_budget_settings['max_inflight_bytes']:,} bytes, wait_timeout={memory_budget_settings['wait_timeout_seconds']}s")
+        return self.memory_budget
+
+    def _stop_memory_budget(self) -> None:
+        """Log the memory budget statistics and drop it."""
+        if self.memory_budget is not None:
+            self.log.info(
+                f"📊 Memory budget: peak={self.memory_budget.peak_bytes:,} bytes, in_use={self.memory_budget.in_use_bytes:,} bytes, "
+                f"acquired={self.memory_budget.acquired}, waited={self.memory_budget.waited}, timeouts={self.memory_budget.timeouts}"
+            )
+            self.memory_budget = None
+
+    @asynccontextmanager
+    async def _reserve_promotion_memory(self, job: PromotionJob, streamed: bool) -> AsyncIterator[int | None]:
+        """
+        Hold the memory of a promotion from before its download until its upload finished. Yields the bytes the
+        download may read (the reserved size if buffered, the room's size limit if streamed or without a budget),
+        None if the budget had no room for it within the wait timeout, after telling the user.
+        """
+        maximum_allowed_file_size: int = self._get_room_policy(job.target_image_message.room_id).maximum_file_size_bytes
+        if (memory_budget := self.memory_budget) is None:
+            yield maximum_allowed_file_size
+            return
+        # Streamed images are held one chunk at a time
+        memory_size: int = self._get_image_memory_size(job.target_image_message)
+        if streamed:
+            memory_size = min(memory_size, self.config_snapshot.streaming_chunk_size_bytes)
+        if not memory_budget.try_acquire(memory_size):
+            self.log.info(f"🧠 Waiting for the memory budget: message_id={job.target_image_event_id}, size={memory_size:,} bytes, in_use={memory_budget.in_use_bytes:,} bytes, waiting={memory_budget.waiting}")
+            if not await memory_budget.acquire(memory_size, self.config_snapshot.memory_budget_wait_timeout_seconds):
+                self.log.warning(f"🧠 Memory budget exhausted, promotion refused: message_id={job.target_image_event_id}, size={memory_size:,} bytes, in_use={memory_budget.in_use_bytes:,} bytes")
+                await self._respond_with_message(job.message_event, "memory_budget_exceeded")
+                yield None
+                return
+        try:
+            # A buffered image larger than it announced is aborted once it outgrows its reservation
+            yield maximum_allowed_file_size if streamed else memory_size
+        finally:
+            memory_budget.release(memory_size)
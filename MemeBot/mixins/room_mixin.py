@@ -0,0 +1,53 @@
+"""
+Room settings mixin for MemeBot.
+Resolves the allowlist and the room-specific commands, cooldowns, size limit and promotion server.
+"""
+from __future__ import annotations
+
+from typing import Any
+import re
+from mautrix.types import RoomID
+from .types import MixinHost, RoomPolicy
+
+
+class RoomMixin(MixinHost):
+    """Mixin for room-specific settings."""
+
+    def _build_room_policies(self) -> RoomPolicy:
+        """Precompute the settings of every room from the config, so they are resolved with one lookup per event."""
+        room_settings = self.config["rooms"]
+        self.room_allowlist = frozenset(room_settings["allowlist"]) if room_settings["allowlist"] else None
+        self.default_room_policy = self._build_room_policy({})
+        self.room_policies = {RoomID(room_id): self._build_room_policy(overrides) for room_id, overrides in room_settings["overrides"].items()}
+        self.log.info(f"🏠 Room settings: allowlist={len(self.room_allowlist) if self.room_allowlist is not None else 'all'}, overrides={len(self.room_policies)}")
+        return self.default_room_policy
+
+    def _build_room_policy(self, overrides: dict[str, Any]) -> RoomPolicy:
+        """Merge room-specific overrides into the global settings."""
+        cooldown_overrides: dict[str, Any] = overrides.get("cooldowns", {})
+        cooldown_settings: dict[str, Any] = {
+            **self.config["cooldowns"], **cooldown_overrides,
+            "burst": {**self.config["cooldowns"]["burst"], **cooldown_overrides.get("burst", {})}
+        }
+        # Ensure server URL has protocol
+        promotion_server: str = overrides.get("server_url", self.config["promotion"]["server_url"])
+        if not promotion_server.startswith(("http://", "https://")):
+            promotion_server = f"http://{promotion_server}"
+        # Longest commands first, so a command is never cut short by another one it starts with
+        commands: tuple[str, ...] = tuple(sorted({command.lower() for command in overrides.get("commands", self.config["commands"])}, key=len, reverse=True))
+        return RoomPolicy(
+            commands=commands,
+            command_pattern=re.compile(rf"(?:{'|'.join(map(re.escape, commands))})(?=\s|$)", re.IGNORECASE),
+            command_initials=frozenset(initial for command in commands for initial in (command[0], command[0].upper())),
+            cooldown_policies=self._build_cooldown_policies(cooldown_settings),
+            maximum_file_size_bytes=overrides.get("maximum_file_size_bytes", self.config["image"]["maximum_file_size_bytes"]),
+            server_url=promotion_server
+        )
+
+    def _get_room_policy(self, room_id: RoomID) -> RoomPolicy:
+        """Return the settings of a room (built whenever a valid config is loaded)."""
+        return self.room_policies.get(room_id, self.default_room_policy)
+
+    def _is_room_allowed(self, room_id: RoomID) -> bool:
+        """Check if the bot works in a room."""
+        return self.room_allowlist is None or room_id in self.room_allowlist
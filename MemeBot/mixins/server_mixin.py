@@ -4,76 +4,162 @@ Handles image upload and server interactions.
 """
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import time
 import random
 import aiohttp
 from maubot.matrix import MaubotMessageEvent
 from mautrix.types import EventID
+from MemeBot.utils import CircuitBreaker, ImageStream
 from .types import MixinHost
 
 
 class ServerMixin(MixinHost):
     """Mixin for server communication functionality."""
 
-    async def _promote_image(self, message_event: MaubotMessageEvent, target_image_event_id: EventID, image_filename: str, image_data: bytes) -> bool:
-        """Upload image to promotion server and handle response."""
-        # Ensure server URL has protocol
-        promotion_server: str = self.config["promotion"]["server_url"]
-        if not promotion_server.startswith(("http://", "https://")):
-            promotion_server = f"http://{promotion_server}"
+    async def _promote_image(self, message_event: MaubotMessageEvent, target_image_event_id: EventID, image_filename: str, image_data: bytes | ImageStream) -> bool:
+        """Upload image (buffered or streamed) to promotion server and handle response."""
+        # Promotion server of the room, including the protocol
+        promotion_server: str = self._get_room_policy(message_event.room_id).server_url
+        # The idempotency key lets the server recognize retries of the same promotion
+        idempotency_key: str = hashlib.sha256(target_image_event_id.encode()).hexdigest()
         # POST image to the configured server
-        if await self._upload_image_to_server(image_data, image_filename, promotion_server):
+        upload_start: float = time.perf_counter()
+        uploaded: bool = await self._upload_image_to_server(image_data, image_filename, promotion_server, idempotency_key)
+        self._observe_stage("upload", time.perf_counter() - upload_start)
+        if uploaded:
+            reaction_start: float = time.perf_counter()
             await self._add_success_reaction(message_event, target_image_event_id)
+            self._observe_stage("reaction", time.perf_counter() - reaction_start)
             return True
+        # A streamed image that failed validation mid-transfer aborts the upload with its own message
+        elif isinstance(image_data, ImageStream) and image_data.error:
+            await self._respond_with_message(message_event, image_data.error.message_key)
+            return False
         else:
-            await message_event.respond(self.config["messages"]["promotion_server_error"], in_thread=self.config["messages"]["reply_in_thread"])
+            await self._respond_with_message(message_event, "promotion_server_error")
             return False
 
-    async def _upload_image_to_server(self, image_data: bytes, image_filename: str, promotion_server: str) -> bool:
-        """POST image to the promotion server via HTTP form upload."""
-        try:
-            # Prepare headers with API token
-            headers = {
-                'Authorization': f'Bearer {self.config["promotion"]["api_token"]}'
-            }
+    def _open_promotion_session(self) -> aiohttp.ClientSession:
+        """Create the long-lived HTTP session with a pooled connector for promotion uploads."""
+        http_settings = self.config["promotion"]["http"]
+        connector = aiohttp.TCPConnector(
+            limit=http_settings["connection_limit"],
+            limit_per_host=http_settings["connection_limit_per_host"],
+            keepalive_timeout=http_settings["keepalive_timeout_seconds"],
+            ttl_dns_cache=http_settings["dns_cache_ttl_seconds"] or None,
+            use_dns_cache=http_settings["dns_cache_ttl_seconds"] > 0,
+        )
+        timeout = aiohttp.ClientTimeout(
+            connect=http_settings["connect_timeout_seconds"],
+            sock_read=http_settings["read_timeout_seconds"],
+        )
+        self.promotion_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.log.info(f"🔌 Promotion HTTP session opened: limit={http_settings['connection_limit']}, limit_per_host={http_settings['connection_limit_per_host']}, keepalive={http_settings['keepalive_timeout_seconds']}s")
+        return self.promotion_session
+
+    def _get_promotion_session(self) -> aiohttp.ClientSession:
+        """Return the shared promotion session. Raises RuntimeError if it is not open."""
+        if self.promotion_session is None or self.promotion_session.closed:
+            raise RuntimeError("Promotion session is not open")
+        return self.promotion_session
+
+    async def _close_promotion_session(self) -> None:
+        """Close the shared promotion session and all pooled connections."""
+        if self.promotion_session is not None and not self.promotion_session.closed:
+            await self.promotion_session.close()
+            self.log.info(f"🔌 Promotion HTTP session closed")
+        self.promotion_session = None
+
+    def _get_circuit_breaker(self, promotion_server: str) -> CircuitBreaker:
+        """Return the circuit breaker tracking the health of a promotion server."""
+        if not (circuit_breaker := self.promotion_circuit_breakers.get(promotion_server)):
+            circuit_breaker = CircuitBreaker(self.config_snapshot.circuit_breaker_failure_threshold, self.config_snapshot.circuit_breaker_recovery_timeout_seconds)
+            self.promotion_circuit_breakers[promotion_server] = circuit_breaker
+        return circuit_breaker
+
+    async def _upload_image_to_server(self, image_data: bytes | ImageStream, image_filename: str, promotion_server: str, idempotency_key: str) -> bool:
+        """Upload the image, retrying transient failures with jittered exponential backoff."""
+        max_attempts: int = self.config_snapshot.retry_max_attempts
+        circuit_breaker: CircuitBreaker = self._get_circuit_breaker(promotion_server)
+        for attempt in range(1, max_attempts + 1):
+            # Fail fast while the server is known to be down
+            if not circuit_breaker.allow_request():
+                self.log.warning(f"⚡ Circuit breaker open, upload skipped: server={promotion_server}, retry_after={circuit_breaker.retry_after():.1f}s")
+                return False
+            try:
+                response_status: int = await self._post_image_to_server(image_data, image_filename, promotion_server, idempotency_key)
+                # 5xx and rate limiting are worth retrying, other client errors are not
+                transient_failure: bool = response_status >= 500 or response_status == 429
+            except asyncio.CancelledError:
+                # E.g. on shutdown, a cancelled probe must not leave the circuit half-open for good
+                circuit_breaker.record_cancellation()
+                raise
+            except Exception as error:
+                # A streamed image that failed validation aborted the upload itself
+                if isinstance(image_data, ImageStream) and image_data.error:
+                    self.log.warning(f"🚫 Upload aborted: filename='{image_filename}', server={promotion_server}: {image_data.error}")
+                    circuit_breaker.record_success()
+                    return False
+                self.log.error(f"❌🌐 Upload error: filename='{image_filename}', server={promotion_server}, attempt={attempt}: {type(error).__name__}: {error}")
+                response_status, transient_failure = 0, True
+            if response_status == 200:
+                circuit_breaker.record_success()
+                return True
+            if not transient_failure:
+                circuit_breaker.record_success()
+                return False
+            circuit_breaker.record_failure()
+            # A streamed body can't be sent again once it was read, and an open circuit would skip the retry anyway
+            if attempt == max_attempts or (isinstance(image_data, ImageStream) and image_data.started) or circuit_breaker.state == CircuitBreaker.OPEN:
+                return False
+            retry_delay: float = random.uniform(0, min(self.config_snapshot.retry_max_delay_seconds, self.config_snapshot.retry_base_delay_seconds * 2 ** (attempt - 1)))
+            self.log.info(f"🔁 Retrying upload in {retry_delay:.2f}s: server={promotion_server}, attempt={attempt + 1}/{max_attempts}")
+            await asyncio.sleep(retry_delay)
+        return False
+
+    async def _post_image_to_server(self, image_data: bytes | ImageStream, image_filename: str, promotion_server: str, idempotency_key: str) -> int:
+        """POST image to the promotion server via HTTP form upload. Streamed images are sent as a chunked body. Returns the response status."""
+        # Prepare headers with API token and idempotency key
+        headers = {
+            'Authorization': f'Bearer {self.config_snapshot.api_token}',
+            'Idempotency-Key': idempotency_key
+        }
+        # Create the data payload for the POST request
+        form_data: aiohttp.FormData = aiohttp.FormData()
+        form_data.add_field('image', 
+                        image_data,
+                        filename=image_filename,
+                        content_type='application/octet-stream')
+        # Send the POST request to the promotion server over the pooled session
+        upload_start_time = time.time()
+        async with self._get_promotion_session().post(promotion_server, data=form_data, headers=headers) as response:
+            upload_time = time.time() - upload_start_time
             
-            async with aiohttp.ClientSession(headers=headers) as session:
-                # Create the data payload for the POST request
-                form_data: aiohttp.FormData = aiohttp.FormData()
-                form_data.add_field('image', 
-                                image_data,
-                                filename=image_filename,
-                                content_type='application/octet-stream')
-                # Send the POST request to the promotion server
-                upload_start_time = time.time()
-                async with session.post(promotion_server, data=form_data) as response:
-                    upload_time = time.time() - upload_start_time
-                    
-                    if response.status == 200:
-                        self.log.info(f"🚀 Upload successful: server={promotion_server}, upload_time={upload_time:.2f}s, response_status={response.status}")
-                        return True
-                    else:
-                        response_body = await response.text() if response.content_length and response.content_length < 1000 else "Response too large to log"
-                        self.log.error(f"❌🌐 Upload failed: server={promotion_server}, upload_time={upload_time:.2f}s, status={response.status}, response='{response_body[:200]}'")
-                        return False
-        except Exception as error:
-            self.log.error(f"❌🌐 Upload error: filename='{image_filename}', server={promotion_server}: {error}")
-            return False
+            if response.status == 200:
+                if isinstance(image_data, ImageStream):
+                    self.log.info(f"🖼️ Streamed a valid image: filename='{image_filename}', format={image_data.image_format}, size={image_data.size:,} bytes")
+                self.log.info(f"🚀 Upload successful: server={promotion_server}, upload_time={upload_time:.2f}s, response_status={response.status}")
+            else:
+                response_body = await response.text() if response.content_length and response.content_length < 1000 else "Response too large to log"
+                self.log.error(f"❌🌐 Upload failed: server={promotion_server}, upload_time={upload_time:.2f}s, status={response.status}, response='{response_body[:200]}'")
+            return response.status
 
     async def _add_success_reaction(self, message_event: MaubotMessageEvent, target_image_event_id: EventID) -> None:
         """Add a random success emoji reaction to the promoted image, or rarely send a special message."""
         try:
             # Easter egg: Check if we should send a rare special message instead of a reaction
-            rare_probability: float = self.config["messages"]["easter_eggs"]["rare_message_probability"]
+            rare_probability: float = self.config_snapshot.rare_message_probability
             if random.random() < rare_probability:
                 # Send a special easter egg message instead of a reaction
-                rare_messages: list[str] = self.config["messages"]["easter_eggs"]["rare_messages"]
+                rare_messages: tuple[str, ...] = self.config_snapshot.rare_messages
                 special_message: str = random.choice(rare_messages)
                 await message_event.respond(special_message)
                 self.log.info(f"🎉 Easter egg triggered! Sent rare message instead of reaction")
             else:
                 # Normal behavior: add a random emoji reaction
-                available_emoji_options: list[str] = self.config["messages"]["success_reaction_emojis"]
+                available_emoji_options: tuple[str, ...] = self.config_snapshot.success_reaction_emojis
                 randomly_selected_emoji: str = random.choice(available_emoji_options)
                 # Add the reaction to the replied message
                 await message_event.client.react(message_event.room_id, target_image_event_id, randomly_selected_emoji)
@@ -4,9 +4,81 @@ Defines the protocols that mixins expect from the main class.
 """
 from __future__ import annotations
 
+from typing import TYPE_CHECKING, Any, AsyncContextManager, AsyncIterator, cast
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from logging import Logger
-from maubot.matrix import MaubotMatrixClient
-from MemeBot.config import Config
+import asyncio
+import cProfile
+import re
+import time
+import tracemalloc
+import aiohttp
+from maubot.matrix import MaubotMatrixClient, MaubotMessageEvent
+from mautrix.types import MessageEvent, EventID, RoomID, UserID
+from mautrix.util.async_db import Connection, Database
+from MemeBot.config import Config, ConfigSnapshot
+from MemeBot.utils import (
+    ByteBudget, CircuitBreaker, CooldownKey, CooldownPolicy, CooldownStore, MediaCache, MetricsRegistry, MultiIndexHashTable, PromotedImageIndex, PromotedImageKey, RecentEventCache,
+    WorkerPool, WriteBehindBuffer
+)
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine.base import Engine
+
+
+@dataclass(frozen=True)
+class CooldownReservation:
+    """Cooldowns taken by a promotion that is not done yet, kept if it succeeds and given back otherwise."""
+    
+    cooldowns: tuple[tuple[CooldownKey, CooldownPolicy, float], ...]  # Cooldown key, the policy it was taken with and the state it set
+
+
+@dataclass
+class PromotionJob:
+    """A promotion that passed the admission checks and waits to be processed by a worker."""
+    
+    message_event: MaubotMessageEvent
+    target_image_message: MessageEvent
+    target_image_event_id: EventID
+    image_filename: str
+    enqueued_at: float = field(default_factory=time.monotonic)
+    cooldown_reservation: CooldownReservation | None = None  # None for promotions replayed from the outbox
+    followers: dict[UserID, MaubotMessageEvent] = field(default_factory=dict)  # Later requests for the same image by sender, waiting for its result
+    follower_reservations: list[CooldownReservation] = field(default_factory=list)  # Settled with the result of the promotion
+
+
+@dataclass(frozen=True)
+class PrefetchedImage:
+    """Validation results of an image prefetched when it was posted, its data is kept in the prefetch cache."""
+    
+    image_format: str
+    image_digest: str | None  # None if duplicate detection is disabled
+    image_perceptual_hash: int | None  # None if repost detection is disabled
+    prefetched_at: float  # time.monotonic() when the image was ready
+
+
+@dataclass(frozen=True)
+class MessageClassification:
+    """A message that needs handling: a special response, an admin command or a promote command with its arguments."""
+    
+    special_response: str | None = None
+    command: str | None = None
+    arguments: tuple[str, ...] = ()
+    admin: bool = False  # An admin command sent by one of the configured admins
+
+
+@dataclass(frozen=True)
+class RoomPolicy:
+    """Settings of a room: the global settings with the room-specific overrides applied."""
+    
+    commands: tuple[str, ...]  # Lowercase promote commands
+    command_pattern: re.Pattern[str]  # Matches any of the commands (case-insensitive) at the start of a message
+    command_initials: frozenset[str]  # First characters of the commands in both cases, to skip ordinary messages early
+    cooldown_policies: dict[str, CooldownPolicy]  # Cooldown scope -> rate limiting policy
+    maximum_file_size_bytes: int
+    server_url: str  # Promotion server URL including the protocol
 
 
 class MixinHost:
@@ -18,7 +90,132 @@ class MixinHost:
     """
     
     config: Config
+    config_snapshot: ConfigSnapshot
     client: MaubotMatrixClient
     log: Logger
-    next_global_promotion_time: float
-    user_promotion_cooldowns: dict[str, float]
+    database: Engine | Database | None  # As declared by Plugin, see plugin_database
+    cooldown_store: CooldownStore | None
+    cooldown_sweeper: asyncio.Task[None] | None
+    cooldown_writes: WriteBehindBuffer[CooldownKey, tuple[Any, ...]] | None
+    image_event_cache: RecentEventCache[MessageEvent] | None
+    media_cache: MediaCache | None
+    memory_budget: ByteBudget | None
+    metrics: MetricsRegistry | None
+    prefetch_cache: MediaCache | None
+    prefetched_images: dict[EventID, PrefetchedImage]
+    prefetch_tasks: set[asyncio.Task[None]]
+    prefetch_counts: Counter[str]
+    room_allowlist: frozenset[RoomID] | None
+    room_policies: dict[RoomID, RoomPolicy]
+    default_room_policy: RoomPolicy
+    promotion_session: aiohttp.ClientSession | None
+    promotion_circuit_breakers: dict[str, CircuitBreaker]
+    worker_pool: WorkerPool | None
+    promotion_queue: asyncio.Queue[PromotionJob] | None
+    promotion_workers: list[asyncio.Task[None]]
+    inflight_promotions: dict[EventID, PromotionJob]
+    joined_promotions: int
+    promotion_outbox: WriteBehindBuffer[EventID, tuple[Any, ...]] | None
+    outbox_replay_task: asyncio.Task[None] | None
+    promoted_images: PromotedImageIndex | None
+    promoted_image_store: WriteBehindBuffer[PromotedImageKey, tuple[Any, ...]] | None
+    perceptual_hashes: dict[str, MultiIndexHashTable[EventID]] | None
+    perceptual_hash_store: WriteBehindBuffer[tuple[str, int], tuple[Any, ...]] | None
+    profiler: cProfile.Profile | None
+    profiler_events_left: int
+    profiler_started_at: float
+    profiler_timer: asyncio.Task[None] | None
+    profile_report_task: asyncio.Task[str] | None
+    memory_watchdog: asyncio.Task[None] | None
+    memory_snapshot: tracemalloc.Snapshot | None
+    memory_tracing_started: bool
+
+    @property
+    def plugin_database(self) -> Database:
+        """The plugin database, which maubot provides as a mautrix Database for the asyncpg database type in maubot.yaml."""
+        assert isinstance(self.database, Database)
+        return self.database
+
+    @asynccontextmanager
+    async def _database_transaction(self) -> AsyncIterator[Connection]:
+        """Acquire a connection of the plugin database and run a transaction on it."""
+        # mautrix annotates both context managers with the type they yield, so they are cast to what they return
+        connection: Connection
+        async with cast(AsyncContextManager[Connection], self.plugin_database.acquire()) as connection, cast(AsyncContextManager[None], connection.transaction()):
+            yield connection
+
+    async def _process_promotion_job(self, job: PromotionJob) -> None:
+        """Download, validate and promote a queued image. Implemented by the host class."""
+        raise NotImplementedError
+
+    def _complete_promotion(self, job: PromotionJob) -> None:
+        """Remove a finished promotion from the outbox. Implemented by OutboxMixin."""
+        raise NotImplementedError
+
+    def _track_inflight_promotion(self, job: PromotionJob) -> None:
+        """Make a queued promotion joinable by later requests for the same image. Implemented by QueueMixin."""
+        raise NotImplementedError
+
+    def _build_cooldown_policies(self, cooldown_settings: dict[str, Any]) -> dict[str, CooldownPolicy]:
+        """Create the rate limiting policy of each cooldown scope. Implemented by CooldownMixin."""
+        raise NotImplementedError
+
+    def _release_cooldowns(self, cooldown_reservation: CooldownReservation) -> None:
+        """Give back the cooldowns reserved for a promotion that failed or was rejected. Implemented by CooldownMixin."""
+        raise NotImplementedError
+
+    def _get_room_policy(self, room_id: RoomID) -> RoomPolicy:
+        """Return the settings of a room. Implemented by RoomMixin."""
+        raise NotImplementedError
+
+    def _get_worker_pool(self) -> WorkerPool:
+        """Return the worker pool for CPU-bound work. Implemented by ImageMixin."""
+        raise NotImplementedError
+
+    def _get_image_memory_size(self, image_message: MessageEvent) -> int:
+        """Bytes an image may take in memory. Implemented by ImageMixin."""
+        raise NotImplementedError
+
+    def _admit_image_metadata(self, target_image_message: MessageEvent) -> None:
+        """Check the size and mimetype announced in an image event. Implemented by ImageMixin."""
+        raise NotImplementedError
+
+    async def _read_image(self, client: MaubotMatrixClient, image_message: MessageEvent, maximum_size: int) -> bytearray:
+        """Download (and decrypt) an image of at most `maximum_size` bytes without replying to anyone. Implemented by ImageMixin."""
+        raise NotImplementedError
+
+    async def _compute_image_digest(self, image_bytes: bytes) -> str | None:
+        """Hash image data for duplicate detection. Implemented by DedupMixin."""
+        raise NotImplementedError
+
+    async def _compute_perceptual_hash(self, image_bytes: bytes, image_filename: str) -> int | None:
+        """Compute the perceptual hash of an image. Implemented by ImageMixin."""
+        raise NotImplementedError
+
+    def _is_image_prefetched(self, event_id: EventID) -> bool:
+        """Check if an image was prefetched. Implemented by PrefetchMixin."""
+        raise NotImplementedError
+
+    def _observe_stage(self, stage: str, duration_seconds: float) -> None:
+        """Record the duration of a step. Implemented by MetricsMixin."""
+        raise NotImplementedError
+
+    def _count_outcome(self, outcome: str) -> None:
+        """Count how a promote command ended. Implemented by MetricsMixin."""
+        raise NotImplementedError
+
+    async def _respond_with_message(self, message_event: MaubotMessageEvent, message_key: str) -> None:
+        """Reply with a configured message and count it as the outcome. Implemented by MetricsMixin."""
+        raise NotImplementedError
+
+    async def _run_profile_command(self, arguments: tuple[str, ...]) -> str:
+        """Handle the profile admin command and return the reply. Implemented by ProfilingMixin."""
+        raise NotImplementedError
+
+    async def _run_memory_command(self, arguments: tuple[str, ...]) -> str:
+        """Handle the memory admin command and return the reply. Implemented by DiagnosticsMixin."""
+        raise NotImplementedError
+
+    async def _add_success_reaction(self, message_event: MaubotMessageEvent, target_image_event_id: EventID) -> None:
+        """React to a promoted image. Implemented by ServerMixin."""
+        raise NotImplementedError
@@ -0,0 +1,37 @@
+"""
+Helper classes and functions for MemeBot.
+These are independent of the plugin and used by the mixins to implement their functionality.
+"""
+
+from .byte_budget import ByteBudget
+from .circuit_breaker import CircuitBreaker
+from .dedup import PromotedImage, PromotedImageIndex, PromotedImageKey, content_digest
+from .cooldown_policy import CooldownPolicy, FixedWindowPolicy, TokenBucketPolicy
+from .cooldown_store import CooldownKey, CooldownStore
+from .crypto import AttachmentDecryptionError, AttachmentDecryptor, decode_unpadded_base64
+from .event_cache import RecentEventCache
+from .executor import WorkerPool, WorkerPoolBusyError
+from .media import (
+    IMAGE_HEADER_SIZE, ImageRejectedError, ImageStream, detect_image_format, format_from_mimetype, sniff_image_format
+)
+from .media_cache import MediaCache
+from .metrics import MetricsRegistry
+from .phash import PERCEPTUAL_HASH_AVAILABLE, MultiIndexHashTable, perceptual_hash
+from .write_behind import WriteBehindBuffer
+
+__all__ = [
+    'ByteBudget',
+    'CircuitBreaker',
+    'CooldownPolicy', 'FixedWindowPolicy', 'TokenBucketPolicy',
+    'CooldownKey', 'CooldownStore',
+    'PromotedImage', 'PromotedImageIndex', 'PromotedImageKey', 'content_digest',
+    'AttachmentDecryptionError', 'AttachmentDecryptor', 'decode_unpadded_base64',
+    'RecentEventCache',
+    'WorkerPool', 'WorkerPoolBusyError',
+    'IMAGE_HEADER_SIZE', 'ImageRejectedError', 'ImageStream', 'detect_image_format', 'format_from_mimetype',
+    'sniff_image_format',
+    'MediaCache',
+    'MetricsRegistry',
+    'PERCEPTUAL_HASH_AVAILABLE', 'MultiIndexHashTable', 'perceptual_hash',
+    'WriteBehindBuffer'
+]
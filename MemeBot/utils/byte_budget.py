@@ -0,0 +1,100 @@
+"""
+Byte budget for MemeBot.
+Limits the image data held by promotions at the same time with a byte-weighted semaphore.
+"""
+from __future__ import annotations
+
+from collections import deque
+import asyncio
+
+
+class ByteBudget:
+    """
+    Async semaphore weighted in bytes.
+
+    `acquire` takes `size` bytes of the capacity, waiting in FIFO order until enough is released, so a large
+    request is not starved by small ones. A request larger than the whole capacity waits until nothing else is
+    held and then runs alone. `in_use_bytes` is the current usage, e.g. for a gauge.
+    """
+
+    def __init__(self, capacity_bytes: int) -> None:
+        self.capacity_bytes = capacity_bytes
+        self._in_use_bytes: int = 0
+        self._waiters: deque[tuple[int, asyncio.Future[None]]] = deque()
+        # Statistics
+        self.peak_bytes: int = 0
+        self.acquired: int = 0
+        self.waited: int = 0
+        self.timeouts: int = 0
+
+    @property
+    def in_use_bytes(self) -> int:
+        return self._in_use_bytes
+
+    @property
+    def waiting(self) -> int:
+        """Number of requests waiting for bytes to be released."""
+        return len(self._waiters)
+
+    def try_acquire(self, size: int) -> bool:
+        """Take `size` bytes if they are available right away and nobody is waiting. Returns False otherwise."""
+        size = min(size, self.capacity_bytes)
+        if self._waiters or not self._fits(size):
+            return False
+        self._take(size)
+        return True
+
+    async def acquire(self, size: int, timeout: float) -> bool:
+        """Take `size` bytes, waiting at most `timeout` seconds (0 = don't wait). Returns False if they were not available in time."""
+        if self.try_acquire(size):
+            return True
+        size = min(size, self.capacity_bytes)
+        if timeout <= 0:
+            self.timeouts += 1
+            return False
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        entry: tuple[int, asyncio.Future[None]] = (size, waiter)
+        self._waiters.append(entry)
+        self.waited += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # Cancelled while waiting: give the bytes back if they were granted in the meantime
+            if waiter.done():
+                self.release(size)
+            else:
+                self._withdraw(entry)
+            raise
+        # The bytes may have been granted right when the timeout expired
+        if waiter.done():
+            return True
+        self._withdraw(entry)
+        self.timeouts += 1
+        return False
+
+    def release(self, size: int) -> None:
+        """Give back bytes taken with `acquire` and wake the waiting requests that fit now."""
+        self._in_use_bytes -= min(size, self.capacity_bytes)
+        self._wake_waiters()
+
+    def _fits(self, size: int) -> bool:
+        return self._in_use_bytes + size <= self.capacity_bytes or self._in_use_bytes == 0
+
+    def _take(self, size: int) -> None:
+        self._in_use_bytes += size
+        self.peak_bytes = max(self.peak_bytes, self._in_use_bytes)
+        self.acquired += 1
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self._fits(self._waiters[0][0]):
+            size, waiter = self._waiters.popleft()
+            self._take(size)
+            waiter.set_result(None)
+
+    def _withdraw(self, entry: tuple[int, asyncio.Future[None]]) -> None:
+        self._waiters.remove(entry)
+        entry[1].cancel()
+        # The next request in line may fit now that this one gave up its place
+        self._wake_waiters()
@@ -0,0 +1,63 @@
+"""
+Circuit breaker for MemeBot.
+Fails fast while a remote server is known to be down and probes it periodically to recover.
+"""
+from __future__ import annotations
+
+import time
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker with the usual closed, open and half-open states.
+    
+    After `failure_threshold` consecutive failures the circuit opens and requests are refused.
+    Once `recovery_timeout` seconds have passed a single probe request is let through (half-open):
+    its success closes the circuit again, its failure reopens it for another timeout. A probe that is cancelled
+    before its outcome is known reopens it as well, so the circuit doesn't wait for a probe that never returns.
+    """
+
+    CLOSED: str = "closed"
+    OPEN: str = "open"
+    HALF_OPEN: str = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state: str = self.CLOSED
+        self.consecutive_failures: int = 0
+        self.opened_at: float = 0.0
+
+    def allow_request(self) -> bool:
+        """Check if a request may be sent now. Moves an expired open circuit to half-open for one probe."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self.opened_at + self.recovery_timeout:
+            self.state = self.HALF_OPEN
+            return True
+        # Open, or half-open with the probe still in flight
+        return False
+
+    def retry_after(self) -> float:
+        """Seconds until the next probe is allowed (0 if requests are allowed)."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        """Record a successful request and close the circuit."""
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        """Record a failed request and open the circuit if the threshold is reached or the probe failed."""
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def record_cancellation(self) -> None:
+        """Record a request cancelled before its outcome was known. A cancelled probe reopens the circuit for another timeout."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
@@ -0,0 +1,79 @@
+"""
+Cooldown policies for MemeBot.
+Decide from a single stored timestamp per scope whether a promotion is allowed and how long to wait otherwise.
+"""
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+
+
+class CooldownPolicy(ABC):
+    """
+    Rate limiting policy working on one timestamp of state per cooldown key.
+
+    The state is 0 if there is none. A policy never needs the state after the time it is set to,
+    so the cooldown store can drop it then and both checks and updates are O(1).
+    """
+
+    @abstractmethod
+    def wait_time(self, state: float, now: float) -> float:
+        """Seconds until the next promotion is allowed, 0 if it is allowed now."""
+
+    @abstractmethod
+    def next_state(self, state: float, now: float) -> float:
+        """State after a promotion at `now`."""
+
+    @abstractmethod
+    def release_state(self, state: float, reserved_state: float, now: float) -> float | None:
+        """
+        State after giving back a promotion taken with `next_state`, e.g. because it failed.
+
+        `reserved_state` is the state the promotion set. None if the promotion no longer holds anything to give back.
+        """
+
+
+class FixedWindowPolicy(CooldownPolicy):
+    """Wait `cooldown_seconds` after every promotion. The state is the time the cooldown ends."""
+
+    def __init__(self, cooldown_seconds: float) -> None:
+        self.cooldown_seconds = cooldown_seconds
+
+    def wait_time(self, state: float, now: float) -> float:
+        return max(0.0, state - now)
+
+    def next_state(self, state: float, now: float) -> float:
+        return now + self.cooldown_seconds
+
+    def release_state(self, state: float, reserved_state: float, now: float) -> float | None:
+        # Once its window is over a later promotion may have started a new one, which is not this one's to give back
+        if state != reserved_state:
+            return None
+        return state - self.cooldown_seconds
+
+
+class TokenBucketPolicy(CooldownPolicy):
+    """
+    Token bucket holding up to `capacity` promotions, refilled by one every `refill_seconds`.
+
+    Implemented as generic cell rate algorithm (GCRA): the state is the theoretical arrival time,
+    the time the bucket is full again. A promotion is allowed as long as that time is less than
+    `capacity - 1` refills ahead, so bursts of `capacity` promotions pass, followed by one per refill.
+    """
+
+    def __init__(self, capacity: int, refill_seconds: float) -> None:
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self.burst_tolerance: float = (capacity - 1) * refill_seconds
+
+    def wait_time(self, state: float, now: float) -> float:
+        return max(0.0, state - self.burst_tolerance - now)
+
+    def next_state(self, state: float, now: float) -> float:
+        return max(state, now) + self.refill_seconds
+
+    def release_state(self, state: float, reserved_state: float, now: float) -> float | None:
+        # A token taken before the bucket was full again has been refilled already
+        if reserved_state <= now:
+            return None
+        # Put the token back, promotions taken after the released one keep theirs
+        return state - self.refill_seconds
@@ -0,0 +1,98 @@
+"""
+Cooldown store for MemeBot.
+Keeps the end times of active cooldowns and forgets them once they expired.
+"""
+from __future__ import annotations
+
+from collections import Counter
+import heapq
+import time
+
+# Cooldown scope (e.g. "user" or "global") and the ID within that scope
+CooldownKey = tuple[str, str]
+
+
+class CooldownStore:
+    """
+    Cooldown end times by scope and ID with bounded memory.
+
+    Lookups and updates are O(1) dictionary operations. A min-heap ordered by end time lets `sweep()`
+    drop expired cooldowns in O(log n) each; heap entries made stale by a later update are skipped.
+    At most `max_entries` cooldowns of the `evictable_scopes` are kept: when full, the one ending soonest is dropped.
+    Cooldowns of other scopes (e.g. the global one) are never dropped early and don't count towards the limit.
+    """
+
+    def __init__(self, max_entries: int, evictable_scopes: frozenset[str]) -> None:
+        self.max_entries = max_entries
+        self.evictable_scopes = evictable_scopes
+        self._ends_at: dict[CooldownKey, float] = {}
+        self._expiry_heap: list[tuple[float, CooldownKey]] = []
+        self._scope_counts: Counter[str] = Counter()
+        # Statistics
+        self.expired: int = 0
+        self.evicted: int = 0
+
+    def __len__(self) -> int:
+        return len(self._ends_at)
+
+    def get(self, key: CooldownKey) -> float:
+        """Return the time a cooldown ends, 0 if there is none."""
+        ends_at: float = self._ends_at.get(key, 0.0)
+        return ends_at if ends_at > time.time() else 0.0
+
+    def set(self, key: CooldownKey, ends_at: float) -> None:
+        """Start or extend a cooldown until the given time."""
+        if key not in self._ends_at:
+            if key[0] in self.evictable_scopes and self._count_evictable() >= self.max_entries and not self.sweep():
+                self._evict_soonest()
+            self._scope_counts[key[0]] += 1
+        self._ends_at[key] = ends_at
+        heapq.heappush(self._expiry_heap, (ends_at, key))
+        # Frequently extended cooldowns leave stale heap entries behind, rebuild before they dominate the heap
+        if len(self._expiry_heap) > 2 * len(self._ends_at) + 64:
+            self._expiry_heap = [(ends_at, key) for key, ends_at in self._ends_at.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def discard(self, key: CooldownKey) -> None:
+        """End a cooldown early. Its heap entry is skipped as stale when it comes up."""
+        if key in self._ends_at:
+            self._remove(key)
+
+    def sweep(self) -> int:
+        """Drop all expired cooldowns. Returns how many were dropped."""
+        now: float = time.time()
+        dropped: int = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            ends_at, key = heapq.heappop(self._expiry_heap)
+            if self._ends_at.get(key) == ends_at:
+                self._remove(key)
+                dropped += 1
+        self.expired += dropped
+        return dropped
+
+    def entry_counts(self) -> dict[str, int]:
+        """Number of tracked cooldowns per scope."""
+        return {scope: count for scope, count in self._scope_counts.items() if count}
+
+    def _count_evictable(self) -> int:
+        return sum(self._scope_counts[scope] for scope in self.evictable_scopes)
+
+    def _evict_soonest(self) -> None:
+        # Cooldowns of other scopes ending sooner are put back, there are only a few of them
+        kept_entries: list[tuple[float, CooldownKey]] = []
+        while self._expiry_heap:
+            ends_at, key = heapq.heappop(self._expiry_heap)
+            if self._ends_at.get(key) != ends_at:
+                continue
+            if key[0] not in self.evictable_scopes:
+                kept_entries.append((ends_at, key))
+                continue
+            self._remove(key)
+            self.evicted += 1
+            break
+        for kept_entry in kept_entries:
+            heapq.heappush(self._expiry_heap, kept_entry)
+
+    def _remove(self, key: CooldownKey) -> None:
+        del self._ends_at[key]
+        self._scope_counts[key[0]] -= 1
@@ -0,0 +1,65 @@
+"""
+Encryption helpers for MemeBot.
+Provides incremental decryption of Matrix encrypted attachments.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+
+class AttachmentDecryptionError(ValueError):
+    """Raised when an encrypted attachment can't be decrypted or fails its integrity check."""
+
+
+def decode_unpadded_base64(value: str) -> bytes:
+    """Decode unpadded standard or URL-safe base64 as used in Matrix encrypted file metadata."""
+    padded_value: str = value + "=" * (-len(value) % 4)
+    if "-" in value or "_" in value:
+        return base64.urlsafe_b64decode(padded_value)
+    return base64.b64decode(padded_value)
+
+
+class AttachmentDecryptor:
+    """
+    Incremental AES-256-CTR decryptor for Matrix encrypted attachments.
+    
+    Ciphertext is decrypted chunk by chunk as it arrives while its SHA-256 hash is updated,
+    so the whole ciphertext never has to be held in memory. `verify()` has to be called
+    after the last chunk to check the hash before the plaintext is used.
+    
+    Decryption runs inline: AES-CTR with AES-NI handles gigabytes per second, which is far less
+    than handing every chunk to a worker pool (and pickling it for a process pool) would cost.
+    """
+
+    def __init__(self, key: str, iv: str, sha256_hash: str) -> None:
+        try:
+            key_bytes: bytes = decode_unpadded_base64(key)
+            iv_bytes: bytes = decode_unpadded_base64(iv)
+            self._expected_hash: bytes = decode_unpadded_base64(sha256_hash)
+        except (ValueError, TypeError) as error:
+            raise AttachmentDecryptionError(f"Invalid encryption metadata: {error}") from error
+        if len(key_bytes) != 32:
+            raise AttachmentDecryptionError("Invalid key length")
+        if len(iv_bytes) != 16:
+            raise AttachmentDecryptionError("Invalid IV length")
+        self._cipher = Cipher(algorithms.AES(key_bytes), modes.CTR(iv_bytes)).decryptor()
+        self._hash = hashlib.sha256()
+        self.size: int = 0
+
+    def consume(self, ciphertext_chunk: bytes) -> None:
+        """Hash the next chunk of ciphertext."""
+        self._hash.update(ciphertext_chunk)
+        self.size += len(ciphertext_chunk)
+
+    def update(self, ciphertext_chunk: bytes) -> bytes:
+        """Hash and decrypt the next chunk of ciphertext."""
+        self.consume(ciphertext_chunk)
+        return self._cipher.update(ciphertext_chunk)
+
+    def verify(self) -> None:
+        """Check the hash of all ciphertext passed to `update()`. Raises AttachmentDecryptionError on mismatch."""
+        if not hmac.compare_digest(self._hash.digest(), self._expected_hash):
+            raise AttachmentDecryptionError("Mismatched SHA-256 digest")
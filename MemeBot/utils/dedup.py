@@ -0,0 +1,107 @@
+"""
+Promoted image index for MemeBot.
+Remembers recently promoted images by promotion server and content hash, so identical images are not uploaded twice to the same server.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import hashlib
+import time
+
+# Promotion server URL and content digest of a promoted image
+PromotedImageKey = tuple[str, str]
+
+
+def content_digest(image_bytes: bytes) -> str:
+    """Return the SHA-256 hex digest of (decrypted) image data."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+@dataclass
+class PromotedImage:
+    """A promoted image in the index."""
+
+    digest: str
+    server_url: str  # Promotion server the image was uploaded to
+    event_id: str
+    room_id: str
+    promoted_at: float  # Unix timestamp
+    media_urls: set[str] = field(default_factory=set)
+
+
+class PromotedImageIndex:
+    """
+    LRU index of promoted images keyed by promotion server and content hash, with a secondary index by media URL.
+
+    Images only count as promoted on the server they were uploaded to, so rooms promoting to different servers
+    don't suppress each other's uploads. Entries expire `ttl_seconds` after their promotion, and the least recently used entries are
+    evicted once more than `max_entries` are stored. The media URL index finds forwarded images
+    that reuse the original upload before they are downloaded.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[PromotedImageKey, PromotedImage] = OrderedDict()
+        self._media_urls: dict[tuple[str, str], str] = {}  # Promotion server URL and media URL -> content digest
+        # Statistics
+        self.hits: int = 0
+        self.misses: int = 0
+        self.media_url_hits: int = 0
+        self.evictions: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, server_url: str, digest: str) -> PromotedImage | None:
+        """Find an image promoted to a server by content digest and mark it as recently used."""
+        if entry := self._get((server_url, digest)):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def lookup_media_url(self, server_url: str, media_url: str) -> PromotedImage | None:
+        """Find an image promoted to a server by the media URL of one of its uploads and mark it as recently used."""
+        if not (digest := self._media_urls.get((server_url, media_url))) or not (entry := self._get((server_url, digest))):
+            return None
+        self.media_url_hits += 1
+        return entry
+
+    def add(self, entry: PromotedImage) -> list[PromotedImageKey]:
+        """Add or refresh a promoted image. Returns the keys of the entries evicted to make room."""
+        key: PromotedImageKey = (entry.server_url, entry.digest)
+        if existing := self._entries.pop(key, None):
+            entry.media_urls |= existing.media_urls
+        self._entries[key] = entry
+        for media_url in entry.media_urls:
+            self._media_urls[entry.server_url, media_url] = entry.digest
+        evicted: list[PromotedImageKey] = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._evict(next(iter(self._entries))))
+        return evicted
+
+    def add_media_url(self, server_url: str, digest: str, media_url: str) -> None:
+        """Remember another media URL of an indexed image."""
+        if entry := self._entries.get((server_url, digest)):
+            entry.media_urls.add(media_url)
+            self._media_urls[server_url, media_url] = digest
+
+    def _get(self, key: PromotedImageKey) -> PromotedImage | None:
+        if not (entry := self._entries.get(key)):
+            return None
+        if entry.promoted_at + self.ttl_seconds < time.time():
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _evict(self, key: PromotedImageKey) -> PromotedImageKey:
+        entry: PromotedImage = self._entries.pop(key)
+        for media_url in entry.media_urls:
+            if self._media_urls.get((entry.server_url, media_url)) == entry.digest:
+                del self._media_urls[entry.server_url, media_url]
+        self.evictions += 1
+        return key
+
@@ -0,0 +1,63 @@
+"""
+Recent event cache for MemeBot.
+Keeps recently seen events per room, so replies to them don't need to fetch them from the homeserver.
+"""
+from __future__ import annotations
+
+from typing import Generic, TypeVar
+from collections import OrderedDict
+
+T = TypeVar("T")
+
+
+class RecentEventCache(Generic[T]):
+    """
+    LRU cache of recent events by room and event ID.
+
+    Every room keeps at most `max_events_per_room` events, so a busy room can't push out the events
+    of quieter ones, and at most `max_rooms` rooms are tracked (the least recently active is dropped).
+    """
+
+    def __init__(self, max_events_per_room: int, max_rooms: int) -> None:
+        self.max_events_per_room = max_events_per_room
+        self.max_rooms = max_rooms
+        self._rooms: OrderedDict[str, OrderedDict[str, T]] = OrderedDict()
+        # Statistics
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return sum(len(room_events) for room_events in self._rooms.values())
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of lookups answered from the cache."""
+        lookups: int = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def add(self, room_id: str, event_id: str, event: T) -> None:
+        """Remember an event as the most recent one of its room."""
+        if (room_events := self._rooms.get(room_id)) is None:
+            room_events = self._rooms[room_id] = OrderedDict()
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        else:
+            self._rooms.move_to_end(room_id)
+        room_events[event_id] = event
+        room_events.move_to_end(event_id)
+        if len(room_events) > self.max_events_per_room:
+            room_events.popitem(last=False)
+
+    def get(self, room_id: str, event_id: str) -> T | None:
+        """Find an event and mark it as recently used."""
+        if (room_events := self._rooms.get(room_id)) is None or (event := room_events.get(event_id)) is None:
+            self.misses += 1
+            return None
+        room_events.move_to_end(event_id)
+        self.hits += 1
+        return event
+
+    def discard(self, room_id: str, event_id: str) -> None:
+        """Forget an event, e.g. because it was redacted."""
+        if (room_events := self._rooms.get(room_id)) is not None:
+            room_events.pop(event_id, None)
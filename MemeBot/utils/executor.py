@@ -0,0 +1,82 @@
+"""
+Worker pool for MemeBot.
+Runs CPU-bound image work in a thread or process pool, so it can't stall the event loop.
+"""
+from __future__ import annotations
+
+from typing import Any, Callable, TypeVar
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from logging import Logger
+import asyncio
+import multiprocessing
+import time
+
+T = TypeVar("T")
+
+
+class WorkerPoolBusyError(RuntimeError):
+    """Raised when a job is submitted while the worker pool queue is full."""
+
+
+def _run_timed(function: Callable[..., T], *args: Any) -> tuple[float, T]:
+    """Run a function in a worker and return the wall clock time it started at along with its result."""
+    return time.time(), function(*args)
+
+
+class WorkerPool:
+    """
+    Bounded thread or process pool for CPU-bound functions.
+    
+    At most `max_workers` jobs run at once and at most `max_queue_depth` more wait for a worker;
+    further jobs are refused with WorkerPoolBusyError. The time jobs spend waiting is logged.
+    Functions and arguments must be picklable when a process pool is used.
+    """
+
+    POOL_TYPES: tuple[str, ...] = ("thread", "process")
+
+    def __init__(self, pool_type: str, max_workers: int, max_queue_depth: int, queue_wait_warning_seconds: float, log: Logger) -> None:
+        self._executor: Executor
+        if pool_type == "process":
+            # Forked workers inherit the already imported plugin modules, which spawned ones could not import
+            start_method: str | None = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+            self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="memebot-worker")
+        self.pool_type = pool_type
+        self.max_pending_jobs: int = max_workers + max_queue_depth
+        self.queue_wait_warning_seconds = queue_wait_warning_seconds
+        self.log = log
+        # Statistics
+        self.pending_jobs: int = 0
+        self.completed_jobs: int = 0
+        self.refused_jobs: int = 0
+        self.total_queue_wait_seconds: float = 0.0
+        self.max_queue_wait_seconds: float = 0.0
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """Run a function in the pool and return its result. Raises WorkerPoolBusyError if the queue is full."""
+        if self.pending_jobs >= self.max_pending_jobs:
+            self.refused_jobs += 1
+            raise WorkerPoolBusyError(f"Worker pool is busy: pending_jobs={self.pending_jobs}")
+        self.pending_jobs += 1
+        submitted_at: float = time.time()
+        try:
+            started_at, result = await asyncio.get_running_loop().run_in_executor(self._executor, _run_timed, function, *args)
+        finally:
+            self.pending_jobs -= 1
+        # Record how long the job waited for a free worker
+        queue_wait_seconds: float = max(0.0, started_at - submitted_at)
+        self.completed_jobs += 1
+        self.total_queue_wait_seconds += queue_wait_seconds
+        self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, queue_wait_seconds)
+        if queue_wait_seconds >= self.queue_wait_warning_seconds:
+            self.log.warning(f"⏳ Worker pool job '{function.__name__}' waited {queue_wait_seconds:.2f}s in the queue: pending_jobs={self.pending_jobs}")
+        else:
+            self.log.debug(f"⏳ Worker pool job '{function.__name__}' waited {queue_wait_seconds * 1000:.1f}ms in the queue")
+        return result
+
+    def shutdown(self) -> None:
+        """Stop the workers and cancel jobs that have not started yet."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        average_queue_wait: float = self.total_queue_wait_seconds / self.completed_jobs if self.completed_jobs else 0.0
+        self.log.info(f"📊 Worker pool ({self.pool_type}) stopped: completed_jobs={self.completed_jobs}, refused_jobs={self.refused_jobs}, average_queue_wait={average_queue_wait * 1000:.1f}ms, max_queue_wait={self.max_queue_wait_seconds * 1000:.1f}ms")
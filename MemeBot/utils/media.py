@@ -0,0 +1,151 @@
+"""
+Media helpers for MemeBot.
+Provides magic number based format detection and validated streaming of image data.
+"""
+from __future__ import annotations
+
+from typing import AsyncIterator, NoReturn
+from io import BytesIO
+import hashlib
+from PIL import Image
+from .crypto import AttachmentDecryptionError, AttachmentDecryptor
+
+
+# Magic number prefixes mapped to the format names reported by PIL
+IMAGE_SIGNATURES: tuple[tuple[bytes, str], ...] = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+)
+
+# Number of leading bytes needed to detect every supported format
+IMAGE_HEADER_SIZE: int = 16
+
+# Image mimetypes mapped to the format names reported by PIL
+MIMETYPE_FORMATS: dict[str, str] = {
+    "image/png": "PNG",
+    "image/jpeg": "JPEG",
+    "image/jpg": "JPEG",
+    "image/pjpeg": "JPEG",
+    "image/gif": "GIF",
+    "image/webp": "WEBP",
+    "image/bmp": "BMP",
+    "image/tiff": "TIFF",
+}
+
+
+def sniff_image_format(header: bytes) -> str | None:
+    """Detect the image format from the leading bytes of a file. Returns None if unknown."""
+    # WEBP is a RIFF container with the form type at offset 8
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "WEBP"
+    for signature, image_format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    return None
+
+
+def detect_image_format(image_bytes: bytes, deep_verify: bool = False) -> str | None:
+    """
+    Detect the image format with PIL, optionally checking the whole file with `Image.verify()`.
+    Raises an exception if the image can't be parsed. Stateless, so it can run in a worker pool.
+    """
+    with Image.open(BytesIO(image_bytes)) as image_object:
+        detected_image_format: str | None = image_object.format
+        if deep_verify:
+            image_object.verify()
+        return detected_image_format
+
+
+def format_from_mimetype(mimetype: str | None) -> str | None:
+    """Map an image mimetype to a format name. Returns None if the mimetype is missing or unknown."""
+    if not mimetype:
+        return None
+    return MIMETYPE_FORMATS.get(mimetype.split(";", 1)[0].strip().lower())
+
+
+class ImageRejectedError(Exception):
+    """Raised when image data fails validation. Carries the key of the message shown to the user."""
+
+    def __init__(self, message_key: str, reason: str) -> None:
+        super().__init__(reason)
+        self.message_key = message_key
+
+
+class ImageStream:
+    """
+    Async iterator over image data as it arrives from the homeserver.
+    
+    The format is sniffed from the first bytes by `read_header()` before anything is sent on,
+    and the size limit is enforced on every chunk, so only a couple of chunks are held in memory.
+    Encrypted files are decrypted on the fly; the last chunk is held back until the ciphertext
+    hash is verified, so a corrupted file never reaches the consumer completely.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], maximum_size: int, allowed_formats: tuple[str, ...], decryptor: AttachmentDecryptor | None = None) -> None:
+        self._chunks = chunks
+        self._decryptor = decryptor
+        self._header: bytes = b""
+        self.maximum_size = maximum_size
+        self.allowed_formats = allowed_formats
+        self.size: int = 0
+        self.image_format: str | None = None
+        self.error: ImageRejectedError | None = None
+        # SHA-256 of the (decrypted) image data, complete once the stream was read to the end
+        self.sha256 = hashlib.sha256()
+        # Set once a consumer started reading, after which the stream can't be sent again
+        self.started: bool = False
+
+    async def read_header(self) -> None:
+        """Read and validate the leading bytes of the stream. Raises ImageRejectedError if invalid."""
+        while len(self._header) < IMAGE_HEADER_SIZE:
+            if (chunk := await self._next_chunk()) is None:
+                break
+            self._header += chunk
+        if not self._header:
+            self._reject("image_download_failed", "No image data received")
+        if not (image_format := sniff_image_format(self._header[:IMAGE_HEADER_SIZE])):
+            self._reject("image_format_invalid", "Could not determine image format")
+        if image_format.upper() not in self.allowed_formats:
+            self._reject("image_format_unsupported", f"Unsupported image format: {image_format}")
+        self.image_format = image_format
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[bytes]:
+        self.started = True
+        pending_chunk, self._header = self._header, b""
+        while (chunk := await self._next_chunk()) is not None:
+            if pending_chunk:
+                yield pending_chunk
+            pending_chunk = chunk
+        # Release the last chunk only once the whole file is verified
+        if self._decryptor:
+            try:
+                self._decryptor.verify()
+            except AttachmentDecryptionError as error:
+                self._reject("encrypted_image_decrypt_failed", f"Decryption failed: {error}")
+        if pending_chunk:
+            yield pending_chunk
+
+    async def _next_chunk(self) -> bytes | None:
+        """Read, decrypt and count the next chunk. Returns None at the end of the stream."""
+        if (chunk := await anext(self._chunks, None)) is None:
+            return None
+        if self._decryptor:
+            chunk = self._decryptor.update(chunk)
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+        if self.size > self.maximum_size:
+            self._reject("image_size_exceeded", f"Image size exceeded limit while streaming: received={self.size:,} bytes, max={self.maximum_size:,} bytes")
+        return chunk
+
+    def _reject(self, message_key: str, reason: str) -> NoReturn:
+        # Raise a copy, a kept error with a traceback would keep the frames and their chunks alive in a reference cycle
+        self.error = ImageRejectedError(message_key, reason)
+        raise ImageRejectedError(message_key, reason)
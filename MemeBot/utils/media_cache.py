@@ -0,0 +1,135 @@
+"""
+Media cache for MemeBot.
+Keeps downloaded (and decrypted) images within a byte budget, so repeated promotions don't download them again.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from pathlib import Path
+import asyncio
+import hashlib
+
+
+class MediaCache:
+    """
+    LRU cache of image data by media key with a memory and an optional disk tier.
+
+    Entries live in memory until their total size exceeds `memory_budget_bytes`; the least recently used ones
+    are then moved to `disk_directory` (or dropped without one), where they are kept until the disk tier exceeds
+    `disk_budget_bytes`. Disk hits move the entry back into memory. Disk I/O runs in a thread.
+    """
+
+    # Suffix of spilled files, only files with it are ever deleted from the directory
+    FILE_SUFFIX: str = ".media"
+
+    def __init__(self, memory_budget_bytes: int, disk_directory: str | None = None, disk_budget_bytes: int = 0) -> None:
+        self.memory_budget_bytes = memory_budget_bytes
+        self.disk_budget_bytes = disk_budget_bytes
+        self.disk_directory: Path | None = Path(disk_directory) if disk_directory else None
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes: int = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()  # Key -> size of the spilled file
+        self._disk_bytes: int = 0
+        # Statistics
+        self.memory_hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def __len__(self) -> int:
+        return len(self._memory) + len(self._disk)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    @property
+    def disk_bytes(self) -> int:
+        return self._disk_bytes
+
+    def open(self) -> None:
+        """Create the disk directory and remove files spilled by an earlier run, which are not indexed anymore."""
+        if self.disk_directory is not None:
+            self.disk_directory.mkdir(parents=True, exist_ok=True)
+            self._remove_spilled_files()
+
+    def close(self) -> None:
+        """Drop all entries and remove the spilled files."""
+        self._memory.clear()
+        self._memory_bytes = 0
+        self._disk.clear()
+        self._disk_bytes = 0
+        if self.disk_directory is not None:
+            self._remove_spilled_files()
+
+    async def get(self, key: str) -> bytes | None:
+        """Return the cached data of a key and mark it as recently used."""
+        if (data := self._memory.get(key)) is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return data
+        if key in self._disk:
+            file_path: Path = self._file_path(key)
+            try:
+                data = await asyncio.to_thread(file_path.read_bytes)
+            except OSError:
+                self._forget_spilled(key)
+            else:
+                # Moved back into memory, the file may be written again when it is spilled the next time
+                self._forget_spilled(key)
+                file_path.unlink(missing_ok=True)
+                self.disk_hits += 1
+                await self.put(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes) -> None:
+        """Cache data in memory, moving the least recently used entries to disk if the memory budget is exceeded."""
+        if (previous := self._memory.pop(key, None)) is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_budget_bytes and self._memory:
+            spilled_key, spilled_data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(spilled_data)
+            await self._spill(spilled_key, spilled_data)
+
+    def discard(self, key: str) -> None:
+        """Remove the data of a key from both tiers."""
+        if (data := self._memory.pop(key, None)) is not None:
+            self._memory_bytes -= len(data)
+        if key in self._disk:
+            self._forget_spilled(key)
+            self._file_path(key).unlink(missing_ok=True)
+
+    async def _spill(self, key: str, data: bytes) -> None:
+        if self.disk_directory is None or len(data) > self.disk_budget_bytes:
+            self.evictions += 1
+            return
+        try:
+            await asyncio.to_thread(self._file_path(key).write_bytes, data)
+        except OSError:
+            self.evictions += 1
+            return
+        self._forget_spilled(key)
+        self._disk[key] = len(data)
+        self._disk_bytes += len(data)
+        while self._disk_bytes > self.disk_budget_bytes:
+            evicted_key: str = next(iter(self._disk))
+            self._forget_spilled(evicted_key)
+            self._file_path(evicted_key).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def _forget_spilled(self, key: str) -> None:
+        if (size := self._disk.pop(key, None)) is not None:
+            self._disk_bytes -= size
+
+    def _file_path(self, key: str) -> Path:
+        assert self.disk_directory is not None
+        return self.disk_directory / f"{hashlib.sha256(key.encode()).hexdigest()}{self.FILE_SUFFIX}"
+
+    def _remove_spilled_files(self) -> None:
+        assert self.disk_directory is not None
+        for spilled_file in self.disk_directory.glob(f"*{self.FILE_SUFFIX}"):
+            spilled_file.unlink(missing_ok=True)
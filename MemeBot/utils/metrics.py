@@ -0,0 +1,117 @@
+"""
+Metrics for MemeBot.
+Counters, latency histograms and gauges rendered in the Prometheus text exposition format.
+"""
+from __future__ import annotations
+
+from typing import Callable, Mapping
+from bisect import bisect_left
+from collections import Counter
+from logging import Logger
+
+# Upper bounds in seconds, from a cached lookup up to a slow upload
+DEFAULT_LATENCY_BUCKETS: tuple[float, ...] = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# A gauge value, or values by label value (None if the measured component is disabled)
+GaugeValue = float | Mapping[str, float] | None
+
+
+class Histogram:
+    """Fixed-bucket histogram. Observing is a binary search and three additions, buckets are made cumulative on rendering."""
+
+    __slots__ = ("bucket_bounds", "bucket_counts", "count", "sum")
+
+    def __init__(self, bucket_bounds: tuple[float, ...]) -> None:
+        self.bucket_bounds = bucket_bounds
+        self.bucket_counts: list[int] = [0] * (len(bucket_bounds) + 1)  # The last bucket is +Inf
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        # Prometheus buckets are inclusive: the first bound >= value
+        self.bucket_counts[bisect_left(self.bucket_bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """
+    Metric families with at most one label each, rendered in the Prometheus text format.
+
+    Counters and histograms are plain integers and lists updated from the event loop, so recording needs no lock.
+    Gauges are read from callbacks when the metrics are rendered, so they cost nothing in between.
+    A callback returns None to leave its gauge out, a failing one is logged and left out.
+    """
+
+    def __init__(self, log: Logger) -> None:
+        self.log = log
+        # Name -> (type, help, label name)
+        self._families: dict[str, tuple[str, str, str]] = {}
+        self._counters: dict[str, Counter[str]] = {}
+        self._histograms: dict[str, dict[str, Histogram]] = {}
+        self._histogram_buckets: dict[str, tuple[float, ...]] = {}
+        self._gauges: dict[str, Callable[[], GaugeValue]] = {}
+
+    def add_counter(self, name: str, help_text: str, label: str = "") -> None:
+        self._families[name] = ("counter", help_text, label)
+        self._counters[name] = Counter()
+
+    def add_histogram(self, name: str, help_text: str, label: str = "", buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self._families[name] = ("histogram", help_text, label)
+        self._histograms[name] = {}
+        self._histogram_buckets[name] = buckets
+
+    def add_gauge(self, name: str, help_text: str, collect: Callable[[], GaugeValue], label: str = "") -> None:
+        self._families[name] = ("gauge", help_text, label)
+        self._gauges[name] = collect
+
+    def inc(self, name: str, label_value: str = "", amount: int = 1) -> None:
+        self._counters[name][label_value] += amount
+
+    def observe(self, name: str, value: float, label_value: str = "") -> None:
+        if (histogram := self._histograms[name].get(label_value)) is None:
+            histogram = self._histograms[name][label_value] = Histogram(self._histogram_buckets[name])
+        histogram.observe(value)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines: list[str] = []
+        for name, (metric_type, help_text, label) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for label_value, count in self._counters[name].items():
+                    lines.append(f"{name}{_labels(label, label_value)} {count}")
+            elif metric_type == "histogram":
+                for label_value, histogram in self._histograms[name].items():
+                    cumulative_count: int = 0
+                    for bound, bucket_count in zip((*histogram.bucket_bounds, "+Inf"), histogram.bucket_counts):
+                        cumulative_count += bucket_count
+                        lines.append(f"{name}_bucket{_labels(label, label_value, le=str(bound))} {cumulative_count}")
+                    lines.append(f"{name}_sum{_labels(label, label_value)} {histogram.sum}")
+                    lines.append(f"{name}_count{_labels(label, label_value)} {histogram.count}")
+            else:
+                try:
+                    gauge_value: GaugeValue = self._gauges[name]()
+                except Exception as error:
+                    self.log.error(f"❌ Failed to collect gauge {name}: {type(error).__name__}: {error}")
+                    continue
+                if gauge_value is None:
+                    continue
+                if isinstance(gauge_value, Mapping):
+                    for label_value, value in gauge_value.items():
+                        lines.append(f"{name}{_labels(label, label_value)} {float(value)}")
+                else:
+                    lines.append(f"{name} {float(gauge_value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(label: str, label_value: str, le: str | None = None) -> str:
+    """Format the label set of a sample, escaping label values."""
+    pairs: list[str] = []
+    if label:
+        escaped_value: str = label_value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{label}="{escaped_value}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
@@ -0,0 +1,151 @@
+"""
+Perceptual hashing for MemeBot.
+Computes difference hashes of images and finds near-duplicates by Hamming distance in a multi-index hash table.
+"""
+from __future__ import annotations
+
+from typing import Generic, TypeVar
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+from itertools import combinations
+from types import ModuleType
+import time
+from PIL import Image
+
+try:
+    import numpy
+    np: ModuleType | None = numpy
+except ImportError:  # numpy is a soft dependency, only needed for perceptual hashing
+    np = None
+
+T = TypeVar("T")
+
+# Whether perceptual hashes can be computed in this environment
+PERCEPTUAL_HASH_AVAILABLE: bool = np is not None
+
+# Side length of the hash grid, the hash has HASH_SIZE² bits
+HASH_SIZE: int = 8
+
+
+def perceptual_hash(image_bytes: bytes) -> int:
+    """
+    Compute the 64-bit difference hash (dHash) of an image.
+
+    The image (first frame of animations) is reduced to a 9x8 grayscale frame and every bit tells whether
+    a pixel is brighter than its left neighbour, so re-encoding, resizing and small edits flip few bits.
+    Raises ImportError if numpy is not installed (see PERCEPTUAL_HASH_AVAILABLE).
+    """
+    if np is None:
+        raise ImportError("Perceptual hashing requires numpy, install it or disable dedup.perceptual")
+    with Image.open(BytesIO(image_bytes)) as image:
+        # Let JPEG decoders skip most of the data by decoding at a reduced scale
+        image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        frame: Image.Image = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX)
+    pixels = np.asarray(frame, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+@lru_cache(maxsize=None)
+def _segment_flip_masks(radius: int) -> tuple[int, ...]:
+    """All masks of one segment with at most `radius` bits set, the value without flips first."""
+    return tuple(
+        sum(1 << bit for bit in bits)
+        for flipped_bits in range(radius + 1)
+        for bits in combinations(range(MultiIndexHashTable.SEGMENT_BITS), flipped_bits)
+    )
+
+
+class MultiIndexHashTable(Generic[T]):
+    """
+    Multi-index hash table for Hamming distance searches over 64-bit hashes.
+
+    Hashes are split into 4 segments of 16 bits with one lookup table each. Two hashes within distance d
+    differ in at least one segment by at most d // 4 bits (pigeonhole principle), so a search only looks
+    up the segment values within that radius and compares the few hashes found there, instead of scanning
+    all of them. Each hash is stored once, with the item it was last added with.
+
+    Like the promoted image index, hashes expire `ttl_seconds` after they were added and the least recently
+    used hashes are evicted once more than `max_entries` are stored.
+    """
+
+    SEGMENTS: int = 4
+    SEGMENT_BITS: int = 16
+    SEGMENT_MASK: int = (1 << SEGMENT_BITS) - 1
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._items: OrderedDict[int, tuple[T, float]] = OrderedDict()  # Hash -> item and the time it was added, least recently used first
+        self._tables: list[dict[int, list[int]]] = [{} for _ in range(self.SEGMENTS)]  # Segment value -> hashes
+        # Statistics
+        self.evictions: int = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, hash_value: int, item: T, added_at: float | None = None) -> list[int]:
+        """Add or refresh a hash with its item, added now unless given. Returns the hashes evicted to make room."""
+        if hash_value in self._items:
+            self._items.move_to_end(hash_value)
+        else:
+            for segment, table in enumerate(self._tables):
+                table.setdefault(self._segment_value(hash_value, segment), []).append(hash_value)
+        self._items[hash_value] = (item, time.time() if added_at is None else added_at)
+        evicted: list[int] = []
+        while len(self._items) > self.max_entries:
+            evicted_hash: int = next(iter(self._items))
+            self.remove(evicted_hash)
+            self.evictions += 1
+            evicted.append(evicted_hash)
+        return evicted
+
+    def remove(self, hash_value: int) -> bool:
+        """Remove a hash. Returns False if it was not stored."""
+        if self._items.pop(hash_value, None) is None:
+            return False
+        for segment, table in enumerate(self._tables):
+            segment_value: int = self._segment_value(hash_value, segment)
+            hashes: list[int] = table[segment_value]
+            hashes.remove(hash_value)
+            if not hashes:
+                del table[segment_value]
+        return True
+
+    def find_nearest(self, hash_value: int, max_distance: int) -> tuple[int, T] | None:
+        """
+        Find the unexpired hash closest to the given one within `max_distance` and mark it as recently used.
+        Returns its distance and item. Expired hashes found on the way are removed.
+        """
+        expired_before: float = time.time() - self.ttl_seconds
+        if (stored := self._items.get(hash_value)) is not None:
+            if stored[1] >= expired_before:
+                self._items.move_to_end(hash_value)
+                return 0, stored[0]
+            self.remove(hash_value)
+        best_hash: int | None = None
+        best_distance: int = max_distance + 1
+        expired_hashes: set[int] = set()
+        flip_masks: tuple[int, ...] = _segment_flip_masks(max_distance // self.SEGMENTS)
+        for segment, table in enumerate(self._tables):
+            segment_value: int = self._segment_value(hash_value, segment)
+            for flip_mask in flip_masks:
+                for candidate in table.get(segment_value ^ flip_mask, ()):
+                    if (distance := (candidate ^ hash_value).bit_count()) >= best_distance:
+                        continue
+                    # An expired hash must not hide a farther unexpired one
+                    if self._items[candidate][1] < expired_before:
+                        expired_hashes.add(candidate)
+                        continue
+                    best_hash, best_distance = candidate, distance
+        # Removed after the search, the segment tables must not change while they are iterated
+        for expired_hash in expired_hashes:
+            self.remove(expired_hash)
+        if best_hash is None:
+            return None
+        self._items.move_to_end(best_hash)
+        return best_distance, self._items[best_hash][0]
+
+    def _segment_value(self, hash_value: int, segment: int) -> int:
+        return (hash_value >> (segment * self.SEGMENT_BITS)) & self.SEGMENT_MASK
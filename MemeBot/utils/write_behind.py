@@ -0,0 +1,106 @@
+"""
+Write-behind buffer for MemeBot.
+Collects database writes in memory and flushes them in batches, so the message handler never waits for the database.
+"""
+from __future__ import annotations
+
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+from logging import Logger
+import asyncio
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class WriteBehindBuffer(Generic[K, V]):
+    """
+    Buffer of pending row writes keyed by primary key.
+
+    Writes to the same key are coalesced, so only the latest value or the deletion of a key reaches the database.
+    A background task hands the pending writes to `flush_rows(upserts, deletes)` every `flush_interval` seconds,
+    or as soon as `max_batch_size` writes are pending. Writes of a failed flush are kept and retried with the next one.
+    """
+
+    def __init__(self, name: str, flush_rows: Callable[[list[V], list[K]], Awaitable[None]], flush_interval: float, max_batch_size: int, log: Logger) -> None:
+        self.name = name
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.log = log
+        self._pending: dict[K, V | None] = {}  # Key -> row to write, or None to delete it
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._stopping: bool = False
+        self._task: asyncio.Task[None] | None = None
+        # Statistics
+        self.flushed_batches: int = 0
+        self.flushed_writes: int = 0
+        self.failed_flushes: int = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, key: K, row: V) -> None:
+        """Queue a row to be inserted or replaced."""
+        self._pending[key] = row
+        self._wake_if_full()
+
+    def delete(self, key: K) -> None:
+        """Queue the row of a key to be deleted."""
+        self._pending[key] = None
+        self._wake_if_full()
+
+    def discard(self, key: K) -> bool:
+        """Drop a pending row write of a key that wasn't flushed yet. Returns True if there was one."""
+        if self._pending.get(key) is None:
+            return False
+        del self._pending[key]
+        return True
+
+    def start(self) -> None:
+        """Start the background flush task."""
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background flush task after writing all pending writes."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        self.log.info(f"💾 {self.name} write buffer stopped: batches={self.flushed_batches}, writes={self.flushed_writes}, failed_flushes={self.failed_flushes}, unwritten={len(self._pending)}")
+
+    async def flush(self) -> None:
+        """Write all pending writes in one batch."""
+        if not self._pending:
+            return
+        batch: dict[K, V | None] = self._pending
+        self._pending = {}
+        upserts: list[V] = [row for row in batch.values() if row is not None]
+        deletes: list[K] = [key for key, row in batch.items() if row is None]
+        try:
+            await self.flush_rows(upserts, deletes)
+        except Exception as error:
+            self.failed_flushes += 1
+            self.log.error(f"❌ Failed to flush {self.name} writes, retrying with the next batch: writes={len(batch)}: {type(error).__name__}: {error}")
+            # Writes queued while flushing are newer and win over the failed ones
+            for key, row in batch.items():
+                self._pending.setdefault(key, row)
+            return
+        self.flushed_batches += 1
+        self.flushed_writes += len(batch)
+
+    def _wake_if_full(self) -> None:
+        if len(self._pending) >= self.max_batch_size:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self._stopping:
+                return
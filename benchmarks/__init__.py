@@ -0,0 +1,3 @@
+"""
+Benchmarks for MemeBot, run from the repository root with `uv run python -m benchmarks.<name>`.
+"""
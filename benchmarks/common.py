@@ -0,0 +1,38 @@
+"""
+Helpers shared by the benchmarks: loading the base config outside maubot and summarizing timings.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any
+import copy
+import statistics
+
+from mautrix.util.config import RecursiveDict
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
+
+from MemeBot.config import Config
+
+BASE_CONFIG_PATH: Path = Path(__file__).parent.parent / "base-config.yaml"
+
+
+def load_config(overrides: dict[str, Any]) -> Config:
+    """Load base-config.yaml with the given overrides (dotted keys), as maubot would for a new instance."""
+    base_config = YAML().load(BASE_CONFIG_PATH.read_text())
+    config_data = copy.deepcopy(base_config)
+    config = Config(lambda: config_data, lambda: RecursiveDict(copy.deepcopy(base_config), CommentedMap), lambda data: None)
+    config.load_and_update()
+    for key, value in overrides.items():
+        config[key] = value
+    config._load_proxy = lambda: config._data
+    return config
+
+
+def summarize(name: str, durations: list[float], unit: str = "ms", scale: float = 1000) -> str:
+    """One line with the p50, p99 and mean of the durations (in seconds)."""
+    percentiles: list[float] = statistics.quantiles(durations, n=100, method="inclusive")
+    return (
+        f"{name:<28} n={len(durations):<6} p50={percentiles[49] * scale:8.3f}{unit}  "
+        f"p99={percentiles[98] * scale:8.3f}{unit}  mean={statistics.fmean(durations) * scale:8.3f}{unit}"
+    )
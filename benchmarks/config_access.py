@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the config reads done while handling a promote command.
+
+Compares the nested BaseProxyConfig lookups the handlers did before the config snapshot with the attribute reads
+from ConfigSnapshot they do now, and prints the time per event of both.
+
+Usage: uv run python -m benchmarks.config_access [--events 200000]
+"""
+from __future__ import annotations
+
+from typing import Any
+import argparse
+import timeit
+
+from MemeBot.config import Config, ConfigSnapshot
+from .common import load_config
+
+
+def read_from_config(config: Config) -> tuple[Any, ...]:
+    """The settings a promote command read from the config before the snapshot."""
+    return (
+        config["messages"]["reply_in_thread"],
+        config["image"]["maximum_file_size_bytes"],
+        [image_format.upper() for image_format in config["image"]["allowed_image_formats"]],
+        config["image"]["admission"]["enabled"],
+        config["image"]["admission"]["trust_event_metadata"],
+        config["image"]["streaming"]["enabled"],
+        config["promotion"]["api_token"],
+        config["promotion"]["retry"]["max_attempts"],
+        config["messages"]["success_reaction_emojis"],
+        config["messages"]["easter_eggs"]["rare_message_probability"],
+    )
+
+
+def read_from_snapshot(config_snapshot: ConfigSnapshot) -> tuple[Any, ...]:
+    """The same settings read from the snapshot. The size limit is precomputed per room, see RoomPolicy."""
+    return (
+        config_snapshot.reply_in_thread,
+        config_snapshot.allowed_image_formats,
+        config_snapshot.admission_enabled,
+        config_snapshot.trust_event_metadata,
+        config_snapshot.streaming_enabled,
+        config_snapshot.api_token,
+        config_snapshot.retry_max_attempts,
+        config_snapshot.success_reaction_emojis,
+        config_snapshot.rare_message_probability,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare per-event config reads through the config and through the snapshot.")
+    parser.add_argument("--events", type=int, default=200_000, help="events per measurement")
+    arguments = parser.parse_args()
+    config: Config = load_config({"promotion.server_url": "https://promotion.example.org/upload"})
+    config_snapshot: ConfigSnapshot = ConfigSnapshot.from_config(config)
+    for name, read_settings, source in (("config lookups", read_from_config, config), ("config snapshot", read_from_snapshot, config_snapshot)):
+        # Best of five, to leave out interruptions by other processes
+        seconds: float = min(timeit.repeat(lambda: read_settings(source), number=arguments.events, repeat=5))  # type: ignore[operator]
+        print(f"{name:<16} {seconds / arguments.events * 1e9:8.1f} ns per event")
+
+
+if __name__ == "__main__":
+    main()
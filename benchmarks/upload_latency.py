@@ -0,0 +1,99 @@
+"""
+Upload latency benchmark for the pooled promotion session.
+
+Uploads an image repeatedly, once with a new HTTP session per upload (how uploads worked before the pooled
+session) and once through the plugin's long-lived session, and prints the p50/p99 latencies of both.
+By default the uploads go to a local promotion server, so the difference is the session and TCP connection
+setup. Point --server-url at the real promotion server to include DNS and the TLS handshake.
+
+Usage: uv run python -m benchmarks.upload_latency [--uploads 500] [--image-size 262144] [--server-url URL --api-token TOKEN]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from aiohttp import web
+import aiohttp
+
+from MemeBot.config import Config, ConfigSnapshot
+from MemeBot.mixins import ServerMixin
+from .common import load_config, summarize
+
+
+class BenchmarkUploader(ServerMixin):
+    """Just enough of the plugin to upload through ServerMixin."""
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.config_snapshot = ConfigSnapshot.from_config(config)
+        self.log = logging.getLogger("memebot.benchmark")
+        self.promotion_session = None
+
+
+async def receive_upload(request: web.Request) -> web.Response:
+    multipart_reader = await request.multipart()
+    while (part := await multipart_reader.next()) is not None:
+        await part.read()  # type: ignore[union-attr]
+    return web.Response(status=200)
+
+
+async def upload_with_new_session(image_bytes: bytes, server_url: str, api_token: str) -> int:
+    """Upload like before the pooled session: a new session, connector and connection for every upload."""
+    async with aiohttp.ClientSession(headers={"Authorization": f"Bearer {api_token}"}) as session:
+        form_data = aiohttp.FormData()
+        form_data.add_field("image", image_bytes, filename="benchmark.png", content_type="application/octet-stream")
+        async with session.post(server_url, data=form_data) as response:
+            return response.status
+
+
+async def run_benchmark(uploads: int, image_size: int, server_url: str | None, api_token: str) -> None:
+    runner: web.AppRunner | None = None
+    if server_url is None:
+        app = web.Application(client_max_size=image_size * 2)
+        app.router.add_post("/upload", receive_upload)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        server_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/upload"  # type: ignore[union-attr]
+    image_bytes: bytes = os.urandom(image_size)
+    uploader = BenchmarkUploader(load_config({"promotion.server_url": server_url, "promotion.api_token": api_token}))
+    uploader._open_promotion_session()
+    try:
+        new_session_durations: list[float] = []
+        pooled_session_durations: list[float] = []
+        # Alternate the variants, so both see the same server and network conditions
+        for upload_number in range(uploads):
+            upload_start: float = time.perf_counter()
+            status: int = await upload_with_new_session(image_bytes, server_url, api_token)
+            new_session_durations.append(time.perf_counter() - upload_start)
+            upload_start = time.perf_counter()
+            status = min(status, await uploader._post_image_to_server(image_bytes, "benchmark.png", server_url, f"benchmark-{upload_number}"))
+            pooled_session_durations.append(time.perf_counter() - upload_start)
+            if status != 200:
+                raise SystemExit(f"Upload failed with status {status}")
+        print(f"{uploads} uploads of {image_size:,} bytes to {server_url}")
+        print(summarize("new session per upload", new_session_durations))
+        print(summarize("pooled session", pooled_session_durations))
+    finally:
+        await uploader._close_promotion_session()
+        if runner is not None:
+            await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare upload latencies with a new session per upload and with the pooled session.")
+    parser.add_argument("--uploads", type=int, default=500, help="uploads per variant")
+    parser.add_argument("--image-size", type=int, default=256 * 1024, help="bytes per upload")
+    parser.add_argument("--server-url", help="promotion server to upload to (default: a local server)")
+    parser.add_argument("--api-token", default="", help="bearer token for --server-url")
+    arguments = parser.parse_args()
+    asyncio.run(run_benchmark(arguments.uploads, arguments.image_size, arguments.server_url, arguments.api_token))
+
+
+if __name__ == "__main__":
+    main()
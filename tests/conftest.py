@@ -0,0 +1,233 @@
+"""
+Shared fixtures for the MemeBot tests: a fake Matrix client whose media is served by a local HTTP server,
+a local promotion server, a plugin database and a started plugin instance.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable
+import asyncio
+import copy
+import io
+import logging
+
+from aiohttp import web
+from mautrix.types import ContentURI, ImageInfo, InReplyTo, MediaMessageEventContent, MessageType, RelatesTo, TextMessageEventContent
+from mautrix.util.async_db import Database
+from mautrix.util.config import RecursiveDict
+from PIL import Image
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
+import aiohttp
+import pytest
+
+from MemeBot import MemeBot
+from MemeBot.config import Config
+from MemeBot.db import upgrade_table
+
+BASE_CONFIG_PATH: Path = Path(__file__).parent.parent / "base-config.yaml"
+ROOM_ID: str = "!memes:example.org"
+
+
+def create_png(seed: int, size: int = 32) -> bytes:
+    image_buffer = io.BytesIO()
+    Image.new("RGB", (size, size), (seed % 256, seed // 256 % 256, 7)).save(image_buffer, "PNG")
+    return image_buffer.getvalue()
+
+
+async def start_http_server(routes: list[web.RouteDef]) -> tuple[web.AppRunner, str]:
+    """Serve the routes on a free local port. Returns the runner and the base URL."""
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port: int = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+class FakeEvent:
+    """Message event recording the bot's replies."""
+
+    def __init__(self, client: FakeClient, content: Any, sender: str, event_id: str, room_id: str = ROOM_ID) -> None:
+        self.client = client
+        self.content = content
+        self.sender = sender
+        self.room_id = room_id
+        self.event_id = event_id
+        self.responses: list[str] = []
+
+    async def respond(self, text: str, **kwargs: Any) -> None:
+        self.responses.append(text)
+
+
+class FakeSpecVersions:
+    def supports(self, version: Any) -> bool:
+        return False
+
+
+class FakeClientAPI:
+    """The parts of the client API used to download media: the URLs point to the local media server."""
+
+    token: str = "access-token"
+    as_user_id: str | None = None
+
+    def __init__(self, session: aiohttp.ClientSession, media_url: str) -> None:
+        self.session = session
+        self.media_url = media_url
+
+    def get_download_url(self, media_url: ContentURI, authenticated: bool = False) -> str:
+        return f"{self.media_url}/{media_url.rpartition('/')[2]}"
+
+
+class FakeClient:
+    """Matrix client serving the image events from memory and their media from a local HTTP server."""
+
+    mxid: str = "@memebot:example.org"
+    disable_replies: bool = False  # Read by MaubotMessageEvent, which wraps the commands of replayed promotions
+
+    def __init__(self, session: aiohttp.ClientSession, media_url: str) -> None:
+        self.api = FakeClientAPI(session, media_url)
+        self.events: dict[str, FakeEvent] = {}
+        self.media: dict[str, bytes] = {}
+        self.reactions: list[tuple[str, str]] = []
+        self.downloads: int = 0
+        self.downloaded_bytes: int = 0
+        self.media_delay_seconds: float = 0.0  # Wait before serving media, to keep downloads in flight
+
+    async def versions(self) -> FakeSpecVersions:
+        return FakeSpecVersions()
+
+    async def get_event(self, room_id: str, event_id: str) -> FakeEvent:
+        return self.events[event_id]
+
+    async def react(self, room_id: str, event_id: str, reaction: str) -> None:
+        self.reactions.append((event_id, reaction))
+
+    def add_event_handler(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def add_image(self, event_id: str, image_bytes: bytes, announced_size: int | None = None, sender: str = "@poster:example.org") -> FakeEvent:
+        """Post an image. Its event announces `announced_size` (the real size by default)."""
+        media_url = ContentURI(f"mxc://example.org/{event_id.lstrip('$')}")
+        self.media[media_url.rpartition("/")[2]] = image_bytes
+        image_info = ImageInfo(size=len(image_bytes) if announced_size is None else announced_size, mimetype="image/png")
+        content = MediaMessageEventContent(msgtype=MessageType.IMAGE, body="meme.png", url=media_url, info=image_info)
+        self.events[event_id] = FakeEvent(self, content, sender, event_id)
+        return self.events[event_id]
+
+    def add_encrypted_image(self, event_id: str, ciphertext: bytes, encryption_info: Any) -> FakeEvent:
+        """Post an encrypted image, its ciphertext is served under the URL of `encryption_info`."""
+        self.media[encryption_info.url.rpartition("/")[2]] = ciphertext
+        content = MediaMessageEventContent(msgtype=MessageType.IMAGE, body="meme.png", file=encryption_info, info=ImageInfo(size=len(ciphertext), mimetype="image/png"))
+        self.events[event_id] = FakeEvent(self, content, "@poster:example.org", event_id)
+        return self.events[event_id]
+
+    def create_promote_command(self, target_event_id: str, sender: str, event_id: str) -> FakeEvent:
+        content = TextMessageEventContent(msgtype=MessageType.TEXT, body="!promote")
+        content.relates_to = RelatesTo(in_reply_to=InReplyTo(event_id=target_event_id))
+        return FakeEvent(self, content, sender, event_id)
+
+    async def serve_media(self, request: web.Request) -> web.StreamResponse:
+        """Send a file in chunks without announcing its length, like a homeserver proxying a remote file."""
+        media_bytes: bytes = self.media[request.match_info["media_id"]]
+        self.downloads += 1
+        await asyncio.sleep(self.media_delay_seconds)
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for offset in range(0, len(media_bytes), 4096):
+            await response.write(media_bytes[offset:offset + 4096])
+            self.downloaded_bytes += len(media_bytes[offset:offset + 4096])
+        await response.write_eof()
+        return response
+
+
+class PromotionServer:
+    """Promotion server recording the uploads and the client port they arrived from."""
+
+    def __init__(self) -> None:
+        self.url: str = ""
+        self.statuses: list[int] = []  # Statuses of the next responses, 200 once they are used up
+        self.delay_seconds: float = 0.0
+        self.uploads: list[tuple[str, int]] = []  # Filename and size of the uploaded images
+        self.client_ports: list[int] = []
+
+    async def receive_upload(self, request: web.Request) -> web.Response:
+        self.client_ports.append(request.transport.get_extra_info("peername")[1])  # type: ignore[union-attr]
+        await asyncio.sleep(self.delay_seconds)
+        multipart_reader = await request.multipart()
+        image_part = await multipart_reader.next()
+        image_bytes: bytes = await image_part.read()  # type: ignore[union-attr]
+        status: int = self.statuses.pop(0) if self.statuses else 200
+        if status == 200:
+            self.uploads.append((image_part.filename or "", len(image_bytes)))  # type: ignore[union-attr]
+        return web.Response(status=status)
+
+
+def load_config(overrides: dict[str, Any]) -> Config:
+    yaml = YAML()
+    base_config = yaml.load(BASE_CONFIG_PATH.read_text())
+    config_data = copy.deepcopy(base_config)
+    config = Config(lambda: config_data, lambda: RecursiveDict(copy.deepcopy(base_config), CommentedMap), lambda data: None)
+    config.load_and_update()
+    for key, value in overrides.items():
+        config[key] = value
+    # Reloads (e.g. in start() or on config updates) keep the overrides and later changes
+    config._load_proxy = lambda: config._data
+    return config
+
+
+@pytest.fixture
+async def client() -> AsyncIterator[FakeClient]:
+    async with aiohttp.ClientSession() as session:
+        fake_client = FakeClient(session, "")
+        runner, base_url = await start_http_server([web.get("/media/{media_id}", fake_client.serve_media)])
+        fake_client.api.media_url = f"{base_url}/media"
+        yield fake_client
+        await runner.cleanup()
+
+
+@pytest.fixture
+async def promotion_server() -> AsyncIterator[PromotionServer]:
+    server = PromotionServer()
+    runner, base_url = await start_http_server([web.post("/upload", server.receive_upload)])
+    server.url = f"{base_url}/upload"
+    yield server
+    await runner.cleanup()
+
+
+@pytest.fixture
+async def database(tmp_path: Path) -> AsyncIterator[Database]:
+    plugin_database = Database.create(f"sqlite:{tmp_path / 'memebot.db'}", upgrade_table=upgrade_table)
+    await plugin_database.start()
+    yield plugin_database
+    await plugin_database.stop()
+
+
+@pytest.fixture
+async def start_bot(client: FakeClient, promotion_server: PromotionServer, database: Database) -> AsyncIterator[Callable[..., Awaitable[MemeBot]]]:
+    """Start plugin instances with the base config and the given overrides, without cooldowns or easter eggs unless overridden."""
+    started_bots: list[MemeBot] = []
+
+    async def start(overrides: dict[str, Any] | None = None) -> MemeBot:
+        config = load_config({
+            "promotion.server_url": promotion_server.url,
+            "cooldowns.global": 0,
+            "cooldowns.room": 0,
+            "cooldowns.user": 0,
+            "cooldowns.persist": False,
+            "outbox.enabled": False,
+            # Easter eggs replace the success reaction with a reply now and then
+            "messages.easter_eggs.rare_message_probability": 0,
+            **(overrides or {}),
+        })
+        bot = MemeBot(client, asyncio.get_running_loop(), None, "test", logging.getLogger("memebot.test"), config, database, None, None, None)  # type: ignore[arg-type]
+        await bot.start()
+        started_bots.append(bot)
+        return bot
+
+    yield start
+    for bot in started_bots:
+        await bot.stop()
@@ -0,0 +1,71 @@
+"""
+Tests for the incremental decryption of encrypted attachments: the plaintext matches the original image
+and a hash mismatch aborts the promotion, buffered and streamed.
+"""
+from __future__ import annotations
+
+from mautrix.crypto.attachments import encrypt_attachment
+from mautrix.types import ContentURI, EncryptedFile
+import pytest
+
+from MemeBot.utils import AttachmentDecryptionError, AttachmentDecryptor
+from conftest import FakeClient, PromotionServer, create_png
+
+
+def encrypt_image(image_bytes: bytes) -> tuple[bytes, EncryptedFile]:
+    ciphertext, encryption_info = encrypt_attachment(image_bytes)
+    encryption_info.url = ContentURI("mxc://example.org/encrypted")
+    return ciphertext, encryption_info
+
+
+def create_decryptor(encryption_info: EncryptedFile) -> AttachmentDecryptor:
+    return AttachmentDecryptor(encryption_info.key.key, encryption_info.iv, encryption_info.hashes["sha256"])
+
+
+def test_chunked_decryption_matches_the_image() -> None:
+    image_bytes: bytes = create_png(1, size=256)
+    ciphertext, encryption_info = encrypt_image(image_bytes)
+    decryptor = create_decryptor(encryption_info)
+    # Chunks not aligned to the AES block size
+    plaintext: bytes = b"".join(decryptor.update(ciphertext[offset:offset + 1000]) for offset in range(0, len(ciphertext), 1000))
+    decryptor.verify()
+    assert plaintext == image_bytes
+    assert decryptor.size == len(ciphertext)
+
+
+def test_tampered_ciphertext_fails_verification() -> None:
+    ciphertext, encryption_info = encrypt_image(create_png(1))
+    decryptor = create_decryptor(encryption_info)
+    decryptor.update(ciphertext[:-1] + bytes([ciphertext[-1] ^ 1]))
+    with pytest.raises(AttachmentDecryptionError, match="Mismatched SHA-256 digest"):
+        decryptor.verify()
+
+
+def test_invalid_metadata_is_rejected() -> None:
+    _, encryption_info = encrypt_image(create_png(1))
+    with pytest.raises(AttachmentDecryptionError, match="Invalid key length"):
+        AttachmentDecryptor(encryption_info.key.key[:20], encryption_info.iv, encryption_info.hashes["sha256"])
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+async def test_encrypted_image_is_promoted(start_bot, client: FakeClient, promotion_server: PromotionServer, streaming: bool) -> None:
+    bot = await start_bot({"dedup.enabled": False, "image.streaming.enabled": streaming})
+    image_bytes: bytes = create_png(1, size=256)
+    client.add_encrypted_image("$image", *encrypt_image(image_bytes))
+    promote_command = client.create_promote_command("$image", "@user:example.org", "$promote")
+    await bot.handle_message(promote_command)
+    await bot.promotion_queue.join()
+    assert promotion_server.uploads == [("meme.png", len(image_bytes))]
+    assert not promote_command.responses
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+async def test_hash_mismatch_aborts_the_promotion(start_bot, client: FakeClient, promotion_server: PromotionServer, streaming: bool) -> None:
+    bot = await start_bot({"dedup.enabled": False, "image.streaming.enabled": streaming, "promotion.retry.max_attempts": 1})
+    ciphertext, encryption_info = encrypt_image(create_png(1, size=256))
+    client.add_encrypted_image("$image", ciphertext[:-1] + bytes([ciphertext[-1] ^ 1]), encryption_info)
+    promote_command = client.create_promote_command("$image", "@user:example.org", "$promote")
+    await bot.handle_message(promote_command)
+    await bot.promotion_queue.join()
+    assert not promotion_server.uploads
+    assert promote_command.responses == [bot.config_snapshot.messages["encrypted_image_decrypt_failed"]]
@@ -0,0 +1,97 @@
+"""
+Tests for the circuit breaker transitions: it opens after the failure threshold, lets a single probe through
+once the recovery timeout passed, and reopens when the probe fails or is cancelled.
+"""
+from __future__ import annotations
+
+import pytest
+
+from MemeBot.utils import circuit_breaker
+from MemeBot.utils.circuit_breaker import CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now: float = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", fake_clock)
+    return fake_clock
+
+
+def open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30)
+    for _ in range(3):
+        assert breaker.allow_request()
+        breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_the_failure_threshold(clock: FakeClock) -> None:
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    clock.now += 10
+    assert breaker.retry_after() == pytest.approx(20)
+
+
+def test_success_resets_the_failure_count(clock: FakeClock) -> None:
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_single_probe_after_the_recovery_timeout(clock: FakeClock) -> None:
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.retry_after() == 0
+    # Only one probe is in flight at a time
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_the_circuit(clock: FakeClock) -> None:
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.retry_after() == pytest.approx(30)
+    assert not breaker.allow_request()
+
+
+def test_cancelled_probe_reopens_the_circuit(clock: FakeClock) -> None:
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.allow_request()
+    breaker.record_cancellation()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    # The next probe follows after another timeout instead of waiting for the cancelled one forever
+    clock.now += 30
+    assert breaker.allow_request()
+
+
+def test_cancellation_while_closed_changes_nothing(clock: FakeClock) -> None:
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30)
+    breaker.record_failure()
+    breaker.record_cancellation()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.consecutive_failures == 1
@@ -0,0 +1,50 @@
+"""
+Tests for the config snapshot: it is immutable and replaced as a whole when the config is updated,
+so edited settings take effect without a restart.
+"""
+from __future__ import annotations
+
+import dataclasses
+
+import pytest
+
+from conftest import FakeClient, PromotionServer, create_png
+
+
+async def test_config_update_swaps_the_snapshot(start_bot) -> None:
+    bot = await start_bot()
+    config_snapshot = bot.config_snapshot
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config_snapshot.reply_in_thread = False
+    bot.config["messages"]["reply_in_thread"] = not config_snapshot.reply_in_thread
+    bot.config["image"]["allowed_image_formats"] = ["png"]
+    bot.on_external_config_update()
+    assert bot.config_snapshot is not config_snapshot
+    assert bot.config_snapshot.reply_in_thread is not config_snapshot.reply_in_thread
+    assert bot.config_snapshot.allowed_image_formats == ("PNG",)
+    # Handlers still holding the old snapshot see the old settings only
+    assert config_snapshot.allowed_image_formats != ("PNG",)
+
+
+async def test_invalid_config_update_keeps_the_snapshot(start_bot) -> None:
+    bot = await start_bot()
+    config_snapshot = bot.config_snapshot
+    bot.config["promotion"]["server_url"] = ""
+    bot.on_external_config_update()
+    assert bot.config_snapshot is config_snapshot
+    assert not bot._config_valid
+
+
+async def test_edited_commands_take_effect(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    bot = await start_bot({"dedup.enabled": False})
+    bot.config["commands"] = ["!meme"]
+    bot.on_external_config_update()
+    for index, command in enumerate(("!promote", "!MEME")):
+        client.add_image(f"$image{index}", create_png(index))
+        promote_command = client.create_promote_command(f"$image{index}", "@user:example.org", f"$promote{index}")
+        promote_command.content.body = command
+        await bot.handle_message(promote_command)
+        await bot.promotion_queue.join()
+    # Only the new command promoted its image
+    assert len(promotion_server.uploads) == 1
+    assert client.reactions and client.reactions[0][0] == "$image1"
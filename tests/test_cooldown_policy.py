@@ -0,0 +1,64 @@
+"""
+Tests for the cooldown policies: the token bucket passes a burst of `capacity` promotions and then refills
+one per `refill_seconds`, and giving a promotion back returns its token.
+"""
+from __future__ import annotations
+
+import pytest
+
+from MemeBot.utils.cooldown_policy import FixedWindowPolicy, TokenBucketPolicy
+
+
+def take_promotions(policy: TokenBucketPolicy, state: float, now: float) -> tuple[int, float]:
+    """Take promotions at `now` until the policy refuses one. Returns how many passed and the new state."""
+    taken: int = 0
+    while not policy.wait_time(state, now):
+        state = policy.next_state(state, now)
+        taken += 1
+    return taken, state
+
+
+def test_burst_then_one_per_refill() -> None:
+    policy = TokenBucketPolicy(capacity=3, refill_seconds=10)
+    taken, state = take_promotions(policy, 0.0, 1000.0)
+    assert taken == 3
+    assert policy.wait_time(state, 1000.0) == pytest.approx(10)
+    # Each refill adds one token
+    assert take_promotions(policy, state, 1009.0)[0] == 0
+    taken, state = take_promotions(policy, state, 1010.0)
+    assert taken == 1
+    assert take_promotions(policy, state, 1020.0)[0] == 1
+
+
+def test_bucket_refills_up_to_its_capacity() -> None:
+    policy = TokenBucketPolicy(capacity=3, refill_seconds=10)
+    _, state = take_promotions(policy, 0.0, 1000.0)
+    # Two refills give back two tokens, a long pause never more than the capacity
+    assert take_promotions(policy, state, 1020.0)[0] == 2
+    assert take_promotions(policy, state, 5000.0)[0] == 3
+
+
+def test_released_token_is_returned() -> None:
+    policy = TokenBucketPolicy(capacity=2, refill_seconds=10)
+    first_state: float = policy.next_state(0.0, 1000.0)
+    second_state: float = policy.next_state(first_state, 1000.0)
+    assert policy.wait_time(second_state, 1000.0)
+    released_state = policy.release_state(second_state, second_state, 1000.0)
+    assert released_state == first_state
+    assert not policy.wait_time(released_state, 1000.0)
+
+
+def test_refilled_token_is_not_released_twice() -> None:
+    policy = TokenBucketPolicy(capacity=2, refill_seconds=10)
+    state: float = policy.next_state(0.0, 1000.0)
+    assert policy.release_state(state, state, 1010.0) is None
+
+
+def test_fixed_window_waits_the_whole_cooldown() -> None:
+    policy = FixedWindowPolicy(cooldown_seconds=60)
+    state: float = policy.next_state(0.0, 1000.0)
+    assert policy.wait_time(state, 1030.0) == pytest.approx(30)
+    assert policy.wait_time(state, 1060.0) == 0
+    assert policy.release_state(state, state, 1010.0) == 1000.0
+    # A later promotion's window is not given back
+    assert policy.release_state(policy.next_state(state, 1060.0), state, 1070.0) is None
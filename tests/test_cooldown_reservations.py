@@ -0,0 +1,89 @@
+"""
+Stress tests for the cooldown reservations: concurrent promotions must not pass the cooldowns,
+and promotions that fail must give back what they reserved.
+"""
+from __future__ import annotations
+
+from typing import Any
+import asyncio
+
+import pytest
+
+from MemeBot import MemeBot
+from MemeBot.utils.cooldown_policy import FixedWindowPolicy, TokenBucketPolicy
+from conftest import FakeClient, FakeEvent, create_png
+
+PROMOTIONS: int = 300
+
+
+@pytest.fixture
+def start_promoting_bot(start_bot):
+    async def start(policy: str, upload_succeeds: bool) -> tuple[MemeBot, list[str]]:
+        bot = await start_bot({
+            "promotion.retry.max_attempts": 1,
+            "cooldowns.policy": policy,
+            "cooldowns.global": 60,
+            "cooldowns.room": 60,
+            "cooldowns.user": 60,
+            "queue.max_size": PROMOTIONS,
+            "queue.workers": 8,
+            "dedup.enabled": False,
+            "metrics.enabled": False,
+        })
+        uploaded_images: list[str] = []
+
+        async def upload_image_to_server(image_data: bytes, image_filename: str, *args: Any) -> bool:
+            # Keep the promotions in flight long enough for all of them to overlap
+            await asyncio.sleep(0.01)
+            uploaded_images.append(image_filename)
+            return upload_succeeds
+
+        bot._upload_image_to_server = upload_image_to_server  # type: ignore[method-assign]
+        return bot, uploaded_images
+
+    return start
+
+
+async def promote_concurrently(bot: MemeBot, client: FakeClient) -> list[FakeEvent]:
+    """Send all promote commands at once, from ten users, and wait until every accepted promotion is done."""
+    promote_commands: list[FakeEvent] = []
+    for index in range(PROMOTIONS):
+        client.add_image(f"$image{index}", create_png(index))
+        promote_commands.append(client.create_promote_command(f"$image{index}", f"@user{index % 10}:example.org", f"$promote{index}"))
+    await asyncio.gather(*(bot.handle_message(promote_command) for promote_command in promote_commands))
+    assert bot.promotion_queue is not None
+    await bot.promotion_queue.join()
+    return promote_commands
+
+
+async def test_fixed_window_lets_one_promotion_through(start_promoting_bot, client: FakeClient) -> None:
+    bot, uploaded_images = await start_promoting_bot("fixed", upload_succeeds=True)
+    promote_commands = await promote_concurrently(bot, client)
+    assert len(uploaded_images) == 1
+    # Everyone else was told to wait
+    assert sum(1 for promote_command in promote_commands if promote_command.responses) == PROMOTIONS - 1
+
+
+async def test_token_bucket_lets_burst_through(start_promoting_bot, client: FakeClient) -> None:
+    bot, uploaded_images = await start_promoting_bot("token_bucket", upload_succeeds=True)
+    await promote_concurrently(bot, client)
+    assert len(uploaded_images) == bot.config["cooldowns"]["burst"]["global"]
+
+
+@pytest.mark.parametrize("policy", ["fixed", "token_bucket"])
+async def test_failed_uploads_release_all_reservations(start_promoting_bot, client: FakeClient, policy: str) -> None:
+    bot, uploaded_images = await start_promoting_bot(policy, upload_succeeds=False)
+    await promote_concurrently(bot, client)
+    assert uploaded_images
+    assert bot.cooldown_store is not None
+    assert len(bot.cooldown_store) == 0
+
+
+def test_release_keeps_later_reservations() -> None:
+    # A promotion outliving its window must not give back the window of a promotion reserved after it
+    fixed_window_policy = FixedWindowPolicy(60)
+    assert fixed_window_policy.release_state(state=190, reserved_state=160, now=170) is None
+    assert fixed_window_policy.release_state(state=160, reserved_state=160, now=110) == 100
+    token_bucket_policy = TokenBucketPolicy(3, 60)
+    assert token_bucket_policy.release_state(state=220, reserved_state=160, now=170) is None
+    assert token_bucket_policy.release_state(state=220, reserved_state=160, now=110) == 160
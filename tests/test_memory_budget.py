@@ -0,0 +1,84 @@
+"""
+Tests for the memory budget: the byte-weighted semaphore itself, and buffered downloads that must stay within
+the bytes reserved for them.
+"""
+from __future__ import annotations
+
+import asyncio
+
+from MemeBot.utils import ByteBudget
+from conftest import FakeClient, PromotionServer, create_png
+
+
+async def test_acquire_waits_in_order_until_released() -> None:
+    memory_budget = ByteBudget(100)
+    assert memory_budget.try_acquire(60)
+    large_request = asyncio.create_task(memory_budget.acquire(80, timeout=5))
+    await asyncio.sleep(0)
+    # A small request doesn't overtake the large one waiting before it
+    assert not memory_budget.try_acquire(10)
+    small_request = asyncio.create_task(memory_budget.acquire(10, timeout=5))
+    await asyncio.sleep(0)
+    assert memory_budget.waiting == 2
+    memory_budget.release(60)
+    assert await large_request
+    assert await small_request
+    assert memory_budget.in_use_bytes == 90
+    assert memory_budget.peak_bytes == 90
+    assert memory_budget.waited == 2
+
+
+async def test_acquire_times_out_and_lets_the_next_request_in() -> None:
+    memory_budget = ByteBudget(100)
+    assert memory_budget.try_acquire(50)
+    assert not await memory_budget.acquire(80, timeout=0)
+    assert not await memory_budget.acquire(80, timeout=0.01)
+    assert memory_budget.timeouts == 2
+    assert memory_budget.waiting == 0
+    assert await memory_budget.acquire(50, timeout=0)
+    assert memory_budget.in_use_bytes == 100
+
+
+async def test_cancelled_acquire_gives_up_its_place() -> None:
+    memory_budget = ByteBudget(100)
+    assert memory_budget.try_acquire(100)
+    cancelled_request = asyncio.create_task(memory_budget.acquire(100, timeout=5))
+    await asyncio.sleep(0)
+    cancelled_request.cancel()
+    await asyncio.gather(cancelled_request, return_exceptions=True)
+    assert memory_budget.waiting == 0
+    memory_budget.release(100)
+    assert memory_budget.in_use_bytes == 0
+
+
+async def test_request_larger_than_the_capacity_runs_alone() -> None:
+    memory_budget = ByteBudget(100)
+    assert memory_budget.try_acquire(500)
+    assert memory_budget.in_use_bytes == 100
+    assert not memory_budget.try_acquire(1)
+    memory_budget.release(500)
+    assert memory_budget.in_use_bytes == 0
+
+
+async def test_download_larger_than_announced_is_aborted(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    bot = await start_bot({"media_cache.enabled": False, "event_cache.enabled": False})
+    image_bytes: bytes = create_png(1, size=512) + bytes(200_000)
+    client.add_image("$image", image_bytes, announced_size=1024)
+    promote_command = client.create_promote_command("$image", "@user:example.org", "$promote")
+    await bot.handle_message(promote_command)
+    await bot.promotion_queue.join()
+    assert promote_command.responses == [bot.config["messages"]["image_size_exceeded"]]
+    assert promotion_server.uploads == []
+    assert bot.memory_budget.in_use_bytes == 0
+
+
+async def test_download_within_announced_size_is_promoted(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    bot = await start_bot({"media_cache.enabled": False, "event_cache.enabled": False})
+    image_bytes: bytes = create_png(2, size=512)
+    client.add_image("$image", image_bytes)
+    promote_command = client.create_promote_command("$image", "@user:example.org", "$promote")
+    await bot.handle_message(promote_command)
+    await bot.promotion_queue.join()
+    assert promote_command.responses == []
+    assert promotion_server.uploads == [("meme.png", len(image_bytes))]
+    assert bot.memory_budget.peak_bytes == len(image_bytes)
@@ -0,0 +1,81 @@
+"""
+Tests for repost detection: the multi-index hash table finds the same nearest hash as a linear scan,
+forgets removed and expired hashes, and resized images get nearby perceptual hashes.
+"""
+from __future__ import annotations
+
+import io
+import random
+import time
+
+from PIL import Image
+import pytest
+
+from MemeBot.utils import PERCEPTUAL_HASH_AVAILABLE, MultiIndexHashTable, perceptual_hash
+
+
+def flip_bits(hash_value: int, bits: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), bits):
+        hash_value ^= 1 << bit
+    return hash_value
+
+
+@pytest.mark.parametrize("max_distance", [0, 3, 6, 10])
+def test_find_nearest_matches_a_linear_scan(max_distance: int) -> None:
+    rng = random.Random(max_distance)
+    table: MultiIndexHashTable[int] = MultiIndexHashTable(max_entries=10_000, ttl_seconds=60)
+    stored_hashes: list[int] = [rng.getrandbits(64) for _ in range(2000)]
+    for item, hash_value in enumerate(stored_hashes):
+        table.add(hash_value, item)
+    for _ in range(300):
+        # Queries near stored hashes and random ones
+        query: int = flip_bits(rng.choice(stored_hashes), rng.randint(0, 12), rng) if rng.random() < 0.8 else rng.getrandbits(64)
+        expected_distance: int = min((query ^ hash_value).bit_count() for hash_value in stored_hashes)
+        match = table.find_nearest(query, max_distance)
+        if expected_distance > max_distance:
+            assert match is None
+        else:
+            assert match is not None
+            distance, item = match
+            assert distance == expected_distance == (query ^ stored_hashes[item]).bit_count()
+
+
+def test_removed_hashes_are_not_found() -> None:
+    table: MultiIndexHashTable[str] = MultiIndexHashTable(max_entries=10, ttl_seconds=60)
+    table.add(0b1011, "first")
+    assert table.remove(0b1011)
+    assert not table.remove(0b1011)
+    assert table.find_nearest(0b1011, 6) is None
+    assert len(table) == 0
+
+
+def test_expired_hash_does_not_hide_a_farther_one() -> None:
+    table: MultiIndexHashTable[str] = MultiIndexHashTable(max_entries=10, ttl_seconds=60)
+    table.add(0b1, "expired", added_at=time.time() - 61)
+    table.add(0b111, "current")
+    assert table.find_nearest(0b0, 6) == (3, "current")
+    # The expired hash was removed on the way
+    assert len(table) == 1
+
+
+def test_least_recently_used_hash_is_evicted() -> None:
+    table: MultiIndexHashTable[str] = MultiIndexHashTable(max_entries=2, ttl_seconds=60)
+    table.add(1 << 10, "a")
+    table.add(1 << 30, "b")
+    assert table.find_nearest(1 << 10, 0) == (0, "a")
+    assert table.add(1 << 50, "c") == [1 << 30]
+    assert table.find_nearest(1 << 30, 0) is None
+    assert table.evictions == 1
+
+
+@pytest.mark.skipif(not PERCEPTUAL_HASH_AVAILABLE, reason="numpy is not installed")
+def test_resized_image_has_a_nearby_hash() -> None:
+    image = Image.radial_gradient("L").convert("RGB")
+    resized_buffer, original_buffer = io.BytesIO(), io.BytesIO()
+    image.save(original_buffer, "PNG")
+    image.resize((128, 128)).save(resized_buffer, "JPEG", quality=70)
+    other_buffer = io.BytesIO()
+    Image.linear_gradient("L").convert("RGB").save(other_buffer, "PNG")
+    original_hash: int = perceptual_hash(original_buffer.getvalue())
+    assert (original_hash ^ perceptual_hash(resized_buffer.getvalue())).bit_count() <= 6
+    assert (original_hash ^ perceptual_hash(other_buffer.getvalue())).bit_count() > 6
@@ -0,0 +1,78 @@
+"""
+Tests for speculative prefetching: prefetched images save the download of the promotion, and prefetching stays
+within its bounds (concurrency cap, announced size and free memory budget).
+"""
+from __future__ import annotations
+
+import asyncio
+import io
+import random
+
+from PIL import Image
+
+from MemeBot import MemeBot
+from conftest import FakeClient, PromotionServer, create_png
+
+PREFETCH_SETTINGS: dict[str, object] = {"prefetch.enabled": True, "dedup.enabled": False}
+
+
+def create_noise_png(size: int) -> bytes:
+    """A PNG that doesn't compress, so its file size grows with its pixels."""
+    image_buffer = io.BytesIO()
+    Image.frombytes("RGB", (size, size), random.Random(size).randbytes(size * size * 3)).save(image_buffer, "PNG")
+    return image_buffer.getvalue()
+
+
+async def post_images(bot: MemeBot, client: FakeClient, images: list[tuple[bytes, int | None]]) -> None:
+    """Post images with their announced size and wait for the prefetches they started."""
+    for index, (image_bytes, announced_size) in enumerate(images):
+        await bot.handle_message(client.add_image(f"$image{index}", image_bytes, announced_size))
+    await asyncio.gather(*bot.prefetch_tasks)
+
+
+async def test_prefetched_image_is_not_downloaded_again(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    bot = await start_bot(PREFETCH_SETTINGS)
+    await post_images(bot, client, [(create_png(1), None)])
+    assert bot._is_image_prefetched("$image0")
+    await bot.handle_message(client.create_promote_command("$image0", "@user:example.org", "$promote"))
+    await bot.promotion_queue.join()
+    assert len(promotion_server.uploads) == 1
+    assert client.downloads == 1
+    assert bot.prefetch_counts["hits"] == 1
+
+
+async def test_prefetches_beyond_the_cap_are_skipped(start_bot, client: FakeClient) -> None:
+    client.media_delay_seconds = 0.1
+    bot = await start_bot({**PREFETCH_SETTINGS, "prefetch.max_concurrent": 2})
+    await post_images(bot, client, [(create_png(index), None) for index in range(5)])
+    assert bot.prefetch_counts["prefetched"] == 2
+    assert bot.prefetch_counts["skipped"] == 3
+    assert client.downloads == 2
+
+
+async def test_image_larger_than_announced_is_aborted(start_bot, client: FakeClient) -> None:
+    bot = await start_bot(PREFETCH_SETTINGS)
+    await post_images(bot, client, [(create_noise_png(256), 10_000)])
+    assert not bot._is_image_prefetched("$image0")
+    # Rejected by the size limit of the download, the announced size passed admission
+    assert bot.prefetch_counts["rejected"] == 1
+    assert bot.memory_budget is not None and bot.memory_budget.in_use_bytes == 0
+
+
+async def test_images_without_announced_size_are_skipped(start_bot, client: FakeClient) -> None:
+    bot = await start_bot(PREFETCH_SETTINGS)
+    await post_images(bot, client, [(create_png(1), 0)])
+    assert bot.prefetch_counts["skipped"] == 1
+    assert client.downloads == 0
+
+
+async def test_prefetch_only_uses_free_memory(start_bot, client: FakeClient) -> None:
+    bot = await start_bot({**PREFETCH_SETTINGS, "memory_budget.max_inflight_bytes": 100_000})
+    assert bot.memory_budget is not None
+    # Promotions hold most of the budget
+    assert bot.memory_budget.try_acquire(90_000)
+    await post_images(bot, client, [(create_noise_png(64), None)])
+    assert bot.prefetch_counts["skipped"] == 1
+    assert client.downloads == 0
+    bot.memory_budget.release(90_000)
+    assert bot.memory_budget.in_use_bytes == 0
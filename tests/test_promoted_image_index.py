@@ -0,0 +1,81 @@
+"""
+Tests for the promoted image index: entries expire after their TTL, the least recently used entry is evicted
+first, and images only count as promoted on the server they were uploaded to. Repeated promotions of an image
+are not uploaded again.
+"""
+from __future__ import annotations
+
+import time
+
+from MemeBot.utils import PromotedImage, PromotedImageIndex
+from conftest import FakeClient, PromotionServer, create_png
+
+SERVER_URL: str = "https://promotion.example.org/upload"
+
+
+def create_entry(digest: str, promoted_at: float | None = None, media_urls: set[str] | None = None, server_url: str = SERVER_URL) -> PromotedImage:
+    return PromotedImage(digest, server_url, f"$event-{digest}", "!room:example.org", time.time() if promoted_at is None else promoted_at, media_urls or set())
+
+
+def test_lookup_by_digest_and_media_url() -> None:
+    index = PromotedImageIndex(max_entries=10, ttl_seconds=60)
+    index.add(create_entry("a", media_urls={"mxc://example.org/a"}))
+    index.add_media_url(SERVER_URL, "a", "mxc://example.org/forwarded")
+    assert index.lookup(SERVER_URL, "a") is not None
+    assert index.lookup(SERVER_URL, "b") is None
+    assert index.lookup_media_url(SERVER_URL, "mxc://example.org/forwarded") is not None
+    assert (index.hits, index.misses, index.media_url_hits) == (1, 1, 1)
+
+
+def test_entries_are_separate_per_server() -> None:
+    index = PromotedImageIndex(max_entries=10, ttl_seconds=60)
+    index.add(create_entry("a", media_urls={"mxc://example.org/a"}))
+    assert index.lookup("https://other.example.org/upload", "a") is None
+    assert index.lookup_media_url("https://other.example.org/upload", "mxc://example.org/a") is None
+
+
+def test_expired_entries_are_dropped() -> None:
+    index = PromotedImageIndex(max_entries=10, ttl_seconds=60)
+    index.add(create_entry("old", promoted_at=time.time() - 61, media_urls={"mxc://example.org/old"}))
+    index.add(create_entry("new", promoted_at=time.time() - 59))
+    assert index.lookup(SERVER_URL, "old") is None
+    assert index.lookup(SERVER_URL, "new") is not None
+    # The media URL of the expired entry is forgotten with it
+    assert index.lookup_media_url(SERVER_URL, "mxc://example.org/old") is None
+    assert len(index) == 1
+
+
+def test_least_recently_used_entry_is_evicted() -> None:
+    index = PromotedImageIndex(max_entries=2, ttl_seconds=60)
+    index.add(create_entry("a", media_urls={"mxc://example.org/a"}))
+    index.add(create_entry("b"))
+    # Looking up "a" makes "b" the least recently used entry
+    assert index.lookup(SERVER_URL, "a") is not None
+    assert index.add(create_entry("c")) == [(SERVER_URL, "b")]
+    assert index.lookup(SERVER_URL, "b") is None
+    assert index.lookup(SERVER_URL, "a") is not None
+    assert index.lookup_media_url(SERVER_URL, "mxc://example.org/a") is not None
+    assert index.evictions == 1
+
+
+def test_refreshed_entry_keeps_its_media_urls() -> None:
+    index = PromotedImageIndex(max_entries=10, ttl_seconds=60)
+    index.add(create_entry("a", media_urls={"mxc://example.org/first"}))
+    index.add(create_entry("a", media_urls={"mxc://example.org/second"}))
+    assert len(index) == 1
+    entry = index.lookup(SERVER_URL, "a")
+    assert entry is not None and entry.media_urls == {"mxc://example.org/first", "mxc://example.org/second"}
+
+
+async def test_duplicate_image_is_not_uploaded_again(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    bot = await start_bot({"dedup.action": "reject"})
+    promote_commands = []
+    # The same content posted twice, as separate uploads
+    for index in range(2):
+        client.add_image(f"$image{index}", create_png(1))
+        promote_commands.append(client.create_promote_command(f"$image{index}", f"@user{index}:example.org", f"$promote{index}"))
+        await bot.handle_message(promote_commands[-1])
+        await bot.promotion_queue.join()
+    assert len(promotion_server.uploads) == 1
+    assert not promote_commands[0].responses
+    assert promote_commands[1].responses == [bot.config_snapshot.messages["duplicate_image"]]
@@ -0,0 +1,102 @@
+"""
+Tests for coalesced promotions: requests for an image that is already being promoted join that promotion,
+pass the cooldowns first, and are answered once per user even if the promotion raises.
+"""
+from __future__ import annotations
+
+import asyncio
+
+from MemeBot import MemeBot
+from conftest import FakeClient, FakeEvent, PromotionServer, create_png
+
+
+async def join_promotion(bot: MemeBot, client: FakeClient, senders: list[str]) -> list[FakeEvent]:
+    """Promote one image from each sender while the first promotion is still running, and wait until it is done."""
+    client.add_image("$image", create_png(1))
+    promote_commands: list[FakeEvent] = [
+        client.create_promote_command("$image", sender, f"$promote{index}") for index, sender in enumerate(senders)
+    ]
+    for promote_command in promote_commands:
+        await bot.handle_message(promote_command)
+    assert bot.promotion_queue is not None
+    await bot.promotion_queue.join()
+    return promote_commands
+
+
+async def test_followers_share_one_upload(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    promotion_server.delay_seconds = 0.2
+    bot = await start_bot({"dedup.enabled": False})
+    promote_commands = await join_promotion(bot, client, ["@first:example.org", "@second:example.org", "@third:example.org"])
+    assert len(promotion_server.uploads) == 1
+    assert client.downloads == 1
+    assert bot.joined_promotions == 2
+    # The reaction on the image answers everyone
+    assert all(not promote_command.responses for promote_command in promote_commands)
+
+
+async def test_followers_pass_the_cooldowns_first(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    promotion_server.delay_seconds = 0.2
+    bot = await start_bot({"dedup.enabled": False, "cooldowns.global": 60})
+    first_command, second_command = await join_promotion(bot, client, ["@first:example.org", "@second:example.org"])
+    # The global cooldown reserved by the first promotion applies to the second request as well
+    assert bot.joined_promotions == 0
+    assert len(second_command.responses) == 1
+    assert not first_command.responses
+
+
+async def test_successful_promotion_keeps_the_follower_cooldowns(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    promotion_server.delay_seconds = 0.2
+    bot = await start_bot({"dedup.enabled": False, "cooldowns.user": 60})
+    await join_promotion(bot, client, ["@first:example.org", "@second:example.org"])
+    assert bot.joined_promotions == 1
+    client.add_image("$other", create_png(2))
+    next_command = client.create_promote_command("$other", "@second:example.org", "$next")
+    await bot.handle_message(next_command)
+    assert len(next_command.responses) == 1
+    assert len(promotion_server.uploads) == 1
+
+
+async def test_failed_promotion_answers_each_user_once(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    promotion_server.delay_seconds = 0.2
+    promotion_server.statuses = [500]
+    bot = await start_bot({"dedup.enabled": False, "promotion.retry.max_attempts": 1})
+    senders: list[str] = ["@first:example.org", "@second:example.org", "@second:example.org", "@third:example.org"]
+    promote_commands = await join_promotion(bot, client, senders)
+    failure_message: str = bot.config_snapshot.messages["joined_promotion_failed"]
+    assert [promote_command.responses for promote_command in promote_commands[1:]] == [[failure_message], [], [failure_message]]
+
+
+async def test_failed_promotion_releases_the_follower_cooldowns(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    promotion_server.delay_seconds = 0.2
+    promotion_server.statuses = [500]
+    bot = await start_bot({"dedup.enabled": False, "promotion.retry.max_attempts": 1, "cooldowns.user": 60})
+    await join_promotion(bot, client, ["@first:example.org", "@second:example.org"])
+    assert bot.joined_promotions == 1
+    client.add_image("$other", create_png(2))
+    next_command = client.create_promote_command("$other", "@second:example.org", "$next")
+    await bot.handle_message(next_command)
+    await bot.promotion_queue.join()
+    assert not next_command.responses
+    assert len(promotion_server.uploads) == 1
+
+
+async def test_followers_beyond_the_limit_are_not_answered(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    promotion_server.delay_seconds = 0.2
+    promotion_server.statuses = [500]
+    bot = await start_bot({"dedup.enabled": False, "promotion.retry.max_attempts": 1})
+    senders: list[str] = [f"@user{index}:example.org" for index in range(bot.MAX_PROMOTION_FOLLOWERS + 5)]
+    promote_commands = await join_promotion(bot, client, senders)
+    assert bot.joined_promotions == len(senders) - 1
+    assert sum(1 for promote_command in promote_commands[1:] if promote_command.responses) == bot.MAX_PROMOTION_FOLLOWERS
+
+
+async def test_followers_are_answered_when_the_promotion_raises(start_bot, client: FakeClient) -> None:
+    bot = await start_bot({"dedup.enabled": False})
+
+    async def promote_job_image(job: object) -> str | None:
+        await asyncio.sleep(0.1)
+        raise RuntimeError("promotion crashed")
+
+    bot._promote_job_image = promote_job_image  # type: ignore[method-assign]
+    _, follower_command = await join_promotion(bot, client, ["@first:example.org", "@second:example.org"])
+    assert follower_command.responses == [bot.config_snapshot.messages["joined_promotion_failed"]]
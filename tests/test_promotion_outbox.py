@@ -0,0 +1,68 @@
+"""
+Tests for the promotion outbox: promotions interrupted by a shutdown stay in the plugin database
+and are replayed on the next start, unusable entries are dropped.
+"""
+from __future__ import annotations
+
+import asyncio
+
+from mautrix.util.async_db import Database
+
+from MemeBot import MemeBot
+from conftest import ROOM_ID, FakeClient, PromotionServer, create_png
+
+OUTBOX_SETTINGS: dict[str, object] = {"outbox.enabled": True, "outbox.flush_interval_seconds": 0.05, "dedup.enabled": False}
+
+
+async def count_outbox_rows(database: Database) -> int:
+    return await database.fetchval("SELECT COUNT(*) FROM promotion_outbox")
+
+
+async def finish_replay(bot: MemeBot) -> None:
+    assert bot.outbox_replay_task is not None and bot.promotion_queue is not None
+    await bot.outbox_replay_task
+    await bot.promotion_queue.join()
+
+
+async def test_interrupted_promotion_is_replayed(start_bot, client: FakeClient, promotion_server: PromotionServer, database: Database) -> None:
+    promotion_server.delay_seconds = 1.0
+    first_bot = await start_bot(OUTBOX_SETTINGS)
+    client.add_image("$image", create_png(1))
+    await first_bot.handle_message(client.create_promote_command("$image", "@user:example.org", "$promote"))
+    # Let the outbox write the promotion, then stop in the middle of the upload
+    await asyncio.sleep(0.2)
+    await first_bot.stop()
+    assert not promotion_server.uploads
+    assert await count_outbox_rows(database) == 1
+
+    promotion_server.delay_seconds = 0.0
+    second_bot = await start_bot(OUTBOX_SETTINGS)
+    await finish_replay(second_bot)
+    assert len(promotion_server.uploads) == 1
+    assert [event_id for event_id, _ in client.reactions] == ["$image"]
+    await second_bot.stop()
+    assert await count_outbox_rows(database) == 0
+
+
+async def test_finished_promotions_leave_no_rows(start_bot, client: FakeClient, promotion_server: PromotionServer, database: Database) -> None:
+    bot = await start_bot(OUTBOX_SETTINGS)
+    for index in range(3):
+        client.add_image(f"$image{index}", create_png(index))
+        await bot.handle_message(client.create_promote_command(f"$image{index}", f"@user{index}:example.org", f"$promote{index}"))
+    await finish_replay(bot)
+    await bot.stop()
+    assert len(promotion_server.uploads) == 3
+    assert await count_outbox_rows(database) == 0
+
+
+async def test_unreadable_entry_is_dropped(start_bot, promotion_server: PromotionServer, database: Database) -> None:
+    await database.execute(
+        "INSERT INTO promotion_outbox (event_id, room_id, sender, target_event_id, target_sender, image_filename, media_content, created_at) "
+        "VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+        "$promote", ROOM_ID, "@user:example.org", "$image", "@poster:example.org", "meme.png", "not json", 0
+    )
+    bot = await start_bot(OUTBOX_SETTINGS)
+    await finish_replay(bot)
+    await bot.stop()
+    assert not promotion_server.uploads
+    assert await count_outbox_rows(database) == 0
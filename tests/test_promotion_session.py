@@ -0,0 +1,36 @@
+"""
+Tests for the pooled promotion session: uploads reuse one session and its connections until the plugin stops.
+"""
+from __future__ import annotations
+
+import pytest
+
+from conftest import FakeClient, PromotionServer, create_png
+
+
+async def test_uploads_reuse_the_pooled_connection(start_bot, client: FakeClient, promotion_server: PromotionServer) -> None:
+    bot = await start_bot({"dedup.enabled": False})
+    promotion_session = bot.promotion_session
+    for index in range(5):
+        client.add_image(f"$image{index}", create_png(index))
+        await bot.handle_message(client.create_promote_command(f"$image{index}", f"@user{index}:example.org", f"$promote{index}"))
+        await bot.promotion_queue.join()
+    assert len(promotion_server.uploads) == 5
+    assert bot.promotion_session is promotion_session
+    # One keep-alive connection carried all uploads
+    assert len(set(promotion_server.client_ports)) == 1
+
+
+async def test_stop_closes_the_session(start_bot) -> None:
+    bot = await start_bot()
+    promotion_session = bot.promotion_session
+    assert promotion_session is not None and not promotion_session.closed
+    await bot.stop()
+    assert promotion_session.closed
+    assert bot.promotion_session is None
+    # Nothing is started again behind the back of a stopped plugin
+    assert not bot.components_started
+    with pytest.raises(RuntimeError):
+        bot._get_promotion_session()
+    with pytest.raises(RuntimeError):
+        bot._get_cooldown_store()